@@ -1,9 +1,11 @@
 from django.contrib import admin
 from django.conf import settings
+from django.db.models import Q
 
 from mptt.admin import MPTTModelAdmin
 
-from .models import OrgUnit, Identifier
+from .models import AuditChangeSet, OrgUnit, Identifier
+from .search import search_orgunits
 
 def level_name_from_id(obj):
     return settings.ORG_UNIT_LEVELS[obj.level]
@@ -17,8 +19,26 @@ class OrgUnitAdmin(MPTTModelAdmin):
     readonly_fields = ['uuid', 'identifiers']
     search_fields = ['name', 'identifiers__external_id']
 
+    def get_search_results(self, request, queryset, search_term):
+        # names through the search index instead of a LIKE scan, identifiers exactly
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        pks = [row['pk'] for _, row in search_orgunits(search_term, queryset=queryset, limit=100, fields=('pk',))]
+        return queryset.filter(Q(pk__in=pks) | Q(identifiers__external_id=search_term)).distinct(), True
+
 class IdentifierAdmin(admin.ModelAdmin):
     list_display = ['agency', 'context', 'external_id']
 
+class AuditChangeSetAdmin(admin.ModelAdmin):
+    list_display = ['operation', 'user', 'started_at', 'finished_at', 'object_count']
+    list_filter = ['operation']
+    fields = ['operation', 'description', 'user', ('started_at', 'finished_at'), 'object_count', 'counts']
+    readonly_fields = ['operation', 'description', 'user', 'started_at', 'finished_at', 'object_count', 'counts']
+
+    def has_add_permission(self, request):
+        return False
+
 admin.site.register(OrgUnit, OrgUnitAdmin)
 admin.site.register(Identifier, IdentifierAdmin)
+admin.site.register(AuditChangeSet, AuditChangeSetAdmin)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class FacilitiesConfig(AppConfig):
     name = 'facilities'
+
+    def ready(self):
+        import facilities.signals # noqa: F401 (registers the signal receivers)
@@ -0,0 +1,373 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.db import close_old_connections, connection, transaction
+from django.db.models import signals
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+import zlib
+
+from easyaudit.middleware.easyaudit import get_current_request, get_current_user
+from easyaudit.models import CRUDEvent
+from easyaudit.settings import CRUD_DIFFERENCE_CALLBACKS, WATCH_MODEL_EVENTS
+from easyaudit.signals.model_signals import _m2m_rev_field_name, should_audit
+from easyaudit.utils import model_delta
+
+from facilities.models import AuditChangeSet
+
+# Audit logging without a write per saved row. django-easy-audit inserts a
+# CRUDEvent (after looking the user up again) inside every save and delete;
+# install() swaps its model signal receivers for ones building the same
+# events, but queueing them:
+#
+# - within a request (AuditBufferMiddleware) or a buffered_audit() block they
+#   are written with one bulk insert at the end, or every AUDIT_FLUSH_SIZE
+#   events. Elsewhere they are written as they come, like easyaudit does.
+# - events raised in a transaction are only queued once it commits, so rolled
+#   back writes leave no audit rows, as before.
+# - with AUDIT_ASYNC the inserts are left to a background thread, which tries
+#   a failed insert again on a new connection before giving up on it.
+#
+# Bulk writers (the importer, FacilityBatch, Restructure) run in an
+# audit_batch(): the CRUD events of the saves in it are replaced by one
+# AuditChangeSet holding the changes of every object compactly, and writers
+# that bypass save() add their changes to it themselves.
+
+logger = logging.getLogger(__name__)
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+LINKED = 'm2m'
+
+_local = threading.local()
+
+def current_user():
+    user = get_current_user()
+    return user if user is not None and user.is_authenticated else None
+
+class AuditBatch:
+    """
+    Changes of one bulk operation, saved as an AuditChangeSet
+    """
+    def __init__(self, operation, description='', user=None):
+        self.operation = operation
+        self.description = description
+        self.user = user
+        self.started_at = timezone.now()
+        self.changes = OrderedDict() # model label -> {action: [[pk, detail], ...]}
+
+    def add(self, model, action, pk, detail=None):
+        """
+        Record `action` on object `pk` of `model` (a model, an instance or a
+        label). The detail is the object's text for creations and deletions,
+        {field: [old, new]} for updates.
+        """
+        label = model if isinstance(model, str) else model._meta.label_lower
+        self.changes.setdefault(label, OrderedDict()).setdefault(action, []).append([pk, detail])
+
+    def add_links(self, model, related_model, links):
+        """
+        Record new many-to-many links, an iterable of (pk, related pk) pairs
+        """
+        related = OrderedDict()
+        for pk, related_pk in sorted(links):
+            related.setdefault(pk, []).append(related_pk)
+        for pk, related_pks in related.items():
+            self.add(model, LINKED, pk, {'action': 'post_add', 'model': related_model._meta.label_lower, 'pks': related_pks})
+
+    def counts(self):
+        return OrderedDict(
+            (label, OrderedDict((action, len(entries)) for action, entries in actions.items()))
+            for label, actions in self.changes.items()
+        )
+
+    def save(self):
+        """
+        Write the change set, returns it (None when nothing changed)
+        """
+        object_count = sum(len(entries) for actions in self.changes.values() for entries in actions.values())
+        if not object_count:
+            return None
+        return AuditChangeSet.objects.create(
+            operation=self.operation,
+            description=self.description,
+            user_id=self.user.pk if self.user is not None else None,
+            started_at=self.started_at,
+            finished_at=timezone.now(),
+            object_count=object_count,
+            counts=json.dumps(self.counts()),
+            changes=zlib.compress(json.dumps(self.changes, separators=(',', ':'), default=force_text).encode()),
+        )
+
+def current_batch():
+    return getattr(_local, 'batch', None)
+
+@contextmanager
+def audit_batch(operation, description='', user=None):
+    """
+    Audit the writes in the block as one AuditChangeSet, saved when the block
+    completes. Nested blocks are part of the outer one. Yields the
+    AuditBatch, for writers that bypass the model signals.
+    """
+    batch = current_batch()
+    if batch is not None:
+        yield batch
+        return
+    batch = _local.batch = AuditBatch(operation, description, user if user is not None else current_user())
+    try:
+        yield batch
+    finally:
+        _local.batch = None
+    if WATCH_MODEL_EVENTS:
+        batch.save()
+
+@contextmanager
+def buffered_audit():
+    """
+    Collect the CRUD events of the block and write them together at its end
+    """
+    if getattr(_local, 'buffer', None) is not None:
+        yield
+        return
+    _local.buffer = []
+    try:
+        yield
+    finally:
+        events, _local.buffer = _local.buffer, None
+        if events:
+            write_events(events)
+
+def enqueue(event):
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        write_events([event])
+        return
+    buffer.append(event)
+    if len(buffer) >= getattr(settings, 'AUDIT_FLUSH_SIZE', 500):
+        write_events(buffer[:])
+        del buffer[:]
+
+def write_events(events):
+    if getattr(settings, 'AUDIT_ASYNC', False):
+        audit_writer().queue.put(events)
+        return
+    try:
+        insert_events(events)
+    except Exception:
+        logger.exception('%d audit events could not be written', len(events))
+
+def insert_events(events):
+    """
+    Bulk insert CRUD events, dropping the users deleted since
+    """
+    user_ids = set(event.user_id for event in events if event.user_id is not None)
+    if user_ids:
+        existing = set(get_user_model().objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+        for event in events:
+            if event.user_id not in existing:
+                event.user_id = None
+    # note that CRUDEvent.datetime is auto_now_add, the insert sets it
+    CRUDEvent.objects.bulk_create(events, batch_size=getattr(settings, 'AUDIT_FLUSH_SIZE', 500))
+
+class AuditWriter(threading.Thread):
+    """
+    Background thread inserting the queued events (AUDIT_ASYNC)
+    """
+    def __init__(self):
+        super().__init__(name='audit-writer', daemon=True)
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            events = list(self.queue.get())
+            taken = 1
+            # whatever queued up meanwhile goes into the same insert
+            while len(events) < getattr(settings, 'AUDIT_FLUSH_SIZE', 500):
+                try:
+                    events.extend(self.queue.get_nowait())
+                    taken += 1
+                except queue.Empty:
+                    break
+            self.write(events)
+            for _ in range(taken):
+                self.queue.task_done()
+
+    def write(self, events):
+        """
+        Insert `events`, trying again on a fresh connection (the database
+        restarted, the connection timed out) AUDIT_WRITE_RETRIES times
+        """
+        retries = getattr(settings, 'AUDIT_WRITE_RETRIES', 3)
+        for attempt in range(retries + 1):
+            # this thread outlives any request, so it has to drop stale connections itself
+            close_old_connections()
+            try:
+                insert_events(events)
+                return True
+            except Exception:
+                connection.close()
+                if attempt == retries:
+                    logger.exception('%d audit events could not be written', len(events))
+                    return False
+                logger.warning('%d audit events not written, trying again', len(events), exc_info=True)
+                time.sleep(getattr(settings, 'AUDIT_RETRY_DELAY', 1.0) * 2 ** attempt)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def audit_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = AuditWriter()
+            _writer.start()
+            atexit.register(wait_for_audit_writer)
+        return _writer
+
+def wait_for_audit_writer():
+    """
+    Block until the events queued for the background writer are written
+    """
+    if _writer is not None:
+        _writer.queue.join()
+
+def queue_event(event_type, instance, object_json_repr, changed_fields=None):
+    user = current_user()
+    event = CRUDEvent(
+        event_type=event_type,
+        object_repr=str(instance),
+        object_json_repr=object_json_repr,
+        changed_fields=changed_fields,
+        content_type=ContentType.objects.get_for_model(instance),
+        object_id=instance.pk,
+        user_id=user.pk if user is not None else None,
+        datetime=timezone.now(),
+        user_pk_as_string=str(user.pk) if user is not None else None,
+    )
+    transaction.on_commit(partial(enqueue, event))
+
+def callbacks_allow(instance, object_json_repr, created, raw, using, update_fields, kwargs):
+    kwargs['request'] = get_current_request() # make request available for callbacks
+    return all(
+        callback(instance, object_json_repr, created, raw, using, update_fields, **kwargs)
+        for callback in CRUD_DIFFERENCE_CALLBACKS if callable(callback)
+    )
+
+# Signal receivers, replacing easyaudit's. In an audit_batch() the objects
+# aren't serialized and CRUD_DIFFERENCE_CALLBACKS are not consulted.
+
+def audit_pre_save(sender, instance, raw, using, update_fields, **kwargs):
+    if raw or instance.pk is None:
+        return
+    try:
+        if not should_audit(instance):
+            return
+        old = sender._default_manager.using(using).filter(pk=instance.pk).first()
+        if old is None:
+            return # created with an explicit pk
+        delta = model_delta(old, instance)
+        batch = current_batch()
+        if batch is not None:
+            if delta:
+                batch.add(instance, UPDATED, instance.pk, delta)
+            return
+        object_json_repr = serializers.serialize('json', [instance])
+        if callbacks_allow(instance, object_json_repr, False, raw, using, update_fields, kwargs):
+            queue_event(CRUDEvent.UPDATE, instance, object_json_repr, json.dumps(delta))
+    except Exception:
+        logger.exception('audit pre-save exception')
+
+def audit_post_save(sender, instance, created, raw, using, update_fields, **kwargs):
+    if raw or not created:
+        return
+    try:
+        if not should_audit(instance):
+            return
+        batch = current_batch()
+        if batch is not None:
+            batch.add(instance, CREATED, instance.pk, str(instance))
+            return
+        object_json_repr = serializers.serialize('json', [instance])
+        if callbacks_allow(instance, object_json_repr, True, raw, using, update_fields, kwargs):
+            queue_event(CRUDEvent.CREATE, instance, object_json_repr)
+    except Exception:
+        logger.exception('audit post-save exception')
+
+def audit_m2m_changed(sender, instance, action, reverse, model, pk_set, using, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    try:
+        if not should_audit(instance):
+            return
+        batch = current_batch()
+        if batch is not None:
+            batch.add(instance, LINKED, instance.pk, {'action': action, 'model': model._meta.label_lower, 'pks': sorted(pk_set or ())})
+            return
+        object_json_repr = serializers.serialize('json', [instance])
+        event_type = CRUDEvent.M2M_CHANGE
+        if reverse:
+            event_type = CRUDEvent.M2M_CHANGE_REV
+            # django serializers ignore extra fields
+            tmp_repr = json.loads(object_json_repr)
+            related = getattr(instance, _m2m_rev_field_name(instance._meta.concrete_model, model)).all()
+            tmp_repr[0]['m2m_rev_model'] = force_text(model._meta)
+            tmp_repr[0]['m2m_rev_pks'] = [r.pk for r in related]
+            tmp_repr[0]['m2m_rev_action'] = action
+            object_json_repr = json.dumps(tmp_repr)
+        queue_event(event_type, instance, object_json_repr)
+    except Exception:
+        logger.exception('audit m2m-changed exception')
+
+def audit_post_delete(sender, instance, using, **kwargs):
+    try:
+        if not should_audit(instance):
+            return
+        batch = current_batch()
+        if batch is not None:
+            batch.add(instance, DELETED, instance.pk, str(instance))
+            return
+        queue_event(CRUDEvent.DELETE, instance, serializers.serialize('json', [instance]))
+    except Exception:
+        logger.exception('audit post-delete exception')
+
+RECEIVERS = (
+    (signals.post_save, 'easy_audit_signals_post_save', audit_post_save),
+    (signals.pre_save, 'easy_audit_signals_pre_save', audit_pre_save),
+    (signals.m2m_changed, 'easy_audit_signals_m2m_changed', audit_m2m_changed),
+    (signals.post_delete, 'easy_audit_signals_post_delete', audit_post_delete),
+)
+
+def install():
+    """
+    Replace easyaudit's model signal receivers with the ones above. Called
+    from AuditLogConfig.ready(), after easyaudit connected its own.
+    """
+    if not WATCH_MODEL_EVENTS:
+        return
+    for signal, dispatch_uid, receiver in RECEIVERS:
+        signal.disconnect(dispatch_uid=dispatch_uid)
+        signal.connect(receiver, dispatch_uid=dispatch_uid.replace('easy_audit', 'facilities_audit'))
+
+class AuditBufferMiddleware:
+    """
+    Write the CRUD events of each request with one insert. Goes after
+    EasyAuditMiddleware, which makes the user known to the receivers.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with buffered_audit():
+            return self.get_response(request)
@@ -0,0 +1,283 @@
+from django.db import transaction
+from django.utils import timezone
+
+from collections import OrderedDict
+import json
+
+from facilities.audit import CREATED, UPDATED, audit_batch
+from facilities.boundaries import store_geometries
+from facilities.bulk import bulk_fetch, bulk_update, chunked, rebuild_tree
+from facilities.geo import location_fields
+from facilities.hierarchy import rebuild_ancestor_fields
+from facilities.models import LOCATION_FIELDS, Identifier, OrgUnit, OrgUnitChange
+from facilities.paths import path_key, rebuild_path_keys, resolve_paths
+from facilities.search import index_names, normalize_name
+from facilities.subtree import invalidate_all_subtrees
+from facilities.summary import rebuild_summary
+from facilities.tiles import invalidate_tiles
+
+class FacilityBatch:
+    """
+    Create, update and deactivate many facilities at once. Every item is
+    checked before anything is written, then the whole batch is applied in
+    one transaction with bulk queries, rebuilding the nested set (and the
+    other derived columns) once at the end rather than per facility.
+
+    Items are dicts as validated by the API: an 'action', the facility
+    address ('uuid', 'identifier' or 'path', or 'path'/'parent' and 'name' to
+    create one) and the new field values.
+    """
+    CREATE = 'create'
+    UPDATE = 'update'
+    DEACTIVATE = 'deactivate'
+    ACTIONS = (CREATE, UPDATE, DEACTIVATE)
+
+    FIELDS = ('name', 'orgunit_type', 'ownership', 'authority', 'active', 'geometry_str')
+    ROW_FIELDS = ('pk', 'uuid', 'parent_id', 'level') + FIELDS
+
+    def __init__(self, items, batch_size=500):
+        self.items = list(items)
+        self.batch_size = batch_size
+        self.errors = {} # index -> {field: [message, ...]}
+        self.targets = {} # index -> pk of the facility to update/deactivate
+        self.parents = {} # index -> pk of the parent to create under/move to
+        self.rows = {} # pk -> current values of targets and parents
+
+    def add_error(self, index, field, message):
+        self.errors.setdefault(index, {}).setdefault(field, []).append(message)
+
+    def new_values(self, item):
+        values = dict((f, item[f]) for f in ('name', 'orgunit_type', 'ownership', 'authority', 'active') if f in item)
+        if 'geometry' in item:
+            values['geometry_str'] = json.dumps(item['geometry']) if item['geometry'] else ''
+        if item['action'] == self.DEACTIVATE:
+            values['active'] = False
+        return values
+
+    def validate(self):
+        """
+        Resolve every address with a few bulk queries and check the batch as a
+        whole. Returns True if it can be applied, see self.errors otherwise.
+        """
+        uuids = set()
+        id_strs = set()
+        paths = set()
+        for item in self.items:
+            uuids.update(str(item[f]) for f in ('uuid', 'parent') if f in item)
+            if 'identifier' in item:
+                id_strs.add(item['identifier'])
+            if 'path' in item:
+                paths.add(tuple(item['path']) if item['action'] != self.CREATE else tuple(item['path'][:-1]))
+
+        pk_by_uuid = dict((str(ou_uuid), pk) for ou_uuid, pk in bulk_fetch(OrgUnit.objects, 'uuid', sorted(uuids), 'uuid', 'pk'))
+        pks_by_identifier = dict((id_str, [m['pk'] for m in matches]) for id_str, matches in Identifier.resolve(id_strs, 'pk').items())
+        pk_by_path = resolve_paths(paths)
+
+        # what every item points at
+        for i, item in enumerate(self.items):
+            if item['action'] == self.CREATE:
+                if 'path' in item:
+                    parent_pk = pk_by_path.get(path_key(item['path'][:-1]))
+                    if parent_pk is None:
+                        self.add_error(i, 'path', 'Parent {0} not found'.format('/'.join(item['path'][:-1])))
+                else:
+                    parent_pk = pk_by_uuid.get(str(item['parent']))
+                    if parent_pk is None:
+                        self.add_error(i, 'parent', 'Orgunit not found')
+                if parent_pk is not None:
+                    self.parents[i] = parent_pk
+                continue
+
+            if 'uuid' in item:
+                target_pk = pk_by_uuid.get(str(item['uuid']))
+            elif 'identifier' in item:
+                matches = pks_by_identifier.get(item['identifier'], [])
+                if len(matches) > 1:
+                    self.add_error(i, 'identifier', 'Matches {0} orgunits'.format(len(matches)))
+                    continue
+                target_pk = matches[0] if matches else None
+            else:
+                target_pk = pk_by_path.get(path_key(item['path']))
+            if target_pk is None:
+                self.add_error(i, 'uuid' if 'uuid' in item else 'identifier' if 'identifier' in item else 'path', 'Facility not found')
+                continue
+            self.targets[i] = target_pk
+            if 'parent' in item:
+                if pk_by_uuid.get(str(item['parent'])) is None:
+                    self.add_error(i, 'parent', 'Orgunit not found')
+                else:
+                    self.parents[i] = pk_by_uuid[str(item['parent'])]
+
+        pks = set(self.targets.values()) | set(self.parents.values())
+        for pk, *values in bulk_fetch(OrgUnit.objects, 'pk', sorted(pks), *self.ROW_FIELDS):
+            self.rows[pk] = dict(zip(self.ROW_FIELDS[1:], values))
+
+        seen = {}
+        for i, pk in self.targets.items():
+            if self.rows[pk]['orgunit_type'] == 'ADMIN':
+                self.add_error(i, 'non_field_errors', 'Not a facility')
+            if pk in seen:
+                self.add_error(i, 'non_field_errors', 'Same facility as item {0}'.format(seen[pk]))
+            seen.setdefault(pk, i)
+        for i, pk in self.parents.items():
+            if self.rows[pk]['orgunit_type'] != 'ADMIN':
+                self.add_error(i, 'parent', 'Facilities can only be placed under administrative units')
+
+        self.check_sibling_names()
+        return not self.errors
+
+    def item_name(self, i):
+        item = self.items[i]
+        if 'name' in item:
+            return item['name']
+        if item['action'] == self.CREATE:
+            return item['path'][-1]
+        return self.rows[self.targets[i]]['name']
+
+    def check_sibling_names(self):
+        """
+        (name, parent) is unique, names are compared case-insensitively like
+        the importer does. Takes renames and moves within the batch into
+        account.
+        """
+        placed = {} # pk, or ('new', index) for a new facility -> (parent_pk, lowercase name)
+        index_of = {}
+        for i, item in enumerate(self.items):
+            if item['action'] == self.CREATE and i in self.parents:
+                node = ('new', i)
+                placed[node] = (self.parents[i], self.item_name(i).lower())
+            elif i in self.targets and ('name' in item or 'parent' in item):
+                node = self.targets[i]
+                placed[node] = (self.parents.get(i, self.rows[node]['parent_id']), self.item_name(i).lower())
+            else:
+                continue
+            index_of[node] = i
+        if not placed:
+            return
+
+        parent_pks = sorted(set(parent_pk for parent_pk, _ in placed.values()))
+        positions = dict((pk, (parent_pk, name.lower())) for parent_pk, name, pk in bulk_fetch(OrgUnit.objects, 'parent_id', parent_pks, 'parent_id', 'name', 'pk'))
+        positions.update(placed)
+        nodes_at = {}
+        for node, position in positions.items():
+            nodes_at.setdefault(position, []).append(node)
+        for (_, name), nodes in nodes_at.items():
+            if len(nodes) > 1:
+                for node in nodes:
+                    if node in placed:
+                        self.add_error(index_of[node], 'name', 'Another orgunit under the same parent is called {0}'.format(name))
+
+    def apply(self):
+        """
+        Write the validated batch, returning one result per item: its status
+        ('created', 'updated', 'deactivated' or 'unchanged') and the facility pk
+        and uuid
+        """
+        results = [None] * len(self.items)
+        now = timezone.now()
+        with audit_batch('facility batch') as audit, transaction.atomic():
+            new_orgunits = OrderedDict()
+            tile_points = [] # old and new positions of the facilities written
+            for i, item in enumerate(self.items):
+                if item['action'] != self.CREATE:
+                    continue
+                values = self.new_values(item)
+                if 'path' in item:
+                    values.setdefault('name', item['path'][-1])
+                ou = OrgUnit(parent_id=self.parents[i], lft=0, rght=0, tree_id=0, level=self.rows[self.parents[i]]['level']+1, **values)
+                ou.set_location_fields() # bulk_create bypasses save()
+                ou.search_name = normalize_name(ou.name)
+                new_orgunits[i] = ou
+            if new_orgunits:
+                OrgUnit.objects.bulk_create(new_orgunits.values(), batch_size=self.batch_size)
+                pk_by_uuid = dict(bulk_fetch(OrgUnit.objects, 'uuid', [ou.uuid for ou in new_orgunits.values()], 'uuid', 'pk'))
+                for i, ou in new_orgunits.items():
+                    tile_points.append((ou.latitude, ou.longitude))
+                    results[i] = OrderedDict([('status', 'created'), ('pk', pk_by_uuid[ou.uuid]), ('uuid', ou.uuid)])
+                    audit.add(OrgUnit, CREATED, pk_by_uuid[ou.uuid], str(ou))
+
+            new_names = [(r['pk'], ou.search_name) for r, ou in zip((results[i] for i in new_orgunits), new_orgunits.values())]
+            new_geometries = [(r['pk'], ou.geometry_str) for r, ou in zip((results[i] for i in new_orgunits), new_orgunits.values())]
+            updates = []
+            moved = renamed = False
+            for i, pk in self.targets.items():
+                current = dict((f, self.rows[pk][f]) for f in self.FIELDS)
+                current['parent'] = self.rows[pk]['parent_id']
+                new_values = dict(current, **self.new_values(self.items[i]))
+                if i in self.parents:
+                    new_values['parent'] = self.parents[i]
+                status = 'unchanged'
+                if new_values != current:
+                    status = 'deactivated' if self.items[i]['action'] == self.DEACTIVATE else 'updated'
+                    moved = moved or new_values['parent'] != current['parent']
+                    renamed = renamed or new_values['name'] != current['name']
+                    new_values['search_name'] = normalize_name(new_values['name'])
+                    if new_values['name'] != current['name']:
+                        new_names.append((pk, new_values['search_name']))
+                    audit.add(OrgUnit, UPDATED, pk, dict((f, [v, new_values[f]]) for f, v in current.items() if new_values[f] != v))
+                    new_values['updatedAt'] = now
+                    new_values.update(location_fields(new_values['geometry_str']))
+                    old_location = location_fields(current['geometry_str'])
+                    tile_points += [(old_location['latitude'], old_location['longitude']), (new_values['latitude'], new_values['longitude'])]
+                    updates.append((pk, new_values))
+                results[i] = OrderedDict([('status', status), ('pk', pk), ('uuid', self.rows[pk]['uuid'])])
+            if updates:
+                bulk_update(OrgUnit, updates, self.FIELDS + ('parent',) + LOCATION_FIELDS + ('search_name', 'updatedAt'))
+
+            linked = self.link_identifiers(dict((i, results[i]['pk']) for i, item in enumerate(self.items) if item.get('identifiers')))
+            audit.add_links(OrgUnit, Identifier, linked)
+
+            # derived columns, once for the whole batch
+            if new_orgunits or moved:
+                rebuild_tree(OrgUnit)
+            if new_orgunits or moved or renamed:
+                rebuild_path_keys()
+                rebuild_ancestor_fields()
+            index_names(new_names)
+            store_geometries(new_geometries + [(pk, values['geometry_str']) for pk, values in updates])
+
+            OrgUnitChange.record(OrgUnitChange.CREATED, [(r['pk'], r['uuid']) for r in results if r['status'] == 'created'])
+            updated_pks = set(pk for pk, _ in updates) | set(ou_id for ou_id, _ in linked)
+            OrgUnitChange.record(OrgUnitChange.UPDATED, [(r['pk'], r['uuid']) for r in results if r['status'] != 'created' and r['pk'] in updated_pks])
+            for r in results:
+                if r['status'] == 'unchanged' and r['pk'] in updated_pks:
+                    r['status'] = 'updated' # only new identifiers
+            if new_orgunits or updated_pks:
+                rebuild_summary()
+                invalidate_all_subtrees()
+            invalidate_tiles(tile_points)
+
+        return results
+
+    def link_identifiers(self, orgunit_by_index):
+        """
+        Link the 'identifiers' of the items to their facilities, creating the
+        identifiers that don't exist yet. Returns the new (orgunit_id,
+        identifier_id) links.
+        """
+        wanted_ids = set()
+        for i in orgunit_by_index:
+            wanted_ids.update(Identifier.split_identifier_str(id_str) for id_str in self.items[i]['identifiers'])
+        if not wanted_ids:
+            return set()
+
+        def existing_ids():
+            found = {}
+            for pk, agency, context, external_id in bulk_fetch(Identifier.objects, 'external_id', sorted(set(x[2] for x in wanted_ids)), 'pk', 'agency', 'context', 'external_id'):
+                found[(agency, context, external_id)] = pk
+            return found
+        identifier_ids = existing_ids()
+        missing = wanted_ids - set(identifier_ids)
+        if missing:
+            Identifier.objects.bulk_create([Identifier(agency=a, context=c, external_id=e) for a, c, e in sorted(missing)], batch_size=self.batch_size)
+            identifier_ids = existing_ids()
+
+        Link = OrgUnit.identifiers.through
+        wanted = set()
+        for i, ou_id in orgunit_by_index.items():
+            wanted.update((ou_id, identifier_ids[Identifier.split_identifier_str(id_str)]) for id_str in self.items[i]['identifiers'])
+        linked = set(bulk_fetch(Link.objects, 'orgunit_id', sorted(set(ou_id for ou_id, _ in wanted)), 'orgunit_id', 'identifier_id'))
+        new_links = wanted - linked
+        for batch in chunked(sorted(new_links), self.batch_size):
+            Link.objects.bulk_create([Link(orgunit_id=ou_id, identifier_id=identifier_id) for ou_id, identifier_id in batch])
+        return new_links
@@ -0,0 +1,209 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from collections import OrderedDict
+import csv
+import datetime
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import django
+
+from facilities.importer import BulkOrgUnitLoader, read_records
+from facilities.models import OrgUnit
+from facilities.synthetic import SyntheticRegistry
+
+# Benchmarks of the import, the API, the exports and the dashboards against
+# a synthetic registry (see facilities.synthetic). Run them with the
+# orgunit_benchmark command, which uses a throwaway database. Results are
+# plain dicts, written as JSON so that runs of different versions can be
+# compared with compare_results().
+
+class BenchmarkRunner:
+    def __init__(self, repeat=5):
+        self.repeat = repeat
+        self.results = []
+
+    def measure(self, name, func, repeat=None, setup=None, memory=False):
+        """
+        Time `func()` over `repeat` runs (calling `setup()` untimed before
+        each), recording the median and fastest run, the queries of the last
+        run and whatever stats dict `func` returns. With `memory` it is run
+        once more under tracemalloc for its peak Python memory use.
+        """
+        timings = []
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                stats = func() or {}
+                timings.append(time.perf_counter() - started)
+
+        result = OrderedDict([
+            ('name', name),
+            ('seconds', statistics.median(timings)),
+            ('min_seconds', min(timings)),
+            ('runs', len(timings)),
+            ('queries', len(queries.captured_queries)),
+            ('query_seconds', sum(float(q['time']) for q in queries.captured_queries)),
+        ])
+        result.update(stats)
+
+        if memory:
+            if setup is not None:
+                setup()
+            tracemalloc.start()
+            try:
+                func()
+                result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        self.results.append(result)
+        return result
+
+def get(client, path, **params):
+    """
+    GET `path` and read the whole response (streamed or not), returns its
+    stats for the results
+    """
+    response = client.get(path, params)
+    if response.status_code != 200:
+        raise AssertionError('GET {0} returned {1}'.format(path, response.status_code))
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    return OrderedDict([('status', response.status_code), ('bytes', len(content))])
+
+def run_benchmarks(orgunits, seed=1, repeat=5, csv_path=None, progress=None):
+    """
+    Load a synthetic registry of about `orgunits` orgunits into the current
+    database and benchmark it. Returns the results as a dict.
+    """
+    report = progress or (lambda name: None)
+    runner = BenchmarkRunner(repeat)
+    registry = SyntheticRegistry(orgunits, seed)
+    workdir = tempfile.mkdtemp(prefix='simplemfl-benchmark-')
+    csv_path = csv_path or os.path.join(workdir, 'facilities.csv')
+
+    try:
+        report('generate_csv')
+        def generate_csv():
+            with open(csv_path, 'w', encoding='utf-8-sig', newline='') as csv_file:
+                return OrderedDict([('rows', registry.write_csv(csv_file))])
+        runner.measure('generate_csv', generate_csv, repeat=1)
+
+        def read_csv():
+            with open(csv_path, encoding='utf-8-sig') as csv_file:
+                return read_records(csv.DictReader(csv_file))[0]
+
+        def import_csv():
+            changes, _ = BulkOrgUnitLoader().load(read_csv())
+            return changes.counts()
+
+        report('import_bulk')
+        runner.measure('import_bulk', import_csv, repeat=1)
+        report('import_unchanged')
+        runner.measure('import_unchanged', import_csv)
+
+        client = Client()
+        district = OrgUnit.objects.filter(level=3).order_by('pk').first()
+        facilities = OrgUnit.objects.exclude(orgunit_type='ADMIN')
+        facility = facilities.order_by('pk').first()
+        identifiers = list(OrgUnit.identifiers.through.objects.order_by('pk').values_list('identifier__external_id', flat=True)[:100])
+        located = facilities.exclude(latitude=None).order_by('pk').first()
+
+        with override_settings(ALLOWED_HOSTS=['testserver'], EXPORT_ROOT=os.path.join(workdir, 'exports')):
+            api = [
+                ('api_orgunit_list', '/api/orgunits/', {'page_size': 100}),
+                ('api_orgunit_list_last_page', '/api/orgunits/', {'page_size': 100, 'page': (OrgUnit.objects.count() + 99) // 100}),
+                ('api_facility_list_cursor', '/api/facilities/', {'page_size': 100, 'paginate': 'cursor'}),
+                ('api_orgunit_detail', '/api/orgunits/{0}/'.format(facility.pk), {}),
+                ('api_district_subtree', '/api/orgunits/{0}/subtree/'.format(district.pk), {}),
+                ('api_identifier_resolve_100', '/api/identifiers/resolve/', {'id': identifiers}),
+                ('api_nearby', '/api/facilities/nearby/', {'lat': located.latitude, 'lon': located.longitude}),
+                ('api_search', '/api/facilities/search/', {'q': facility.name[:-2]}),
+                ('api_search_district', '/api/facilities/search/', {'q': facility.name[:-2], 'within': district.uuid}),
+                ('api_changes', '/api/changes/', {'limit': 500}),
+            ]
+            for name, path, params in api:
+                report(name)
+                runner.measure(name, lambda: get(client, path, **params), setup=cache.clear)
+
+            report('api_not_modified')
+            etag = client.get('/api/orgunits/')['ETag']
+            def not_modified():
+                response = client.get('/api/orgunits/', HTTP_IF_NONE_MATCH=etag)
+                return OrderedDict([('status', response.status_code)])
+            runner.measure('api_not_modified', not_modified)
+
+            report('csv_export')
+            def remove_exports():
+                shutil.rmtree(settings.EXPORT_ROOT, ignore_errors=True)
+            runner.measure('csv_export', lambda: get(client, '/download/facilities.csv'), setup=remove_exports, memory=True)
+            runner.measure('csv_export_prebuilt', lambda: get(client, '/download/facilities.csv'), memory=True)
+
+            report('geojson')
+            runner.measure('geojson_facilities', lambda: get(client, '/geojson/facilities.json'), memory=True)
+            runner.measure('geojson_district', lambda: get(client, '/geojson/facilities.json', district_id=district.pk))
+
+            report('dashboards')
+            runner.measure('dashboard_index', lambda: get(client, '/'), setup=cache.clear)
+            runner.measure('dashboard_index_cached', lambda: get(client, '/'))
+            runner.measure('dashboard_regions_by_type', lambda: get(client, '/regions_by_type/'), setup=cache.clear)
+            runner.measure('listing_district', lambda: get(client, '/listing/{0}'.format(district.uuid)), setup=cache.clear)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return OrderedDict([
+        ('meta', benchmark_meta(orgunits, seed, repeat)),
+        ('results', runner.results),
+    ])
+
+def benchmark_meta(orgunits, seed, repeat):
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return OrderedDict([
+        ('revision', revision),
+        ('date', datetime.datetime.utcnow().isoformat() + 'Z'),
+        ('orgunits_requested', orgunits),
+        ('orgunits', OrgUnit.objects.count()),
+        ('facilities', OrgUnit.objects.exclude(orgunit_type='ADMIN').count()),
+        ('seed', seed),
+        ('repeat', repeat),
+        ('database', connection.vendor),
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+    ])
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compare two benchmark reports, returning one line per benchmark in both
+    with the relative change of its median time and query count. Changes
+    over `threshold` are flagged.
+    """
+    before = dict((r['name'], r) for r in baseline['results'])
+    lines = []
+    for key in ('orgunits', 'database'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            lines.append('warning: {0} differ ({1} vs {2})'.format(key, baseline['meta'].get(key), current['meta'].get(key)))
+    for result in current['results']:
+        old = before.get(result['name'])
+        if old is None:
+            continue
+        change = (result['seconds'] - old['seconds']) / old['seconds'] if old['seconds'] else 0
+        flag = 'SLOWER' if change > threshold else 'faster' if change < -threshold else ''
+        if result['queries'] != old['queries']:
+            flag = (flag + ' queries {0} -> {1}'.format(old['queries'], result['queries'])).strip()
+        lines.append('{0:32} {1:10.4f}s {2:+7.1%} {3}'.format(result['name'], result['seconds'], change, flag).rstrip())
+    return lines
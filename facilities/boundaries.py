@@ -0,0 +1,129 @@
+from django.db.models import Case, F, OuterRef, Subquery, TextField, Value, When
+from django.db.models.functions import Coalesce
+
+from collections import OrderedDict
+import hashlib
+import json
+
+from facilities.bulk import bulk_delete, bulk_fetch
+from facilities.geo import parse_geometry, simplify_geometry
+from facilities.models import OrgUnit, OrgUnitGeometry
+
+# Boundaries at several levels of detail. A district polygon is megabytes of
+# GeoJSON, far more than a map of the whole country can show. Whenever an
+# orgunit's geometry_str is saved, simplified copies of anything but a point
+# are stored in OrgUnitGeometry, one per resolution below, along with the
+# bounding box (OrgUnit.bbox_*). Listings ask for a ?resolution= or a map
+# ?zoom= and get the stored string, which is neither read in full nor parsed.
+#
+# Single saves are handled by a signal, bulk writers call store_geometries()
+# for the rows they write.
+
+FULL = 'full'
+
+# name: (resolution, tolerance in degrees, decimals kept, highest map zoom it's meant for)
+RESOLUTIONS = OrderedDict([
+    ('low', (OrgUnitGeometry.LOW, 0.01, 3, 7)), # ~1km, a country on a screen
+    ('medium', (OrgUnitGeometry.MEDIUM, 0.001, 4, 10)), # ~100m, a region
+    ('high', (OrgUnitGeometry.HIGH, 0.0001, 5, 13)), # ~10m, a district
+])
+
+def resolution_for_zoom(zoom):
+    for name, (_, _, _, max_zoom) in RESOLUTIONS.items():
+        if zoom <= max_zoom:
+            return name
+    return FULL
+
+def requested_resolution(params, default=FULL):
+    """
+    Resolution asked for with ?resolution= (low, medium, high or full) or a
+    map ?zoom=. Raises ValueError for anything else.
+    """
+    if params.get('resolution'):
+        if params['resolution'] not in RESOLUTIONS and params['resolution'] != FULL:
+            raise ValueError('resolution must be one of %s' % ', '.join(list(RESOLUTIONS) + [FULL]))
+        return params['resolution']
+    if params.get('zoom'):
+        return resolution_for_zoom(int(params['zoom']))
+    return default
+
+def source_hash(geometry_str):
+    return hashlib.sha1(geometry_str.encode('utf-8')).hexdigest()
+
+def geometry_levels(geometry_str):
+    """
+    (resolution, simplified geometry string) of a geometry, nothing for
+    points and anything that isn't GeoJSON
+    """
+    geometry = parse_geometry(geometry_str)
+    if geometry is None or geometry.get('type') in (None, 'Point'):
+        return []
+    levels = []
+    for resolution, tolerance, decimals, _ in RESOLUTIONS.values():
+        simplified = simplify_geometry(geometry, tolerance, decimals)
+        if simplified is not None:
+            levels.append((resolution, json.dumps(simplified, separators=(',', ':'))))
+    return levels
+
+def store_geometries(items, geometry_model=OrgUnitGeometry):
+    """
+    Bring the stored levels of detail of orgunits, given as (pk,
+    geometry_str) pairs, up to date. Returns the number of orgunits whose
+    levels were rewritten.
+    """
+    items = dict(items)
+    stored = dict(bulk_fetch(geometry_model.objects, 'orgunit_id', sorted(items), 'orgunit_id', 'source_hash'))
+    changed = {}
+    for pk, geometry_str in items.items():
+        geometry_hash = source_hash(geometry_str or '')
+        if stored.get(pk) != geometry_hash:
+            levels = geometry_levels(geometry_str)
+            if levels or pk in stored:
+                changed[pk] = (geometry_hash, levels)
+    if changed:
+        bulk_delete(geometry_model.objects, 'orgunit_id', sorted(changed))
+        geometry_model.objects.bulk_create(
+            (geometry_model(orgunit_id=pk, resolution=resolution, geometry_str=level_str, source_hash=geometry_hash)
+                for pk, (geometry_hash, levels) in changed.items() for resolution, level_str in levels),
+            batch_size=100
+        )
+    return len(changed)
+
+def forget_geometries(pks):
+    bulk_delete(OrgUnitGeometry.objects, 'orgunit_id', list(pks))
+
+def rebuild_geometries(orgunit_model=OrgUnit, geometry_model=OrgUnitGeometry):
+    """
+    Check the stored levels of every orgunit with a geometry other than a
+    point, a few at a time (the geometries may be large)
+    """
+    pks = list(orgunit_model._base_manager.filter(latitude__isnull=True).exclude(geometry_str='').values_list('pk', flat=True))
+    rewritten = 0
+    for i in range(0, len(pks), 20):
+        rewritten += store_geometries(orgunit_model._base_manager.filter(pk__in=pks[i:i+20]).values_list('pk', 'geometry_str'), geometry_model)
+    stale = set(geometry_model.objects.values_list('orgunit_id', flat=True).distinct()) - set(pks)
+    bulk_delete(geometry_model.objects, 'orgunit_id', sorted(stale))
+    return rewritten + len(stale)
+
+def geometry_at(resolution):
+    """
+    Expression for the geometry string of an orgunit at `resolution`, for
+    values() and annotate(). Points are always in full, other geometries
+    come from OrgUnitGeometry without touching geometry_str.
+    """
+    if resolution == FULL:
+        return F('geometry_str')
+    level = OrgUnitGeometry.objects.filter(orgunit_id=OuterRef('pk'), resolution=RESOLUTIONS[resolution][0]).values('geometry_str')[:1]
+    return Case(
+        When(latitude__isnull=False, then=F('geometry_str')),
+        default=Coalesce(Subquery(level, output_field=TextField()), Value('')),
+        output_field=TextField(),
+    )
+
+def geometry_bbox_list(row):
+    """
+    [west, south, east, north] of a values() row with the bbox columns, None
+    without a geometry
+    """
+    bbox = [row['bbox_west'], row['bbox_south'], row['bbox_east'], row['bbox_north']]
+    return None if None in bbox else bbox
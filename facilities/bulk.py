@@ -0,0 +1,152 @@
+from django.db.models import Case, Q, When, Value
+
+from collections import defaultdict
+from itertools import islice
+
+# SQLite refuses statements with more than 999 parameters, stay well below that
+MAX_QUERY_PARAMS = 900
+
+def chunked(iterable, size):
+    """
+    Yield successive lists of at most `size` items from `iterable`
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def bulk_update(model, updates, fields, batch_size=None):
+    """
+    Update many rows of `model` using one UPDATE ... SET x = CASE ... per batch.
+    `updates` is an iterable of (pk, {field: value}) pairs, every dict must
+    contain all of `fields`. Bypasses save() and therefore signals, auto_now
+    fields and MPTT bookkeeping - the caller is responsible for those.
+
+    Django gained QuerySet.bulk_update() in 2.2, this does the same job on 1.11.
+    """
+    db_fields = [model._meta.get_field(f) for f in fields]
+    if batch_size is None:
+        batch_size = max(1, MAX_QUERY_PARAMS // (2*len(db_fields) + 1))
+
+    row_count = 0
+    for batch in chunked(updates, batch_size):
+        case_statements = {}
+        for f in db_fields:
+            output_field = f.target_field if f.is_relation else f
+            whens = [When(pk=pk, then=Value(values[f.name], output_field=output_field)) for pk, values in batch]
+            case_statements[f.attname] = Case(*whens, output_field=output_field)
+        row_count += model._base_manager.filter(pk__in=[pk for pk, _ in batch]).update(**case_statements)
+    return row_count
+
+def bulk_delete(queryset, lookup, values):
+    """
+    Delete the rows of `queryset` whose <lookup> is in `values`, in chunks,
+    without loading them or sending signals (which QuerySet.delete() does as
+    soon as any delete receiver is connected, easyaudit's included). Only for
+    derived tables that nothing refers to. Returns the number of rows deleted.
+    """
+    row_count = 0
+    for chunk in chunked(values, MAX_QUERY_PARAMS):
+        chunk_qs = queryset.filter(**{lookup+'__in': chunk})
+        row_count += chunk_qs._raw_delete(chunk_qs.db)
+    return row_count
+
+def bulk_fetch(queryset, lookup, values, *fields):
+    """
+    Run `queryset.filter(<lookup>__in=values).values_list(*fields)` in chunks
+    small enough for the database parameter limit, yielding all result rows
+    """
+    for chunk in chunked(values, MAX_QUERY_PARAMS):
+        yield from queryset.filter(**{lookup+'__in': chunk}).values_list(*fields)
+
+def compute_nested_set(nodes):
+    """
+    Given `nodes` as an iterable of (pk, parent_pk, sort_key) compute the MPTT
+    (lft, rght, tree_id, level) values for every node, in the same order that
+    TreeManager.rebuild() would assign them. Returns a dict pk -> tuple.
+    """
+    children = defaultdict(list)
+    for pk, parent_pk, sort_key in nodes:
+        children[parent_pk].append((sort_key, pk))
+    for child_list in children.values():
+        child_list.sort()
+
+    tree_values = {}
+    for tree_id, (_, root_pk) in enumerate(children[None], 1):
+        counter = 1
+        left = {root_pk: counter}
+        stack = [(root_pk, 0, iter(children[root_pk]))]
+        while stack:
+            pk, level, child_iter = stack[-1]
+            next_child = next(child_iter, None)
+            if next_child is None:
+                stack.pop()
+                counter += 1
+                tree_values[pk] = (left[pk], counter, tree_id, level)
+            else:
+                child_pk = next_child[1]
+                counter += 1
+                left[child_pk] = counter
+                stack.append((child_pk, level+1, iter(children[child_pk])))
+    return tree_values
+
+def rebuild_tree(model):
+    """
+    Recompute the nested set (lft/rght/tree_id/level) of an MPTT `model` from
+    the parent links with a single SELECT and write back only the rows that
+    changed. Unlike TreeManager.rebuild() this does not issue a query per node,
+    which makes it usable after bulk inserts and bulk moves. Returns the number
+    of rows updated.
+    """
+    opts = model._mptt_meta
+    tree_fields = (opts.left_attr, opts.right_attr, opts.tree_id_attr, opts.level_attr)
+    order_fields = [f.lstrip('-') for f in opts.order_insertion_by] or ['pk']
+
+    current = {}
+    nodes = []
+    for pk, parent_pk, *rest in model._base_manager.values_list('pk', opts.parent_attr, *(order_fields + list(tree_fields))).iterator():
+        sort_key, tree_values = tuple(rest[:len(order_fields)]), tuple(rest[len(order_fields):])
+        nodes.append((pk, parent_pk, sort_key))
+        current[pk] = tree_values
+
+    computed = compute_nested_set(nodes)
+    changed = [(pk, dict(zip(tree_fields, values))) for pk, values in computed.items() if current[pk] != values]
+    if changed:
+        bulk_update(model, changed, tree_fields)
+    return len(changed)
+
+def keyset_chunks(queryset, key_fields, chunk_size=1000):
+    """
+    Iterate over `queryset` in lists of at most `chunk_size` objects, ordered
+    by `key_fields` (which together must be unique). Every chunk is fetched with
+    a "key > last key" filter instead of OFFSET, so each query costs the same
+    and prefetch_related() still works (unlike with QuerySet.iterator()).
+    Works on values() querysets as long as they include the key fields.
+    """
+    queryset = queryset.order_by(*key_fields)
+    last_key = None
+    while True:
+        chunk_qs = queryset
+        if last_key is not None:
+            chunk_qs = chunk_qs.filter(keyset_after(key_fields, last_key))
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_row = chunk[-1]
+        last_key = tuple(last_row[f] if isinstance(last_row, dict) else getattr(last_row, f) for f in key_fields)
+
+def keyset_after(key_fields, key_values):
+    """
+    Q object matching rows that sort after `key_values` when ordered by
+    `key_fields`, i.e. (a > x) OR (a = x AND b > y) OR ...
+    """
+    condition = None
+    for i, field in enumerate(key_fields):
+        term = Q(**{field+'__gt': key_values[i]})
+        for prev_field, prev_value in zip(key_fields[:i], key_values[:i]):
+            term &= Q(**{prev_field: prev_value})
+        condition = term if condition is None else condition | term
+    return condition
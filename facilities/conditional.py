@@ -0,0 +1,52 @@
+from django.views.decorators.http import condition
+
+import hashlib
+
+from facilities.models import OrgUnitChange
+from facilities.snapshot import get_snapshot
+
+# Conditional GET (ETag/Last-Modified, 304 Not Modified) for everything that
+# is read from the registry. All orgunit and identifier link writes go through
+# the change log (OrgUnitChange), so the latest change is a version of the
+# whole registry: one query on the log decides whether a client's copy is
+# still current, before the view touches the orgunit tables at all. With the
+# registry snapshot enabled its version is used instead, without a query.
+
+def registry_state(request):
+    """
+    (data version, last modified) of the registry, read once per request
+    """
+    if not hasattr(request, '_registry_state'):
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            request._registry_state = (snapshot.version, snapshot.last_modified)
+        else:
+            request._registry_state = OrgUnitChange.latest_change()
+    return request._registry_state
+
+def registry_etag(request, *args, **kwargs):
+    return 'v{0}'.format(registry_state(request)[0])
+
+def registry_last_modified(request, *args, **kwargs):
+    return registry_state(request)[1]
+
+def negotiated_etag(request, *args, **kwargs):
+    # the API renders the same URL as JSON or as the browsable HTML page
+    variant = '{0}|{1}'.format(request.META.get('HTTP_ACCEPT', ''), request.GET.get('format', ''))
+    return '{0}-{1}'.format(registry_etag(request), hashlib.sha1(variant.encode('utf-8')).hexdigest()[:8])
+
+registry_condition = condition(etag_func=registry_etag, last_modified_func=registry_last_modified)
+
+class RegistryConditionalMixin:
+    """
+    ViewSet mixin answering conditional GET/HEAD requests of the
+    `conditional_actions` (every action by default) from the registry version
+    """
+    conditional_actions = None
+
+    def dispatch(self, request, *args, **kwargs):
+        dispatch = super().dispatch
+        action = getattr(self, 'action_map', {}).get('get' if request.method == 'HEAD' else request.method.lower())
+        if request.method in ('GET', 'HEAD') and (self.conditional_actions is None or action in self.conditional_actions):
+            dispatch = condition(etag_func=negotiated_etag, last_modified_func=registry_last_modified)(dispatch)
+        return dispatch(request, *args, **kwargs)
@@ -0,0 +1,265 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from collections import OrderedDict
+import re
+
+from facilities.bulk import bulk_delete, bulk_fetch, bulk_update, chunked
+from facilities.geo import geohash_cell_neighbourhood, haversine_km
+from facilities.models import DuplicateCandidate, DuplicateScan, OrgUnit, OrgUnitChange
+from facilities.search import COMMON_WORDS, name_grams
+
+# Duplicate facility detection without comparing every facility with every
+# other. Facilities are only compared within blocks:
+#
+# - the same parent (subcounty)
+# - the same district and a shared name word (facility levels and other
+#   common words don't count)
+# - the same or a neighbouring geohash cell of CELL_PRECISION
+#
+# and every pair sharing a block is scored on the similarity of the
+# distinctive part of the names (trigrams of search_name without the common
+# words) and the distance between the coordinates. Pairs scoring at least
+# settings.DUPLICATE_MIN_SCORE are kept as DuplicateCandidates for review.
+#
+# A run reads the facilities with one query. Incremental runs (the default
+# once there has been a run) only compare the facilities changed since the
+# previous one, found in the change log.
+
+CELL_PRECISION = 6 # ~1.2 x 0.6 km, the 3x3 neighbourhood covers MAX_DISTANCE_KM
+MAX_DISTANCE_KM = 0.5 # pairs further apart than this get no proximity score
+MAX_BLOCK_SIZE = 500 # larger blocks (e.g. a very common word) are not compared
+NAME_WEIGHT = 0.7
+
+NUMBER_RE = re.compile(r'\d+')
+
+class DuplicateFacility:
+    __slots__ = ('pk', 'name', 'orgunit_type', 'parent_id', 'district_id', 'latitude', 'longitude', 'cell', 'words', 'grams', 'numbers')
+
+    def __init__(self, pk, name, search_name, orgunit_type, parent_id, district_id, latitude, longitude, geocell):
+        self.pk = pk
+        self.name = name
+        self.orgunit_type = orgunit_type
+        self.parent_id = parent_id
+        self.district_id = district_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.cell = geocell[:CELL_PRECISION] if geocell else ''
+        words = search_name.split()
+        self.words = tuple(w for w in words if w not in COMMON_WORDS and not w.isdigit())
+        self.grams = name_grams(' '.join(self.words) or search_name)
+        self.numbers = tuple(NUMBER_RE.findall(search_name))
+
+def district_field():
+    for level, name in settings.ORG_UNIT_LEVELS.items():
+        if name == 'District':
+            return OrgUnit.ancestor_fields()[level][0]
+    return 'parent_id'
+
+def load_facilities():
+    fields = ('pk', 'name', 'search_name', 'orgunit_type', 'parent_id', district_field(), 'latitude', 'longitude', 'geocell')
+    return dict((row[0], DuplicateFacility(*row)) for row in OrgUnit.objects.exclude(orgunit_type='ADMIN').values_list(*fields).iterator())
+
+def compare(a, b, min_score=0.0):
+    """
+    (score, name similarity, distance in km or None, reasons) of a pair, None
+    when the names are too different for it to score `min_score` however
+    close the facilities are
+    """
+    shared = len(a.grams & b.grams)
+    name_similarity = shared / len(a.grams | b.grams) if shared else 0.0
+    if a.numbers != b.numbers:
+        name_similarity /= 2 # 'Kampala Clinic 1' and 'Kampala Clinic 2'
+    if NAME_WEIGHT * name_similarity + (1 - NAME_WEIGHT) < min_score:
+        return None
+    reasons = []
+    if a.numbers != b.numbers:
+        reasons.append('numbers differ')
+    if a.parent_id == b.parent_id:
+        reasons.append('same parent')
+    if a.orgunit_type != b.orgunit_type:
+        reasons.append('types differ')
+
+    distance_km = None
+    proximity = 0.5 # unknown
+    if a.latitude is not None and b.latitude is not None:
+        distance_km = haversine_km(a.latitude, a.longitude, b.latitude, b.longitude)
+        proximity = max(0.0, 1 - distance_km / MAX_DISTANCE_KM)
+        if proximity:
+            reasons.append('%dm apart' % round(distance_km * 1000))
+    else:
+        reasons.append('no coordinates')
+    score = NAME_WEIGHT * name_similarity + (1 - NAME_WEIGHT) * proximity
+    return score, name_similarity, distance_km, reasons
+
+class DuplicateDetector:
+    def __init__(self, min_score=None):
+        self.min_score = min_score if min_score is not None else getattr(settings, 'DUPLICATE_MIN_SCORE', 0.7)
+        self.facilities = {}
+        self.blocks = {} # block key -> [pk, ...]
+        self.neighbours = {} # cell -> neighbouring cells (itself included)
+        self.pairs_compared = 0
+        self.skipped_blocks = set()
+
+    def build_blocks(self):
+        for f in self.facilities.values():
+            for key in self.block_keys(f):
+                self.blocks.setdefault(key, []).append(f.pk)
+
+    def block_keys(self, f):
+        keys = [('parent', f.parent_id)]
+        keys.extend(('word', f.district_id, word) for word in set(f.words))
+        if f.cell:
+            keys.append(('cell', f.cell))
+        return keys
+
+    def lookup_keys(self, f):
+        # blocks to look for matches in: the facility's own, the cell ones widened to the neighbouring cells
+        keys = [key for key in self.block_keys(f) if key[0] != 'cell']
+        if f.cell:
+            if f.cell not in self.neighbours:
+                self.neighbours[f.cell] = geohash_cell_neighbourhood(f.cell)
+            keys.extend(('cell', cell) for cell in self.neighbours[f.cell])
+        return keys
+
+    def candidate_pairs(self, focus):
+        """
+        (pk, pk) pairs, lowest first, sharing a block and with at least one
+        facility in `focus`
+        """
+        pairs = set()
+        for pk in focus:
+            for key in self.lookup_keys(self.facilities[pk]):
+                members = self.blocks.get(key, ())
+                if len(members) > MAX_BLOCK_SIZE:
+                    self.skipped_blocks.add(key)
+                    continue
+                for other in members:
+                    if other != pk and (other > pk or other not in focus):
+                        pairs.add((min(pk, other), max(pk, other)))
+        return pairs
+
+    def find(self, focus):
+        """
+        Candidates among the pairs involving `focus`, as a dict (pk, pk) ->
+        (score, name similarity, distance, reasons)
+        """
+        found = {}
+        for a, b in self.candidate_pairs(focus):
+            self.pairs_compared += 1
+            result = compare(self.facilities[a], self.facilities[b], self.min_score)
+            if result is not None and result[0] >= self.min_score:
+                found[(a, b)] = result
+        return found
+
+    def run(self, full=False):
+        """
+        Detect duplicates among the facilities changed since the last run
+        (all of them with `full` or on the first run) and update the stored
+        candidates. Returns the DuplicateScan.
+        """
+        scan = DuplicateScan(started_at=timezone.now())
+        with transaction.atomic():
+            scan.change_id = OrgUnitChange.latest_change()[0] # changes made while we read are picked up next time
+            last_scan = DuplicateScan.objects.order_by('-id').first()
+            scan.full = full or last_scan is None
+            self.facilities = load_facilities()
+            self.build_blocks()
+
+            if scan.full:
+                focus = set(self.facilities)
+                gone = set()
+                existing = DuplicateCandidate.objects.all()
+            else:
+                changed = set(OrgUnitChange.objects.filter(seq__gt=last_scan.change_id, seq__lte=scan.change_id).values_list('orgunit_id', flat=True))
+                focus = changed & set(self.facilities)
+                gone = changed - set(self.facilities) # deleted, or not a facility any more
+                existing = DuplicateCandidate.objects.filter(pk__in=set(
+                    pk for lookup in ('orgunit_a_id', 'orgunit_b_id') for pk, in bulk_fetch(DuplicateCandidate.objects, lookup, sorted(changed), 'pk')
+                ))
+            found = self.find(focus)
+
+            stored = dict(((a, b), (pk, status)) for pk, a, b, status in existing.values_list('pk', 'orgunit_a_id', 'orgunit_b_id', 'status').iterator())
+            new, updates, stale = [], [], []
+            for pair, (score, name_similarity, distance_km, reasons) in found.items():
+                values = {'score': score, 'name_similarity': name_similarity, 'distance_km': distance_km, 'reasons': ', '.join(reasons)[:200]}
+                if pair in stored:
+                    updates.append((stored[pair][0], values))
+                else:
+                    new.append(DuplicateCandidate(orgunit_a_id=pair[0], orgunit_b_id=pair[1], detected_at=scan.started_at, **values))
+            for pair, (pk, status) in stored.items():
+                if pair not in found and (status == DuplicateCandidate.OPEN or gone.intersection(pair)):
+                    stale.append(pk)
+
+            DuplicateCandidate.objects.bulk_create(new, batch_size=500)
+            bulk_update(DuplicateCandidate, updates, ('score', 'name_similarity', 'distance_km', 'reasons'))
+            bulk_delete(DuplicateCandidate.objects, 'pk', stale)
+
+            scan.orgunits_checked = len(focus)
+            scan.pairs_compared = self.pairs_compared
+            scan.candidates = len(found)
+            scan.finished_at = timezone.now()
+            scan.save()
+        self.stats = OrderedDict([
+            ('orgunits_checked', scan.orgunits_checked),
+            ('pairs_compared', scan.pairs_compared),
+            ('candidates_found', len(found)),
+            ('candidates_new', len(new)),
+            ('candidates_removed', len(stale)),
+            ('blocks_skipped', len(self.skipped_blocks)),
+        ])
+        return scan
+
+def find_duplicates(full=False, min_score=None):
+    detector = DuplicateDetector(min_score)
+    detector.run(full)
+    return detector.stats
+
+def orgunit_rows(pks):
+    """
+    pk -> values dict (uuid, name, type, coordinates, ancestor names) of the
+    orgunits of a page of candidates
+    """
+    name_fields = tuple(name_field for _, name_field in OrgUnit.ancestor_fields().values())
+    fields = ('pk', 'uuid', 'name', 'orgunit_type', 'latitude', 'longitude') + name_fields
+    rows = {}
+    for values in bulk_fetch(OrgUnit.objects, 'pk', sorted(set(pks)), *fields):
+        row = dict(zip(fields, values))
+        row['path'] = [row[f] for f in name_fields if row[f]]
+        rows[row['pk']] = row
+    return rows
+
+def duplicate_report(limit=None, offset=0, status=DuplicateCandidate.OPEN, min_score=None):
+    """
+    Candidates with `status`, best first, as flat dicts for listings and CSV
+    files
+    """
+    candidates = DuplicateCandidate.objects.filter(status=status).order_by('-score', 'pk')
+    if min_score is not None:
+        candidates = candidates.filter(score__gte=min_score)
+    if limit is not None:
+        candidates = candidates[offset:offset + limit]
+    elif offset:
+        candidates = candidates[offset:]
+    fields = ('pk', 'orgunit_a_id', 'orgunit_b_id', 'score', 'name_similarity', 'distance_km', 'reasons')
+    for chunk in chunked(candidates.values_list(*fields).iterator(), 1000):
+        orgunits = orgunit_rows([pk for row in chunk for pk in row[1:3]])
+        for pk, a_id, b_id, score, name_similarity, distance_km, reasons in chunk:
+            a, b = orgunits.get(a_id), orgunits.get(b_id)
+            if a is None or b is None:
+                continue # deleted since the last run
+            yield OrderedDict([
+                ('id', pk),
+                ('score', round(score, 3)),
+                ('name_similarity', round(name_similarity, 3)),
+                ('distance_km', None if distance_km is None else round(distance_km, 3)),
+                ('reasons', reasons),
+                ('status', status),
+                ('uuid_a', str(a['uuid'])),
+                ('name_a', a['name']),
+                ('path_a', '/'.join(a['path'])),
+                ('uuid_b', str(b['uuid'])),
+                ('name_b', b['name']),
+                ('path_b', '/'.join(b['path'])),
+            ])
@@ -0,0 +1,89 @@
+from django.conf import settings
+
+import csv
+import glob
+import os
+import tempfile
+
+from facilities.bulk import keyset_chunks
+from facilities.models import OrgUnit
+
+CSV_FIELDS = (
+    'uuid', 'name', 'active', 'createdAt', 'updatedAt', 'geometry_str', 'orgunit_type', 'ownership', 'authority', 'identifiers'
+)
+
+# bump when the columns change, so snapshots written in the old layout aren't served
+CSV_LAYOUT = 2
+
+def hierarchy_columns():
+    """
+    (header, field) of the ancestor name columns that follow CSV_FIELDS, e.g.
+    ('DISTRICT', 'district_name')
+    """
+    return [(settings.ORG_UNIT_LEVELS[level].upper(), name_field) for level, (_, name_field) in OrgUnit.ancestor_fields().items()]
+
+class Echo:
+    """
+    File-like object whose write() hands back the value, lets csv.writer
+    produce lines for a streaming response
+    """
+    def write(self, value):
+        return value
+
+def facility_to_list(facility_obj, field_list, default=None):
+    out_list = [getattr(facility_obj, field) for field in field_list]
+    out_list = list(map(lambda x: str(x) if x is not None else default, out_list)) # replace empty/null/None with supplied default
+    return out_list
+
+def facility_csv_lines(facilities, chunk_size=1000):
+    """
+    Generate the facilities CSV, one string per chunk of rows, the names of the
+    enclosing admin units in the last columns. The queryset is read in
+    (tree_id, lft) keyset chunks so memory use doesn't grow with the size of
+    the registry.
+    """
+    hierarchy_headers, hierarchy_fields = zip(*hierarchy_columns())
+    writer = csv.writer(Echo(), quoting=csv.QUOTE_NONNUMERIC)
+    yield writer.writerow([h.upper() for h in CSV_FIELDS] + list(hierarchy_headers)) # CSV header row
+    for chunk in keyset_chunks(facilities.prefetch_related('identifiers'), ('tree_id', 'lft'), chunk_size):
+        yield ''.join(
+            writer.writerow(facility_to_list(f, CSV_FIELDS[:-1], default='')+[str(f.identifiers_flat)]+facility_to_list(f, hierarchy_fields, default=''))
+            for f in chunk
+        )
+
+def snapshot_path(version):
+    """
+    Location of the pre-built export for a given data version, or None when
+    snapshots are disabled (settings.EXPORT_ROOT is unset)
+    """
+    export_root = getattr(settings, 'EXPORT_ROOT', None)
+    if not export_root:
+        return None
+    return os.path.join(export_root, 'facilities_{0}_v{1}.csv'.format(version, CSV_LAYOUT))
+
+def write_snapshot(path, lines):
+    """
+    Pass `lines` through while also writing them to a temporary file that is
+    moved to `path` once the last line has been written. An interrupted
+    download leaves no partial snapshot behind. Older snapshots are removed.
+    Falls back to plain streaming if the export directory isn't writable.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    except OSError:
+        yield from lines
+        return
+
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as snapshot_file:
+            for line in lines:
+                snapshot_file.write(line)
+                yield line
+        os.replace(tmp_path, path)
+        for stale_path in glob.glob(os.path.join(os.path.dirname(path), 'facilities_*.csv')):
+            if stale_path != path:
+                os.remove(stale_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
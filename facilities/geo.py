@@ -0,0 +1,295 @@
+import json
+import math
+
+# Geohash cells let us find nearby points with plain B-tree range queries,
+# so proximity search works on SQLite and PostgreSQL without PostGIS
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 7 # ~150m x 150m, shorter prefixes give coarser cells
+EARTH_RADIUS_KM = 6371.0088
+
+# for stepping from a cell to the adjacent one without decoding it, per
+# direction: (even length, odd length) lookup strings
+GEOHASH_NEIGHBOURS = {
+    'n': ('p0r21436x8zb9dcf5h7kjnmqesgutwvy', 'bc01fg45238967deuvhjyznpkmstqrwx'),
+    's': ('14365h7k9dcfesgujnmqp0r2twvyx8zb', '238967debc01fg45kmstqrwxuvhjyznp'),
+    'e': ('bc01fg45238967deuvhjyznpkmstqrwx', 'p0r21436x8zb9dcf5h7kjnmqesgutwvy'),
+    'w': ('238967debc01fg45kmstqrwxuvhjyznp', '14365h7k9dcfesgujnmqp0r2twvyx8zb'),
+}
+GEOHASH_BORDERS = {
+    'n': ('prxz', 'bcfguvyz'),
+    's': ('028b', '0145hjnp'),
+    'e': ('bcfguvyz', 'prxz'),
+    'w': ('0145hjnp', '028b'),
+}
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits, bit_count, even = 0, 0, True
+    while len(chars) < precision:
+        value, value_range = (lon, lon_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits = bits << 1
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+def geohash_cell_size(precision):
+    """
+    (height, width) of a geohash cell in degrees
+    """
+    lon_bits = (5*precision + 1) // 2
+    lat_bits = (5*precision) // 2
+    return 180.0 / 2**lat_bits, 360.0 / 2**lon_bits
+
+def geohash_neighbourhood(lat, lon, precision):
+    """
+    The cell containing (lat, lon) and its 8 neighbours at `precision`
+    """
+    height, width = geohash_cell_size(precision)
+    cells = set()
+    for dlat in (-height, 0, height):
+        for dlon in (-width, 0, width):
+            cell_lat = max(-90.0, min(90.0, lat + dlat))
+            cell_lon = (lon + dlon + 180.0) % 360.0 - 180.0
+            cells.add(geohash_encode(cell_lat, cell_lon, precision))
+    return sorted(cells)
+
+def geohash_adjacent(cell, direction):
+    """
+    The cell next to `cell` to the 'n', 's', 'e' or 'w'
+    """
+    last, parent = cell[-1], cell[:-1]
+    kind = len(cell) % 2
+    if parent and last in GEOHASH_BORDERS[direction][kind]:
+        parent = geohash_adjacent(parent, direction)
+    return parent + GEOHASH_ALPHABET[GEOHASH_NEIGHBOURS[direction][kind].index(last)]
+
+def geohash_cell_neighbourhood(cell):
+    """
+    `cell` and its 8 neighbours, like geohash_neighbourhood() but from the
+    cell itself (and much faster than encoding 9 points)
+    """
+    north, south = geohash_adjacent(cell, 'n'), geohash_adjacent(cell, 's')
+    return sorted(set([
+        cell, north, south, geohash_adjacent(cell, 'e'), geohash_adjacent(cell, 'w'),
+        geohash_adjacent(north, 'e'), geohash_adjacent(north, 'w'), geohash_adjacent(south, 'e'), geohash_adjacent(south, 'w'),
+    ]))
+
+def geohash_covered_radius_km(lat, precision):
+    """
+    Distance from a point that the 3x3 cell neighbourhood around it is
+    guaranteed to cover
+    """
+    height, width = geohash_cell_size(precision)
+    worst_lat = min(90.0, abs(lat) + height)
+    return min(height * math.pi / 180 * EARTH_RADIUS_KM, width * math.pi / 180 * EARTH_RADIUS_KM * math.cos(math.radians(worst_lat)))
+
+def geohash_prefix_range(prefix):
+    """
+    (lower, upper) bounds matching all cells that start with `prefix`, lower
+    inclusive and upper exclusive, a range query can use the index where
+    LIKE 'prefix%' often can't. The upper bound is the prefix with its last
+    character bumped to the next one in the alphabet (carrying past 'z'), so
+    it only compares geohash characters and holds under any collation. None
+    when no cell sorts after the prefix.
+    """
+    chars = prefix.rstrip(GEOHASH_ALPHABET[-1])
+    if not chars:
+        return prefix, None
+    return prefix, chars[:-1] + GEOHASH_ALPHABET[GEOHASH_ALPHABET.index(chars[-1]) + 1]
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2-lat1)/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2-lon1)/2)**2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def parse_geometry(geometry_str):
+    """
+    GeoJSON geometry dict of `geometry_str`, None if it's empty or not JSON
+    """
+    if not geometry_str:
+        return None
+    try:
+        geometry = json.loads(geometry_str)
+    except ValueError:
+        return None
+    return geometry if isinstance(geometry, dict) else None
+
+def point_from_geometry(geometry):
+    """
+    (latitude, longitude) of a GeoJSON Point, None for anything else
+    """
+    try:
+        if geometry is None or geometry.get('type') != 'Point':
+            return None
+        lon, lat = geometry['coordinates'][:2]
+        return float(lat), float(lon)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+def point_from_geometry_str(geometry_str):
+    """
+    (latitude, longitude) of a GeoJSON Point string, None for anything else
+    """
+    return point_from_geometry(parse_geometry(geometry_str))
+
+def geometry_positions(geometry):
+    """
+    Every [lon, lat, ...] position of a GeoJSON geometry
+    """
+    if geometry.get('type') == 'GeometryCollection':
+        for part in geometry.get('geometries') or ():
+            yield from geometry_positions(part)
+        return
+    stack = [geometry.get('coordinates')]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, list) and value:
+            if isinstance(value[0], (int, float)):
+                yield value
+            else:
+                stack.extend(value)
+
+def geometry_bbox(geometry):
+    """
+    (west, south, east, north) of a GeoJSON geometry, None if it has no
+    valid coordinates
+    """
+    if geometry is None:
+        return None
+    try:
+        lons, lats = zip(*((float(p[0]), float(p[1])) for p in geometry_positions(geometry)))
+    except (ValueError, TypeError, IndexError, AttributeError):
+        return None
+    return min(lons), min(lats), max(lons), max(lats)
+
+def location_fields(geometry_str):
+    """
+    Values of the indexed OrgUnit location columns derived from `geometry_str`:
+    the coordinates of a point and the bounding box of any geometry
+    """
+    geometry = parse_geometry(geometry_str)
+    values = dict(zip(('bbox_west', 'bbox_south', 'bbox_east', 'bbox_north'), geometry_bbox(geometry) or (None,) * 4))
+    point = point_from_geometry(geometry)
+    if point is None:
+        values.update({'latitude': None, 'longitude': None, 'geocell': ''})
+        return values
+    lat, lon = point
+    values.update({'latitude': lat, 'longitude': lon, 'geocell': geohash_encode(lat, lon)})
+    return values
+
+# Douglas-Peucker simplification of boundaries, in degrees. The tolerance is
+# the largest distance a dropped vertex may have from the simplified line.
+
+def simplify_line(positions, tolerance):
+    if len(positions) < 3:
+        return positions
+    keep = [False] * len(positions)
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+    stack = [(0, len(positions) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = positions[first][0], positions[first][1]
+        dx, dy = positions[last][0] - ax, positions[last][1] - ay
+        length2 = dx*dx + dy*dy
+        farthest, farthest_d2 = None, tolerance2
+        for i in range(first + 1, last):
+            px, py = positions[i][0] - ax, positions[i][1] - ay
+            t = max(0.0, min(1.0, (px*dx + py*dy) / length2)) if length2 else 0.0
+            ex, ey = px - t*dx, py - t*dy
+            d2 = ex*ex + ey*ey
+            if d2 > farthest_d2:
+                farthest, farthest_d2 = i, d2
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, k in zip(positions, keep) if k]
+
+def simplify_ring(ring, tolerance):
+    """
+    Simplified closed ring, None when it is smaller than the tolerance
+    """
+    if len(ring) < 4:
+        return None
+    lons = [p[0] for p in ring]
+    lats = [p[1] for p in ring]
+    if max(lons) - min(lons) < tolerance and max(lats) - min(lats) < tolerance:
+        return None
+    # the ends of a ring coincide, split it at the vertex farthest from them
+    split = max(range(len(ring)), key=lambda i: (ring[i][0] - ring[0][0])**2 + (ring[i][1] - ring[0][1])**2)
+    simplified = simplify_line(ring[:split + 1], tolerance)[:-1] + simplify_line(ring[split:], tolerance)
+    return simplified if len(simplified) >= 4 else None
+
+def simplify_geometry(geometry, tolerance, decimals):
+    """
+    Simplified copy of a GeoJSON geometry with the coordinates rounded to
+    `decimals`. Rings and polygons smaller than the tolerance are dropped,
+    but never all of them. None if nothing is left.
+    """
+    def rounded(positions):
+        return [[round(p[0], decimals), round(p[1], decimals)] for p in positions]
+
+    def polygon(rings, keep_outer=False):
+        outer = simplify_ring(rings[0], tolerance) if rings else None
+        if outer is None:
+            if not keep_outer or len(rings[0]) < 4:
+                return None
+            outer = rings[0] # too small to simplify, but all there is
+        return [rounded(outer)] + [rounded(r) for r in (simplify_ring(hole, tolerance) for hole in rings[1:]) if r is not None]
+
+    kind, coordinates = geometry.get('type'), geometry.get('coordinates')
+    if kind == 'Point':
+        return {'type': kind, 'coordinates': rounded([coordinates])[0]}
+    if kind == 'MultiPoint':
+        return {'type': kind, 'coordinates': rounded(coordinates)}
+    if kind == 'LineString':
+        return {'type': kind, 'coordinates': rounded(simplify_line(coordinates, tolerance))}
+    if kind == 'MultiLineString':
+        return {'type': kind, 'coordinates': [rounded(simplify_line(line, tolerance)) for line in coordinates]}
+    if kind == 'Polygon':
+        rings = polygon(coordinates, keep_outer=True)
+        return {'type': kind, 'coordinates': rings} if rings else None
+    if kind == 'MultiPolygon':
+        polygons = [rings for rings in (polygon(p) for p in coordinates) if rings]
+        if not polygons and coordinates:
+            largest = max(coordinates, key=lambda p: len(p[0]) if p else 0)
+            polygons = [rings for rings in [polygon(largest, keep_outer=True)] if rings]
+        return {'type': kind, 'coordinates': polygons} if polygons else None
+    if kind == 'GeometryCollection':
+        parts = [part for part in (simplify_geometry(g, tolerance, decimals) for g in geometry.get('geometries') or ()) if part]
+        return {'type': kind, 'geometries': parts} if parts else None
+    return None
+
+def polygon_rings(geometry):
+    """
+    Every ring (exterior and holes) of a Polygon or MultiPolygon as lists of
+    (lon, lat), None for other geometries. A point is inside when it is
+    inside an odd number of them.
+    """
+    if geometry is None:
+        return None
+    kind, coordinates = geometry.get('type'), geometry.get('coordinates')
+    if kind == 'Polygon':
+        polygons = [coordinates]
+    elif kind == 'MultiPolygon':
+        polygons = coordinates
+    else:
+        return None
+    try:
+        rings = [[(float(p[0]), float(p[1])) for p in ring] for rings in polygons for ring in rings]
+    except (ValueError, TypeError, IndexError):
+        return None
+    rings = [ring for ring in rings if len(ring) >= 4]
+    return rings or None
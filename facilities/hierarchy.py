@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+from facilities.bulk import bulk_update
+from facilities.models import OrgUnit
+
+# Maintenance of the denormalized ancestor columns (<level>_id/<level>_name,
+# see OrgUnit.ancestor_fields). OrgUnit.save() keeps them right for single
+# writes, bulk writers call rebuild_ancestor_fields() once at the end.
+
+def ancestor_columns():
+    return [f for id_field, name_field in OrgUnit.ancestor_fields().values() for f in (id_field, name_field)]
+
+def stored_rows(pks):
+    """
+    Stored name, level, path, coordinates and ancestor columns of the orgunits
+    in `pks`, as a dict pk -> values dict
+    """
+    fields = ('id', 'name', 'level', 'path_key', 'latitude', 'longitude') + tuple(ancestor_columns())
+    return dict((row['id'], row) for row in OrgUnit._base_manager.filter(pk__in=[pk for pk in pks if pk is not None]).values(*fields))
+
+def child_ancestor_values(parent_row):
+    """
+    Ancestor column values for a child of the orgunit described by
+    `parent_row` (a stored_rows() dict, None for a root)
+    """
+    values = OrderedDict()
+    for level, (id_field, name_field) in OrgUnit.ancestor_fields().items():
+        if parent_row is None:
+            values[id_field], values[name_field] = None, ''
+        elif parent_row['level'] == level:
+            values[id_field], values[name_field] = parent_row['id'], parent_row['name']
+        else:
+            values[id_field], values[name_field] = parent_row[id_field], parent_row[name_field]
+    return values
+
+def update_descendants(ou, before):
+    """
+    Propagate a rename or move of `ou` (already saved) to the ancestor columns
+    of everything below it, `before` being its stored_rows() values prior to
+    the save. Done with one UPDATE on the indexed <level>_id column, unless the
+    move changed the level of the subtree.
+    """
+    ancestor_fields = OrgUnit.ancestor_fields()
+    if ou.level not in ancestor_fields:
+        return 0 # lowest level, nothing below
+    if ou.level != before['level']:
+        return rebuild_ancestor_fields()
+
+    id_field, name_field = ancestor_fields[ou.level]
+    changes = dict((f, getattr(ou, f)) for f in ancestor_columns() if getattr(ou, f) != before[f])
+    if ou.name != before['name']:
+        changes[name_field] = ou.name
+    if not changes:
+        return 0
+    return OrgUnit._base_manager.filter(**{id_field: ou.pk}).update(**changes)
+
+def compute_ancestor_values(nodes):
+    """
+    Given `nodes` as an iterable of (pk, parent_pk, name) compute the ancestor
+    columns of every node from the parent links, the level of a node being its
+    depth as in the nested set. Returns a dict pk -> values dict.
+    """
+    nodes = dict((pk, (parent_pk, name)) for pk, parent_pk, name in nodes)
+    rows = {}
+    for pk in nodes:
+        # walk up to the first node already done (or the root), then back down
+        chain = []
+        ancestor_pk = pk
+        while ancestor_pk is not None and ancestor_pk not in rows:
+            chain.append(ancestor_pk)
+            ancestor_pk = nodes[ancestor_pk][0]
+        for node_pk in reversed(chain):
+            parent_pk = nodes[node_pk][0]
+            parent_row = None
+            if parent_pk is not None:
+                parent_row = dict(rows[parent_pk], id=parent_pk, name=nodes[parent_pk][1])
+            row = child_ancestor_values(parent_row)
+            row['level'] = 0 if parent_row is None else parent_row['level'] + 1
+            rows[node_pk] = row
+    for row in rows.values():
+        del row['level']
+    return rows
+
+def rebuild_ancestor_fields(orgunit_model=OrgUnit):
+    """
+    Recompute the ancestor columns of every orgunit with a single SELECT and
+    write back only the rows that changed. Returns the number of rows updated.
+    """
+    columns = ancestor_columns()
+    current = {}
+    nodes = []
+    for pk, parent_pk, name, *values in orgunit_model._base_manager.values_list('pk', 'parent_id', 'name', *columns).iterator():
+        nodes.append((pk, parent_pk, name))
+        current[pk] = dict(zip(columns, values))
+
+    changed = [(pk, values) for pk, values in compute_ancestor_values(nodes).items() if current[pk] != values]
+    if changed:
+        bulk_update(orgunit_model, changed, columns)
+    return len(changed)
@@ -0,0 +1,288 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from collections import namedtuple, OrderedDict
+import hashlib
+import json
+
+from facilities.audit import CREATED, UPDATED, audit_batch
+from facilities.boundaries import store_geometries
+from facilities.bulk import bulk_fetch, bulk_update, chunked, rebuild_tree
+from facilities.geo import location_fields
+from facilities.hierarchy import rebuild_ancestor_fields
+from facilities.paths import path_key
+from facilities.search import index_names, normalize_name
+from facilities.subtree import invalidate_all_subtrees
+from facilities.summary import rebuild_summary
+from facilities.tiles import invalidate_tiles
+from facilities.models import LOCATION_FIELDS, OrgUnit, OrgUnitChange, Identifier, orgunit_cleanup_name
+
+# CSV columns holding the path from the root orgunit down to the facility
+PATH_COLUMNS = ('REGION', 'SUB_REGION', 'DISTRICT', 'SUBCOUNTY', 'NAME')
+
+# facility attributes maintained by the loader
+FACILITY_FIELDS = ('active', 'orgunit_type', 'ownership', 'authority', 'geometry_str')
+
+FacilityRecord = namedtuple('FacilityRecord', ('path', 'uid', 'values'))
+
+def parse_row(row):
+    """
+    Convert a CSV row (as read by csv.DictReader) into a FacilityRecord holding
+    the cleaned orgunit path, the DHIS2 UID and the facility attribute values.
+    Returns None for rows that do not describe a facility.
+    """
+    if not (row.get('NAME') and row.get('FACILITY_LEVEL')):
+        return None
+
+    path = tuple(orgunit_cleanup_name(x) for x in [settings.ORG_UNIT_ROOT_NAME] + [row.get(col) or '' for col in PATH_COLUMNS])
+    if not all(path):
+        return None # incomplete path, the facility can't be placed in the tree
+
+    values = OrderedDict()
+    values['active'] = (row.get('OPERATIONAL STATUS') or '').strip() == 'Functional'
+    if row.get('FACILITY_LEVEL'):
+        values['orgunit_type'] = row['FACILITY_LEVEL'].upper()
+    if row.get('OWNERSHIP_NAME'):
+        values['ownership'] = row['OWNERSHIP_NAME'].upper()
+    if row.get('AUTHORITY_NAME'):
+        values['authority'] = row['AUTHORITY_NAME'].upper()
+    if row.get('COORDINATES'):
+        ou_coords = json.loads(row['COORDINATES'])
+        ou_geom = dict([('type', 'Point'), ('coordinates', ou_coords)])
+        values['geometry_str'] = json.dumps(ou_geom)
+
+    return FacilityRecord(path, (row.get('UID') or '').strip(), values)
+
+def record_fingerprint(record):
+    """
+    SHA-1 of the normalized content of a facility record. Stored on the
+    facility as OrgUnit.content_hash so that an unchanged row can be skipped
+    on the next import without comparing (or even reading) its fields.
+    """
+    content = [[p.lower() for p in record.path], record.uid, record.values]
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_records(reader):
+    """
+    Parse all facility rows from a csv.DictReader, later rows for the same path
+    replace earlier ones. Returns (records, skipped_row_count).
+    """
+    records = OrderedDict()
+    skipped = 0
+    for row in reader:
+        record = parse_row(row)
+        if record is None:
+            skipped += 1
+        else:
+            records[record.path] = record
+    return list(records.values()), skipped
+
+class ChangeSet:
+    """
+    Result of comparing a file against the registry: the nodes to create, the
+    facilities whose content changed and those present in the registry but
+    absent from the file
+    """
+    def __init__(self):
+        self.resolved = {(): None} # path -> pk of existing nodes
+        self.new_nodes = OrderedDict() # path -> FacilityRecord (None for admin units), parents first
+        self.updated = [] # (pk, record)
+        self.unchanged = 0
+        self.missing = [] # (pk, name) of facilities not in the file
+
+    @property
+    def inserted(self):
+        return [record for record in self.new_nodes.values() if record is not None]
+
+    @property
+    def new_adminunits(self):
+        return [path for path, record in self.new_nodes.items() if record is None]
+
+    def counts(self):
+        return OrderedDict([
+            ('inserted', len(self.inserted)),
+            ('updated', len(self.updated)),
+            ('unchanged', self.unchanged),
+            ('missing', len(self.missing)),
+            ('new_adminunits', len(self.new_adminunits)),
+        ])
+
+class BulkOrgUnitLoader:
+    """
+    Set-based import of facility records. The whole file is resolved against
+    the existing tree in memory, then written with a handful of bulk queries
+    inside one transaction and the nested set is rebuilt once at the end.
+
+    Facilities whose stored content_hash matches the row fingerprint are
+    skipped without any further query.
+    """
+    IDENTIFIER_AGENCY = 'MOH'
+    IDENTIFIER_CONTEXT = 'DHIS2'
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+
+    def plan(self, records):
+        changes = ChangeSet()
+
+        # one query for the whole existing registry
+        existing = {}
+        stored_hash = {}
+        facility_pks = {}
+        for pk, parent_id, name, orgunit_type, content_hash in OrgUnit.objects.values_list('pk', 'parent_id', 'name', 'orgunit_type', 'content_hash').iterator():
+            existing[(parent_id, name.lower())] = pk
+            stored_hash[pk] = content_hash
+            if orgunit_type != 'ADMIN':
+                facility_pks[pk] = name
+
+        seen = set()
+        for record in records:
+            for depth in range(1, len(record.path)+1):
+                node_path = record.path[:depth]
+                if node_path in changes.resolved or node_path in changes.new_nodes:
+                    continue
+                parent_pk = changes.resolved.get(node_path[:-1]) # missing when the parent is new
+                pk = existing.get((parent_pk, node_path[-1].lower())) if node_path[:-1] in changes.resolved else None
+                if pk is None:
+                    changes.new_nodes[node_path] = None
+                else:
+                    changes.resolved[node_path] = pk
+
+            if record.path in changes.new_nodes:
+                changes.new_nodes[record.path] = record
+                continue
+            pk = changes.resolved[record.path]
+            seen.add(pk)
+            if stored_hash[pk] == record_fingerprint(record):
+                changes.unchanged += 1
+            else:
+                changes.updated.append((pk, record))
+
+        changes.missing = sorted((pk, name) for pk, name in facility_pks.items() if pk not in seen)
+        return changes
+
+    def apply(self, changes):
+        stats = OrderedDict((k, 0) for k in ('adminunits_created', 'facilities_created', 'facilities_updated', 'facilities_rehashed', 'identifiers_created', 'identifiers_linked', 'tree_rows_updated'))
+
+        with audit_batch('orgunit import') as audit, transaction.atomic():
+            # create the new nodes one level at a time, parents before children
+            resolved = dict(changes.resolved)
+            ancestor_fields = OrgUnit.ancestor_fields()
+            created_orgunits = []
+            created_names = []
+            tile_points = [] # old and new positions of the facilities written
+            by_depth = OrderedDict()
+            for path in sorted(changes.new_nodes, key=len):
+                by_depth.setdefault(len(path), []).append(path)
+            for depth, paths in by_depth.items():
+                new_nodes = OrderedDict()
+                for path in paths:
+                    ou = OrgUnit(name=path[-1], parent_id=resolved[path[:-1]], path_key=path_key(path), search_name=normalize_name(path[-1]), lft=0, rght=0, tree_id=0, level=depth-1)
+                    for level, (id_field, name_field) in ancestor_fields.items():
+                        if level < depth-1:
+                            setattr(ou, id_field, resolved[path[:level+1]])
+                            setattr(ou, name_field, path[level])
+                    record = changes.new_nodes[path]
+                    if record is not None:
+                        for field, value in record.values.items():
+                            setattr(ou, field, value)
+                        ou.content_hash = record_fingerprint(record)
+                        ou.set_location_fields() # bulk_create bypasses save()
+                        stats['facilities_created'] += 1
+                    else:
+                        stats['adminunits_created'] += 1
+                    new_nodes[path] = ou
+                OrgUnit.objects.bulk_create(new_nodes.values(), batch_size=self.batch_size)
+                # bulk_create doesn't return primary keys on every backend, look them up by uuid
+                pk_by_uuid = dict(bulk_fetch(OrgUnit.objects, 'uuid', [ou.uuid for ou in new_nodes.values()], 'uuid', 'pk'))
+                for path, ou in new_nodes.items():
+                    resolved[path] = pk_by_uuid[ou.uuid]
+                    tile_points.append((ou.latitude, ou.longitude))
+                    created_orgunits.append((resolved[path], ou.uuid))
+                    created_names.append((resolved[path], ou.search_name))
+                    audit.add(OrgUnit, CREATED, resolved[path], str(ou))
+
+            index_names(created_names)
+
+            # the fingerprint changed, but old rows (or a changed identifier) may not mean different field values
+            current_values = {}
+            uuid_by_pk = {}
+            for pk, ou_uuid, *values in bulk_fetch(OrgUnit.objects, 'pk', [pk for pk, _ in changes.updated], 'pk', 'uuid', *FACILITY_FIELDS):
+                current_values[pk] = dict(zip(FACILITY_FIELDS, values))
+                uuid_by_pk[pk] = ou_uuid
+            now = timezone.now()
+            updates = []
+            rehashes = []
+            for pk, record in changes.updated:
+                current = current_values[pk]
+                changed = dict((k, v) for k, v in record.values.items() if current[k] != v)
+                if changed:
+                    new_values = dict(current, updatedAt=now, content_hash=record_fingerprint(record), **changed)
+                    new_values.update(location_fields(new_values['geometry_str']))
+                    old_location = location_fields(current['geometry_str'])
+                    tile_points += [(old_location['latitude'], old_location['longitude']), (new_values['latitude'], new_values['longitude'])]
+                    updates.append((pk, new_values))
+                    audit.add(OrgUnit, UPDATED, pk, dict((k, [current[k], v]) for k, v in changed.items()))
+                else:
+                    rehashes.append((pk, {'content_hash': record_fingerprint(record)}))
+            if updates:
+                bulk_update(OrgUnit, updates, FACILITY_FIELDS + LOCATION_FIELDS + ('content_hash', 'updatedAt'))
+                store_geometries((pk, values['geometry_str']) for pk, values in updates) # the file only has points, but they may replace a boundary
+            if rehashes:
+                bulk_update(OrgUnit, rehashes, ('content_hash',))
+            stats['facilities_updated'] = len(updates)
+            stats['facilities_rehashed'] = len(rehashes)
+
+            # only new and changed rows can carry an identifier that isn't linked yet
+            touched = changes.inserted + [record for _, record in changes.updated]
+            stats['identifiers_created'], new_links = self.load_identifiers(resolved, touched)
+            stats['identifiers_linked'] = len(new_links)
+            audit.add_links(OrgUnit, Identifier, new_links)
+
+            # bulk writes don't send signals, feed the change log directly
+            OrgUnitChange.record(OrgUnitChange.CREATED, created_orgunits)
+            updated_pks = set(pk for pk, _ in updates) | (set(ou_id for ou_id, _ in new_links) & set(uuid_by_pk))
+            OrgUnitChange.record(OrgUnitChange.UPDATED, sorted((pk, uuid_by_pk[pk]) for pk in updated_pks))
+
+            if changes.new_nodes:
+                stats['tree_rows_updated'] = rebuild_tree(OrgUnit)
+                rebuild_ancestor_fields() # writes nothing unless the file spells existing ancestors differently
+
+            if created_orgunits or updated_pks:
+                rebuild_summary()
+                invalidate_all_subtrees()
+            invalidate_tiles(tile_points)
+
+        return stats
+
+    def load(self, records):
+        changes = self.plan(records)
+        return changes, self.apply(changes)
+
+    def load_identifiers(self, resolved, records):
+        """
+        Create missing DHIS2 identifiers and link them to their facilities.
+        Returns the number of identifiers created and the set of new
+        (orgunit_id, identifier_id) links.
+        """
+        uid_to_orgunit = dict((record.uid, resolved[record.path]) for record in records if record.uid)
+        identifiers = Identifier.objects.filter(agency=self.IDENTIFIER_AGENCY, context=self.IDENTIFIER_CONTEXT)
+
+        identifier_ids = dict(bulk_fetch(identifiers, 'external_id', list(uid_to_orgunit), 'external_id', 'pk'))
+        missing = [uid for uid in uid_to_orgunit if uid not in identifier_ids]
+        if missing:
+            Identifier.objects.bulk_create(
+                (Identifier(agency=self.IDENTIFIER_AGENCY, context=self.IDENTIFIER_CONTEXT, external_id=uid) for uid in missing),
+                batch_size=self.batch_size
+            )
+            identifier_ids.update(bulk_fetch(identifiers, 'external_id', missing, 'external_id', 'pk'))
+
+        Link = OrgUnit.identifiers.through
+        wanted = set((uid_to_orgunit[uid], identifier_ids[uid]) for uid in uid_to_orgunit)
+        linked = set(bulk_fetch(Link.objects, 'identifier_id', [i for _, i in wanted], 'orgunit_id', 'identifier_id'))
+        new_links = wanted - linked
+        for batch in chunked(sorted(new_links), self.batch_size):
+            Link.objects.bulk_create([Link(orgunit_id=ou_id, identifier_id=identifier_id) for ou_id, identifier_id in batch])
+
+        return len(missing), new_links
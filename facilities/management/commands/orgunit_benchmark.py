@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+import json
+
+from facilities.benchmark import compare_results, run_benchmarks
+from facilities.synthetic import parse_size
+
+class Command(BaseCommand):
+    help = 'Benchmark the import, API, exports and dashboards against a synthetic registry, in a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orgunits', default='10k', help='approximate number of orgunits, e.g. 10k, 100k or 1M')
+        parser.add_argument('--seed', type=int, default=1, help='random seed of the synthetic registry')
+        parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the median is reported')
+        parser.add_argument('--output', help='write the results as JSON to this file')
+        parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+        parser.add_argument('--csv', help='keep the generated input CSV at this path')
+
+    def handle(self, *args, **options):
+        # a test database, like manage.py test, so that no real data is touched
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = run_benchmarks(
+                parse_size(options['orgunits']), options['seed'], options['repeat'], options['csv'],
+                progress=lambda name: self.stderr.write('running %s' % name),
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+            for line in compare_results(baseline, results):
+                self.stderr.write(line)
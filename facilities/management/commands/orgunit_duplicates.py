@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+import csv
+
+from facilities.duplicates import DuplicateDetector, duplicate_report
+
+class Command(BaseCommand):
+    help = 'Find possible duplicate facilities (by name and location) and list them for review'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='compare all facilities, not only the ones changed since the last run')
+        parser.add_argument('--min-score', type=float, help='lowest score kept (default settings.DUPLICATE_MIN_SCORE)')
+        parser.add_argument('--limit', type=int, default=20, help='number of open candidates listed')
+        parser.add_argument('--csv', metavar='CSV_FILE', help='write all open candidates to a CSV file')
+
+    def handle(self, *args, **options):
+        detector = DuplicateDetector(options['min_score'])
+        detector.run(full=options['full'])
+        for k, v in detector.stats.items():
+            self.stdout.write('%s: %d' % (k.replace('_', ' '), v))
+
+        if options['csv']:
+            with open(options['csv'], 'w', encoding='utf-8', newline='') as csv_file:
+                writer = None
+                for row in duplicate_report():
+                    if writer is None:
+                        writer = csv.DictWriter(csv_file, list(row))
+                        writer.writeheader()
+                    writer.writerow(row)
+        for row in duplicate_report(limit=options['limit']):
+            self.stdout.write('%.2f %s [%s] <-> %s [%s] %s' % (row['score'], row['name_a'], row['path_a'], row['name_b'], row['path_b'], row['reasons']))
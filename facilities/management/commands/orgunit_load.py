@@ -2,48 +2,82 @@ from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
 import csv
-import json
 
+from facilities.audit import audit_batch
 from facilities.models import OrgUnit, Identifier
+from facilities.importer import BulkOrgUnitLoader, read_records, record_fingerprint
+from facilities.placement import check_placement, deferred_checks
 
-# TODO: How to reset the orgunit cache on 'OrgUnit.from_path_recurse'? Reset at end of load from Excel??
 class Command(BaseCommand):
     help = 'Load from CSV file'
 
     def add_arguments(self, parser):
         parser.add_argument('CSV_FILE', nargs='+', help='CSV file containing facilities')
+        parser.add_argument('--bulk', action='store_true', help='read the whole file and write it with set-based queries, rebuilding the tree once')
+        parser.add_argument('--batch-size', type=int, default=500, help='rows per INSERT/UPDATE statement in bulk mode')
+        parser.add_argument('--dry-run', action='store_true', help='list the changes the file would make without writing anything')
 
     def handle(self, *args, **options):
-        with open(options['CSV_FILE'][0]) as csvfile:
-            reader = csv.DictReader(csvfile) # assumes presence of header row and gobbles it up
-            for row in reader:
-                if row['NAME'] and row['FACILITY_LEVEL']:
-                    # TODO: CSV files are being generated with a BOM (Byte Order Mark) which appears in the first item of the header. Fix this.
-                    ou = OrgUnit.from_path_recurse(settings.ORG_UNIT_ROOT_NAME, row['\ufeffREGION'], row['SUB_REGION'], row['DISTRICT'], row['SUBCOUNTY'], row['NAME'])
-                    ou_dirty = False
-                    if ou.active != (row['OPERATIONAL STATUS'].strip() == 'Functional'):
-                        ou.active = row['OPERATIONAL STATUS'].strip() == 'Functional'
-                        ou_dirty = True
-                    if row['UID']:
-                        ou_identity, identity_created = Identifier.objects.get_or_create(agency='MOH', context='DHIS2', external_id=row['UID'])
-                        if identity_created:
-                            ou_identity.save()
-                        ou.identifiers.add(ou_identity)
-                        ou_dirty = True
-                    if row['FACILITY_LEVEL']:
-                        ou.orgunit_type = row['FACILITY_LEVEL'].upper()
-                        ou_dirty = True
-                    if row['OWNERSHIP_NAME']:
-                        ou.ownership = row['OWNERSHIP_NAME'].upper()
-                        ou_dirty = True
-                    if row['AUTHORITY_NAME']:
-                        ou.authority = row['AUTHORITY_NAME'].upper()
-                        ou_dirty = True
-                    if row['COORDINATES']:
-                        ou_coords = json.loads(row['COORDINATES'])
-                        ou_geom = dict([('type', 'Point'), ('coordinates', ou_coords)])
-                        ou.geometry_str = json.dumps(ou_geom)
-                        ou_dirty = True
-
-                    if ou_dirty:
-                        ou.save()
+        # 'utf-8-sig' drops the BOM that the MoH exports put in front of the header row
+        with open(options['CSV_FILE'][0], encoding='utf-8-sig') as csvfile:
+            records, skipped = read_records(csv.DictReader(csvfile))
+        self.stdout.write('%d facility rows read, %d rows skipped' % (len(records), skipped))
+
+        # rows whose fingerprint matches the stored content_hash are not touched at all
+        loader = BulkOrgUnitLoader(batch_size=options['batch_size'])
+        changes = loader.plan(records)
+        for k, v in changes.counts().items():
+            self.stdout.write('%s: %d' % (k.replace('_', ' '), v))
+
+        if options['dry_run']:
+            self.write_changes(changes)
+            return
+
+        if options['bulk']:
+            stats = loader.apply(changes)
+            for k, v in stats.items():
+                self.stdout.write('%s: %d' % (k.replace('_', ' '), v))
+        else:
+            # checked all at once below, not on every save
+            with deferred_checks():
+                self.apply_rows(changes)
+
+        # coordinates outside their admin units, listed by orgunit_placement
+        if changes.inserted or changes.updated:
+            for k, v in check_placement().items():
+                self.stdout.write('%s: %d' % (k.replace('_', ' '), v))
+
+    def apply_rows(self, changes):
+        """
+        Save new and changed facilities one at a time through the model,
+        audited as a single change set
+        """
+        with audit_batch('orgunit_load'):
+            self.save_rows(changes)
+
+    def save_rows(self, changes):
+        for record in changes.inserted + [record for _, record in changes.updated]:
+            ou = OrgUnit.from_path_recurse(*record.path)
+            ou_dirty = False
+            for field, value in record.values.items():
+                if getattr(ou, field) != value:
+                    setattr(ou, field, value)
+                    ou_dirty = True
+            if record.uid:
+                ou_identity, identity_created = Identifier.objects.get_or_create(agency='MOH', context='DHIS2', external_id=record.uid)
+                ou.identifiers.add(ou_identity)
+
+            ou.content_hash = record_fingerprint(record)
+            if ou_dirty:
+                ou.save()
+            else:
+                # only the fingerprint is new, don't bump updatedAt
+                OrgUnit.objects.filter(pk=ou.pk).update(content_hash=ou.content_hash)
+
+    def write_changes(self, changes):
+        for record in changes.inserted:
+            self.stdout.write('+ %s' % '/'.join(record.path))
+        for _, record in changes.updated:
+            self.stdout.write('~ %s' % '/'.join(record.path))
+        for pk, name in changes.missing:
+            self.stdout.write('- %s [id: %d]' % (name, pk))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+import csv
+
+from facilities.placement import check_placement, placement_report
+
+class Command(BaseCommand):
+    help = 'Check that the facility coordinates are inside their admin units and list the misplaced ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help='number of misplaced facilities listed')
+        parser.add_argument('--csv', metavar='CSV_FILE', help='write all misplaced facilities to a CSV file')
+
+    def handle(self, *args, **options):
+        for k, v in check_placement().items():
+            self.stdout.write('%s: %d' % (k.replace('_', ' '), v))
+
+        if options['csv']:
+            with open(options['csv'], 'w', encoding='utf-8', newline='') as csv_file:
+                writer = None
+                for row in placement_report():
+                    if writer is None:
+                        writer = csv.DictWriter(csv_file, list(row))
+                        writer.writeheader()
+                    writer.writerow(row)
+        for row in placement_report(limit=options['limit']):
+            self.stdout.write('%s [%s] outside %s (%s), in %s' % (row['name'], row['path'], row['expected'], row['method'], row['found'] or 'no known unit'))
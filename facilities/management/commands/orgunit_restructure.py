@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import csv
+import json
+
+from facilities.restructure import Restructure, RestructureError
+
+class Command(BaseCommand):
+    help = 'Apply administrative boundary changes (moves, splits, merges) in one go'
+
+    def add_arguments(self, parser):
+        parser.add_argument('SPEC_FILE', help='JSON restructuring spec (see facilities.restructure), or a CSV file of moves with orgunit and parent columns')
+        parser.add_argument('--batch-size', type=int, default=500, help='rows per INSERT/UPDATE statement')
+        parser.add_argument('--dry-run', action='store_true', help='check the spec and list the changes without writing anything')
+
+    def handle(self, *args, **options):
+        with open(options['SPEC_FILE'], encoding='utf-8-sig') as spec_file:
+            if options['SPEC_FILE'].lower().endswith('.csv'):
+                spec = {'moves': [{'orgunit': row['orgunit'], 'parent': row['parent']} for row in csv.DictReader(spec_file)]}
+            else:
+                spec = json.load(spec_file)
+
+        restructuring = Restructure(spec, batch_size=options['batch_size'])
+        try:
+            summary = restructuring.plan() if options['dry_run'] else restructuring.apply()
+        except RestructureError as e:
+            raise CommandError('\n'.join(e.errors))
+
+        for path in summary['created']:
+            self.stdout.write('created %s' % path)
+        for move in summary['moved']:
+            self.stdout.write('moved %s: %s -> %s (%d below it)' % (move['name'], move['from'], move['to'], move['descendants']))
+        for path in summary['deleted']:
+            self.stdout.write('deleted %s' % path)
+        self.stdout.write('%d orgunits moved' % summary['orgunits_moved'])
+        if 'tree_rows_updated' in summary:
+            self.stdout.write('%d tree rows updated' % summary['tree_rows_updated'])
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from facilities.synthetic import SyntheticRegistry, parse_size
+
+class Command(BaseCommand):
+    help = 'Write a synthetic registry as an orgunit_load CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('CSV_FILE', help='file to write')
+        parser.add_argument('--orgunits', default='10k', help='approximate number of orgunits, e.g. 10k, 100k or 1M')
+        parser.add_argument('--seed', type=int, default=1, help='random seed, the same seed and size give the same file')
+
+    def handle(self, *args, **options):
+        registry = SyntheticRegistry(parse_size(options['orgunits']), options['seed'])
+        # with a BOM, like the MoH exports
+        with open(options['CSV_FILE'], 'w', encoding='utf-8-sig', newline='') as csv_file:
+            rows = registry.write_csv(csv_file)
+        self.stdout.write('%d facility rows written' % rows)
@@ -0,0 +1,312 @@
+from django.conf import settings
+from django.db.backends.utils import CursorWrapper
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+
+# Always-on request instrumentation. MetricsMiddleware records, per URL name
+# and viewset action, the request latency, the number and time of database
+# queries, the time spent serializing and the response size, in histograms
+# kept in this process and exposed in the Prometheus text format by
+# views.metrics. A sample of the requests slower than
+# METRICS_SLOW_REQUEST_SECONDS is kept with its queries (grouped by SQL, so
+# that N+1 patterns stand out) for views.slow_requests. Every request, and
+# every slow trace, can also be written to METRICS_LOG_FILE as JSON lines.
+#
+# Queries are counted by wrapping Django's cursor execute methods, which only
+# do any work while a request is being measured.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+# (metric name, help, buckets, RequestStats attribute)
+HISTOGRAMS = (
+    ('simplemfl_http_request_duration_seconds', 'Time to respond, including streaming the content', DURATION_BUCKETS, 'duration'),
+    ('simplemfl_db_queries', 'Database queries per request', QUERY_BUCKETS, 'queries'),
+    ('simplemfl_db_duration_seconds', 'Time spent in database queries per request', DURATION_BUCKETS, 'db_duration'),
+    ('simplemfl_serializer_duration_seconds', 'Time spent serializing orgunits per request', DURATION_BUCKETS, 'serializer_duration'),
+    ('simplemfl_http_response_size_bytes', 'Response body size', SIZE_BUCKETS, 'size'),
+)
+
+TRACE_MAX_STATEMENTS = 100 # distinct SQL statements kept per request
+TRACE_SQL_LENGTH = 1000
+
+_local = threading.local()
+
+class RequestStats:
+    __slots__ = ('started', 'duration', 'queries', 'db_duration', 'serializer_duration', 'size', 'statements', 'timing_section')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.queries = 0
+        self.db_duration = 0.0
+        self.serializer_duration = 0.0
+        self.size = 0
+        self.statements = OrderedDict() # sql -> [count, seconds]
+        self.timing_section = False
+
+    def add_query(self, sql, seconds):
+        self.queries += 1
+        self.db_duration += seconds
+        sql = str(sql)[:TRACE_SQL_LENGTH]
+        if sql in self.statements:
+            self.statements[sql][0] += 1
+            self.statements[sql][1] += seconds
+        elif len(self.statements) < TRACE_MAX_STATEMENTS:
+            self.statements[sql] = [1, seconds]
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    The metrics of this process: request counts and histograms by label set,
+    and the kept slow request traces
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {} # (endpoint, action, method, status) -> count
+        self.histograms = dict((name, {}) for name, _, _, _ in HISTOGRAMS) # name -> {(endpoint, action, method): Histogram}
+        self.slow_requests = deque(maxlen=getattr(settings, 'METRICS_SLOW_TRACES', 50))
+
+    def record(self, labels, status, stats):
+        with self.lock:
+            key = labels + (str(status),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for name, _, buckets, attr in HISTOGRAMS:
+                histogram = self.histograms[name].get(labels)
+                if histogram is None:
+                    histogram = self.histograms[name][labels] = Histogram(buckets)
+                histogram.observe(getattr(stats, attr))
+
+    def add_slow_request(self, trace):
+        with self.lock:
+            self.slow_requests.append(trace)
+
+    def prometheus_text(self):
+        label_names = ('endpoint', 'action', 'method')
+        lines = [
+            '# HELP simplemfl_http_requests_total Requests by endpoint, action, method and status',
+            '# TYPE simplemfl_http_requests_total counter',
+        ]
+        with self.lock:
+            for key, count in sorted(self.requests.items()):
+                lines.append('simplemfl_http_requests_total{{{0}}} {1}'.format(format_labels(label_names + ('status',), key), count))
+            for name, help_text, buckets, _ in HISTOGRAMS:
+                lines.append('# HELP {0} {1}'.format(name, help_text))
+                lines.append('# TYPE {0} histogram'.format(name))
+                for labels, histogram in sorted(self.histograms[name].items()):
+                    label_text = format_labels(label_names, labels)
+                    for bound, count in zip(buckets, histogram.counts):
+                        lines.append('{0}_bucket{{{1},le="{2:g}"}} {3}'.format(name, label_text, bound, count))
+                    lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(name, label_text, histogram.count))
+                    lines.append('{0}_sum{{{1}}} {2!r}'.format(name, label_text, float(histogram.sum)))
+                    lines.append('{0}_count{{{1}}} {2}'.format(name, label_text, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(names, values):
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('{0}="{1}"'.format(name, escape(value)) for name, value in zip(names, values))
+
+registry = MetricsRegistry()
+
+def prometheus_text():
+    return registry.prometheus_text()
+
+def slow_request_traces():
+    """
+    The kept slow request traces, latest first
+    """
+    with registry.lock:
+        return list(registry.slow_requests)[::-1]
+
+_metrics_logger = None
+
+def metrics_logger():
+    """
+    Logger writing to settings.METRICS_LOG_FILE, None when it's not set
+    """
+    global _metrics_logger
+    log_file = getattr(settings, 'METRICS_LOG_FILE', None)
+    if not log_file:
+        return None
+    if _metrics_logger is None:
+        logger = logging.getLogger('facilities.metrics')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        _metrics_logger = logger
+    return _metrics_logger
+
+def install_cursor_hooks():
+    """
+    Count and time the queries of the request being measured in this thread
+    """
+    if getattr(CursorWrapper, '_metrics_hooks', False):
+        return
+
+    def hook(original):
+        def execute(self, sql, *args, **kwargs):
+            stats = getattr(_local, 'stats', None)
+            if stats is None:
+                return original(self, sql, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return original(self, sql, *args, **kwargs)
+            finally:
+                stats.add_query(sql, time.perf_counter() - started)
+        return execute
+
+    CursorWrapper.execute = hook(CursorWrapper.execute)
+    CursorWrapper.executemany = hook(CursorWrapper.executemany)
+    CursorWrapper._metrics_hooks = True
+
+@contextmanager
+def timed_serialization():
+    """
+    Add the time spent in the block to the serializer time of the current
+    request. Nested blocks are only counted once.
+    """
+    stats = getattr(_local, 'stats', None)
+    if stats is None or stats.timing_section:
+        yield
+        return
+    stats.timing_section = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serializer_duration += time.perf_counter() - started
+        stats.timing_section = False
+
+class TimedSerializerMixin:
+    """
+    Serializer mixin counting to_representation() in the serializer time
+    """
+    def to_representation(self, instance):
+        with timed_serialization():
+            return super().to_representation(instance)
+
+def request_labels(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return ('unmatched', '', request.method)
+    endpoint = match.view_name or match._func_path
+    method = 'get' if request.method == 'HEAD' else request.method.lower()
+    action = getattr(match.func, 'actions', {}).get(method, '') # viewsets
+    return (endpoint, action, request.method)
+
+class MetricsMiddleware:
+    """
+    Measure every request, see the module comment. Goes first in
+    MIDDLEWARE so the other middleware is included.
+    """
+    EXCLUDED_ENDPOINTS = ('metrics', 'metrics-slow')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install_cursor_hooks()
+
+    def __call__(self, request):
+        stats = _local.stats = RequestStats()
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.stats = None # nothing after this belongs to the request, whatever happens to the stream
+
+        if response.streaming:
+            # the content (and its queries) is produced as the server sends
+            # it, and recorded when the server closes the response: a stream
+            # the client dropped halfway through is still counted
+            response.streaming_content = self.measure_stream(stats, response.streaming_content)
+            response.close = partial(self.close_stream, request, response, stats, response.close)
+        else:
+            stats.size = len(response.content)
+            self.finish(request, response, stats)
+        return response
+
+    def measure_stream(self, stats, content):
+        # only measure while the content is being produced, not between chunks
+        _local.stats = stats
+        try:
+            for chunk in content:
+                _local.stats = None
+                stats.size += len(chunk)
+                yield chunk
+                _local.stats = stats
+        finally:
+            _local.stats = None
+
+    def close_stream(self, request, response, stats, close):
+        try:
+            close()
+        finally:
+            self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        _local.stats = None
+        stats.duration = time.perf_counter() - stats.started
+        labels = request_labels(request)
+        if labels[0] in self.EXCLUDED_ENDPOINTS:
+            return
+        registry.record(labels, response.status_code, stats)
+
+        trace = None
+        if stats.duration >= getattr(settings, 'METRICS_SLOW_REQUEST_SECONDS', 1.0) and random.random() < getattr(settings, 'METRICS_SLOW_TRACE_SAMPLE', 1.0):
+            trace = OrderedDict([
+                ('time', datetime.datetime.utcnow().isoformat() + 'Z'),
+                ('endpoint', labels[0]),
+                ('action', labels[1]),
+                ('method', request.method),
+                ('path', request.get_full_path()),
+                ('status', response.status_code),
+                ('duration', stats.duration),
+                ('queries', stats.queries),
+                ('db_duration', stats.db_duration),
+                ('serializer_duration', stats.serializer_duration),
+                ('size', stats.size),
+                ('statements', sorted(
+                    (OrderedDict([('sql', sql), ('count', count), ('duration', seconds)]) for sql, (count, seconds) in stats.statements.items()),
+                    key=lambda s: -s['duration'],
+                )),
+            ])
+            registry.add_slow_request(trace)
+
+        logger = metrics_logger()
+        if logger is not None:
+            logger.info(json.dumps(trace or OrderedDict([
+                ('time', datetime.datetime.utcnow().isoformat() + 'Z'),
+                ('endpoint', labels[0]),
+                ('action', labels[1]),
+                ('method', request.method),
+                ('status', response.status_code),
+                ('duration', round(stats.duration, 6)),
+                ('queries', stats.queries),
+                ('db_duration', round(stats.db_duration, 6)),
+                ('serializer_duration', round(stats.serializer_duration, 6)),
+                ('size', stats.size),
+            ])))
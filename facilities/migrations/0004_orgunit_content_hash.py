@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0003_auto_20191119_0936'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orgunit',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=40, verbose_name='import fingerprint'),
+        ),
+    ]
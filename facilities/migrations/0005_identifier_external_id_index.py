@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # databases migrated before the rename recorded the generated name
+    replaces = [
+        ('facilities', '0005_auto_20261017_1747'),
+    ]
+
+    dependencies = [
+        ('facilities', '0004_orgunit_content_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='identifier',
+            name='external_id',
+            field=models.CharField(db_index=True, max_length=32),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_location_fields(apps, schema_editor):
+    from facilities.bulk import bulk_update
+    from facilities.geo import location_fields
+
+    OrgUnit = apps.get_model('facilities', 'OrgUnit')
+    updates = [(pk, location_fields(geometry_str)) for pk, geometry_str in OrgUnit.objects.exclude(geometry_str='').values_list('pk', 'geometry_str').iterator()]
+    bulk_update(OrgUnit, updates, ('latitude', 'longitude', 'geocell'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0005_identifier_external_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orgunit',
+            name='geocell',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=12, verbose_name='geohash cell'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='latitude',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='longitude',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(populate_location_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def seed_change_log(apps, schema_editor):
+    # start the feed with one 'created' entry per existing orgunit so that a
+    # sync from the beginning of the log yields the whole registry
+    OrgUnit = apps.get_model('facilities', 'OrgUnit')
+    OrgUnitChange = apps.get_model('facilities', 'OrgUnitChange')
+    changes = (
+        OrgUnitChange(orgunit_id=pk, uuid=ou_uuid, action='created', changed_at=updated_at)
+        for pk, ou_uuid, updated_at in OrgUnit.objects.order_by('updatedAt', 'pk').values_list('pk', 'uuid', 'updatedAt').iterator()
+    )
+    OrgUnitChange.objects.bulk_create(changes, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0006_orgunit_location'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrgUnitChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orgunit_id', models.IntegerField(db_index=True)),
+                ('uuid', models.UUIDField(db_index=True)),
+                ('action', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')], max_length=8)),
+                ('changed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'organisation unit change',
+            },
+        ),
+        migrations.AlterField(
+            model_name='orgunit',
+            name='updatedAt',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='updated at'),
+        ),
+        migrations.RunPython(seed_change_log, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_summary(apps, schema_editor):
+    from facilities.summary import rebuild_summary
+    rebuild_summary(apps.get_model('facilities', 'OrgUnit'), apps.get_model('facilities', 'OrgUnitSummary'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0007_orgunitchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrgUnitSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveIntegerField()),
+                ('orgunit_type', models.CharField(max_length=16)),
+                ('ownership', models.CharField(max_length=16)),
+                ('authority', models.CharField(max_length=16)),
+                ('region_id', models.IntegerField(default=0)),
+                ('district_id', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('with_coordinates', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'organisation unit summary',
+                'verbose_name_plural': 'organisation unit summaries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='orgunitsummary',
+            unique_together=set([('level', 'orgunit_type', 'ownership', 'authority', 'region_id', 'district_id')]),
+        ),
+        migrations.RunPython(populate_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 17:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_path_keys(apps, schema_editor):
+    from facilities.paths import rebuild_path_keys
+    rebuild_path_keys(apps.get_model('facilities', 'OrgUnit'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0008_orgunitsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orgunit',
+            name='path_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=512, verbose_name='path'),
+        ),
+        migrations.RunPython(populate_path_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_ancestors(apps, schema_editor):
+    from facilities.hierarchy import rebuild_ancestor_fields
+    rebuild_ancestor_fields(apps.get_model('facilities', 'OrgUnit'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0009_orgunit_path_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orgunit',
+            name='country_id',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='country id'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='country_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=96, verbose_name='country name'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='district_id',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='district id'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='district_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=96, verbose_name='district name'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='region_id',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='region id'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='region_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=96, verbose_name='region name'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='subcounty_id',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='subcounty id'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='subcounty_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=96, verbose_name='subcounty name'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='subregion_id',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='subregion id'),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='subregion_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=96, verbose_name='subregion name'),
+        ),
+        migrations.RunPython(populate_ancestors, migrations.RunPython.noop),
+    ]
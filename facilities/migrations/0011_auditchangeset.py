@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:24
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('facilities', '0010_orgunit_ancestors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditChangeSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(db_index=True, max_length=64)),
+                ('description', models.TextField(blank=True, default='')),
+                ('started_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('object_count', models.IntegerField(default=0)),
+                ('counts', models.TextField(blank=True, default='')),
+                ('changes', models.BinaryField(blank=True, default=b'')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'audit change set',
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
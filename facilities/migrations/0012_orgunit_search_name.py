@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_search_index(apps, schema_editor):
+    from facilities.search import rebuild_name_index
+    rebuild_name_index(apps.get_model('facilities', 'OrgUnit'), apps.get_model('facilities', 'OrgUnitNameGram'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0011_auditchangeset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrgUnitNameGram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orgunit_id', models.IntegerField(db_index=True)),
+                ('gram', models.CharField(max_length=3)),
+            ],
+            options={
+                'verbose_name': 'orgunit name trigram',
+            },
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='search_name',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=96, verbose_name='search name'),
+        ),
+        migrations.AlterIndexTogether(
+            name='orgunitnamegram',
+            index_together=set([('gram', 'orgunit_id')]),
+        ),
+        migrations.RunPython(populate_search_index, migrations.RunPython.noop),
+    ]
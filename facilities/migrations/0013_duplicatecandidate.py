@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:40
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('facilities', '0012_orgunit_search_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicateCandidate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orgunit_a_id', models.IntegerField(db_index=True)),
+                ('orgunit_b_id', models.IntegerField(db_index=True)),
+                ('score', models.FloatField(db_index=True)),
+                ('name_similarity', models.FloatField()),
+                ('distance_km', models.FloatField(blank=True, null=True)),
+                ('reasons', models.CharField(blank=True, default='', max_length=200)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('confirmed', 'Confirmed duplicate'), ('dismissed', 'Not a duplicate')], db_index=True, default='open', max_length=10)),
+                ('detected_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('reviewed_at', models.DateTimeField(blank=True, null=True)),
+                ('reviewed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'duplicate candidate',
+            },
+        ),
+        migrations.CreateModel(
+            name='DuplicateScan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('change_id', models.IntegerField(default=0)),
+                ('full', models.BooleanField(default=False)),
+                ('orgunits_checked', models.IntegerField(default=0)),
+                ('pairs_compared', models.IntegerField(default=0)),
+                ('candidates', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'duplicate scan',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='duplicatecandidate',
+            unique_together=set([('orgunit_a_id', 'orgunit_b_id')]),
+        ),
+    ]
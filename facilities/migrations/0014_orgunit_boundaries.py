@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_boundaries(apps, schema_editor):
+    from facilities.boundaries import rebuild_geometries
+    from facilities.bulk import bulk_update
+    from facilities.geo import location_fields
+
+    OrgUnit = apps.get_model('facilities', 'OrgUnit')
+    updates = [(pk, location_fields(geometry_str)) for pk, geometry_str in OrgUnit.objects.exclude(geometry_str='').values_list('pk', 'geometry_str').iterator()]
+    bulk_update(OrgUnit, updates, ('bbox_west', 'bbox_south', 'bbox_east', 'bbox_north'))
+    rebuild_geometries(OrgUnit, apps.get_model('facilities', 'OrgUnitGeometry'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0013_duplicatecandidate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrgUnitGeometry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orgunit_id', models.IntegerField(db_index=True)),
+                ('resolution', models.PositiveSmallIntegerField(choices=[(1, 'low'), (2, 'medium'), (3, 'high')])),
+                ('geometry_str', models.TextField(verbose_name='geometry (GeoJSON string)')),
+                ('source_hash', models.CharField(max_length=40)),
+            ],
+            options={
+                'verbose_name': 'orgunit geometry',
+            },
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='bbox_east',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='bbox_north',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='bbox_south',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='orgunit',
+            name='bbox_west',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='orgunitgeometry',
+            unique_together=set([('orgunit_id', 'resolution')]),
+        ),
+        migrations.RunPython(populate_boundaries, migrations.RunPython.noop),
+    ]
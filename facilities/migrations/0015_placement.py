@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0014_orgunit_boundaries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MisplacedFacility',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orgunit_id', models.IntegerField(unique=True)),
+                ('level', models.PositiveIntegerField(db_index=True)),
+                ('expected_id', models.IntegerField()),
+                ('found_id', models.IntegerField(blank=True, null=True)),
+                ('method', models.CharField(choices=[('polygon', 'Boundary polygon'), ('extent', 'Extent of the facilities')], max_length=8)),
+                ('checked_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'misplaced facility',
+                'verbose_name_plural': 'misplaced facilities',
+            },
+        ),
+        migrations.CreateModel(
+            name='OrgUnitExtent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orgunit_id', models.IntegerField(unique=True)),
+                ('level', models.PositiveIntegerField()),
+                ('west', models.FloatField()),
+                ('south', models.FloatField()),
+                ('east', models.FloatField()),
+                ('north', models.FloatField()),
+                ('centre_lat', models.FloatField()),
+                ('centre_lon', models.FloatField()),
+                ('facility_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'orgunit extent',
+            },
+        ),
+    ]
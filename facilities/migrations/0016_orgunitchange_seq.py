@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def number_existing_changes(apps, schema_editor):
+    # everything logged so far is committed, the ids are the tokens clients already hold
+    apps.get_model('facilities', 'OrgUnitChange').objects.update(seq=F('id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0015_placement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orgunitchange',
+            name='seq',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, unique=True, verbose_name='sequence number'),
+        ),
+        migrations.RunPython(number_existing_changes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0016_orgunitchange_seq'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='duplicatescan',
+            name='change_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facilities', '0017_duplicatescan_change_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orgunit',
+            name='path_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=581, verbose_name='path'),
+        ),
+    ]
@@ -1,17 +1,28 @@
-from django.db import models
-from django.db.models import F
+from django.db import connection, models, transaction
+from django.db.models import F, Q
 from django.conf import settings
+from django.utils import timezone
 
-from functools import lru_cache, partial
+from collections import OrderedDict
+from functools import partial
+import json
 import re
 import uuid
+import zlib
 
 from mptt.models import MPTTModel, TreeForeignKey
 
+from facilities.geo import (
+    GEOHASH_PRECISION, geohash_covered_radius_km, geohash_neighbourhood, geohash_prefix_range, haversine_km, location_fields
+)
+
+LOCATION_FIELDS = ('latitude', 'longitude', 'geocell', 'bbox_west', 'bbox_south', 'bbox_east', 'bbox_north')
+PATH_KEY_MAX_LENGTH = len(settings.ORG_UNIT_LEVELS) * 96 + len(settings.ORG_UNIT_LEVELS) - 1 # a full name per level, separated
+
 class Identifier(models.Model):
     agency = models.CharField(max_length=64)
     context = models.CharField(max_length=64)
-    external_id = models.CharField(max_length=32)
+    external_id = models.CharField(max_length=32, db_index=True)
 
     class Meta:
         unique_together = (
@@ -21,6 +32,45 @@ class Identifier(models.Model):
     def __str__(self):
         return '::'.join([self.agency, self.context, self.external_id])
 
+    @staticmethod
+    def split_identifier_str(id_str):
+        '''
+        Split 'agency::context::external_id' into a triplet. A bare external ID
+        gives (None, None, external_id).
+        '''
+        parts = id_str.strip().split('::')
+        if len(parts) == 3:
+            return tuple(parts)
+        return (None, None, id_str.strip())
+
+    @classmethod
+    def resolve(cls, id_strs, *orgunit_fields):
+        '''
+        Translate many external IDs and/or 'agency::context::external_id'
+        triplets to orgunits in one query per ~900 distinct external IDs (the
+        SQLite parameter limit). Returns a dict mapping each input string to a
+        list of dicts with the requested orgunit fields plus 'identifier'.
+        '''
+        from facilities.bulk import bulk_fetch
+
+        queries = dict((id_str, cls.split_identifier_str(id_str)) for id_str in id_strs)
+        links = OrgUnit.identifiers.through.objects.all()
+        fields = ('identifier__agency', 'identifier__context', 'identifier__external_id') + tuple('orgunit__'+f for f in orgunit_fields)
+
+        matches_by_id = {}
+        for agency, context, external_id, *values in bulk_fetch(links, 'identifier__external_id', list(set(q[2] for q in queries.values())), *fields):
+            match = dict(zip(orgunit_fields, values))
+            match['identifier'] = '::'.join([agency, context, external_id])
+            matches_by_id.setdefault(external_id, []).append(((agency, context), match))
+
+        results = {}
+        for id_str, (agency, context, external_id) in queries.items():
+            results[id_str] = [
+                dict(match) for (match_agency, match_context), match in matches_by_id.get(external_id, [])
+                if agency is None or (agency, context) == (match_agency, match_context)
+            ]
+        return results
+
 
 def orgunit_cleanup_name(name_str):
     """
@@ -43,11 +93,19 @@ class OrgUnit(MPTTModel):
     name = models.CharField(max_length=96, db_index=True)
     active = models.BooleanField(default=True)
     createdAt = models.DateTimeField(auto_now_add=True, verbose_name='created at')
-    updatedAt = models.DateTimeField(auto_now=True, verbose_name='updated at')
+    updatedAt = models.DateTimeField(auto_now=True, db_index=True, verbose_name='updated at')
 
-    # TODO: find_proximity() - given a set of coordinates, return a list orgunits that might match at all levels (nearest hf, subcounties, district ...)
-    # Build crude bounding box for admin units based on facilities with coordinates within them?
+    # admin units without a boundary get a crude extent from the facilities in them, see OrgUnitExtent
     geometry_str = models.TextField(blank=True, default='', verbose_name='geometry (GeoJSON string)')
+    # derived from a Point geometry_str on save, indexed for find_proximity()
+    latitude = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    longitude = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    geocell = models.CharField(max_length=12, blank=True, default='', editable=False, db_index=True, verbose_name='geohash cell')
+    # bounding box of any geometry_str, derived on save
+    bbox_west = models.FloatField(null=True, blank=True, editable=False)
+    bbox_south = models.FloatField(null=True, blank=True, editable=False)
+    bbox_east = models.FloatField(null=True, blank=True, editable=False)
+    bbox_north = models.FloatField(null=True, blank=True, editable=False)
 
     ORGUNIT_TYPE_CHOICES = (
         ('ADMIN', 'Administrative Unit'),
@@ -101,6 +159,13 @@ class OrgUnit(MPTTModel):
 
     identifiers = models.ManyToManyField(Identifier)
 
+    # fingerprint of the source row this orgunit was last imported from, lets orgunit_load skip unchanged rows
+    content_hash = models.CharField(max_length=40, blank=True, default='', editable=False, verbose_name='import fingerprint')
+    # normalized full path (see facilities.paths), maintained by save()
+    path_key = models.CharField(max_length=PATH_KEY_MAX_LENGTH, blank=True, default='', editable=False, db_index=True, verbose_name='path')
+    # name as matched by the search index (see facilities.search), maintained by save()
+    search_name = models.CharField(max_length=96, blank=True, default='', editable=False, db_index=True, verbose_name='search name')
+
     class MPTTMeta:
         order_insertion_by = ['name']
 
@@ -126,16 +191,136 @@ class OrgUnit(MPTTModel):
         return current_node
 
     @classmethod
-    @lru_cache(maxsize=1024)
     def from_path_recurse(cls, *path_parts):
+        from facilities.paths import resolve_path
+
         if len(path_parts) == 0:
             return None
+        ou = cls.objects.filter(pk=resolve_path(path_parts)).first() # one indexed lookup for paths that exist
+        if ou is not None:
+            return ou
         *parent_path, node_name = path_parts
         node_name = orgunit_cleanup_name(node_name)
         ou_parent = cls.from_path_recurse(*parent_path)
         ou, _ = cls.objects.get_or_create(name__iexact=node_name, parent=ou_parent, defaults={'name':node_name})
         return ou
 
+    def save(self, *args, **kwargs):
+        from facilities import hierarchy
+        from facilities.paths import child_path_key, move_path_keys
+        from facilities.search import normalize_name
+
+        self.set_location_fields()
+        self.search_name = normalize_name(self.name)
+        # stored rows, the instances in memory may predate a rename or move further up the tree
+        stored = hierarchy.stored_rows([self.pk, self.parent_id])
+        before, parent_row = stored.get(self.pk), stored.get(self.parent_id)
+        self.path_key = child_path_key(parent_row['path_key'] if parent_row else '', self.name)
+        for field, value in hierarchy.child_ancestor_values(parent_row).items():
+            setattr(self, field, value)
+        if kwargs.get('update_fields') is not None:
+            update_fields = set(kwargs['update_fields'])
+            if 'geometry_str' in update_fields:
+                update_fields |= set(LOCATION_FIELDS)
+            if update_fields & {'name', 'parent'}:
+                update_fields.add('path_key')
+            if 'name' in update_fields:
+                update_fields.add('search_name')
+            if 'parent' in update_fields:
+                update_fields.update(hierarchy.ancestor_columns())
+            kwargs['update_fields'] = update_fields
+        self._stored_row = before # for the post_save receivers
+        super().save(*args, **kwargs)
+        if before is not None:
+            if before['path_key'] and before['path_key'] != self.path_key:
+                move_path_keys(before['path_key'], self.path_key) # renamed or moved
+            hierarchy.update_descendants(self, before)
+
+    def set_location_fields(self):
+        for field, value in location_fields(self.geometry_str).items():
+            setattr(self, field, value)
+
+    @classmethod
+    def nearest(cls, lat, lon, k=10, radius_km=None, queryset=None):
+        '''
+        Orgunits with point coordinates closest to (lat, lon), as a list of
+        (distance_km, orgunit) nearest first. Limited to `k` results and/or to
+        those within `radius_km`.
+
+        Candidates come from the 3x3 block of geohash cells around the point,
+        using coarser cells until enough results are found within the
+        distance that block is guaranteed to cover.
+        '''
+        if queryset is None:
+            queryset = cls.objects.all()
+        queryset = queryset.exclude(geocell='')
+
+        precision = GEOHASH_PRECISION - 1
+        if radius_km is not None:
+            while precision > 1 and geohash_covered_radius_km(lat, precision) < radius_km:
+                precision -= 1
+
+        while True:
+            covered_km = geohash_covered_radius_km(lat, precision)
+            if radius_km is not None and covered_km < radius_km:
+                # farther than the coarsest cells reach, every point is a candidate
+                points, covered_km = queryset, radius_km
+            else:
+                cell_filter = Q()
+                for cell in geohash_neighbourhood(lat, lon, precision):
+                    lower, upper = geohash_prefix_range(cell)
+                    cell_range = Q(geocell__gte=lower)
+                    if upper is not None:
+                        cell_range &= Q(geocell__lt=upper)
+                    cell_filter |= cell_range
+                points = queryset.filter(cell_filter)
+            candidates = sorted(
+                (haversine_km(lat, lon, ou_lat, ou_lon), pk)
+                for pk, ou_lat, ou_lon in points.values_list('pk', 'latitude', 'longitude')
+            )
+            max_distance = covered_km if radius_km is None else min(radius_km, covered_km)
+            found = [(distance, pk) for distance, pk in candidates if distance <= max_distance]
+            if radius_km is not None or precision == 1 or (k is not None and len(found) >= k):
+                break
+            precision -= 1
+
+        if precision == 1 and radius_km is None and (k is None or len(found) < k):
+            found = candidates # precision 1 cells are ~5000km, settle for what they hold
+
+        if k is not None:
+            found = found[:k]
+        orgunits = cls.objects.in_bulk([pk for _, pk in found])
+        return [(distance, orgunits[pk]) for distance, pk in found]
+
+    @classmethod
+    def find_proximity(cls, lat, lon, k=10, radius_km=None, queryset=None):
+        '''
+        Given a set of coordinates, return the orgunits that might match at all
+        levels: the nearest orgunits and, for every level above them, the
+        enclosing admin units ranked by the distance of their closest member.
+        Returns (nearest, {level_field: [(distance_km, orgunit), ...]}).
+        '''
+        nearest = cls.nearest(lat, lon, k=k, radius_km=radius_km, queryset=queryset)
+        by_level = OrderedDict((cls.get_level_field(level), []) for level in sorted(settings.ORG_UNIT_LEVELS))
+        if not nearest:
+            return nearest, by_level
+
+        # ancestors of all the nearest orgunits in one nested-set query
+        ancestor_filter = Q()
+        for _, ou in nearest:
+            ancestor_filter |= Q(tree_id=ou.tree_id, lft__lt=ou.lft, rght__gt=ou.rght)
+        ancestors = list(cls.objects.filter(ancestor_filter))
+
+        closest = {}
+        for distance, ou in nearest:
+            for ancestor in ancestors:
+                if ancestor.tree_id == ou.tree_id and ancestor.lft < ou.lft and ancestor.rght > ou.rght:
+                    closest[ancestor.pk] = min(distance, closest.get(ancestor.pk, distance))
+        for ancestor in sorted(ancestors, key=lambda x: (closest[x.pk], x.name)):
+            by_level[cls.get_level_field(ancestor.level)].append((closest[ancestor.pk], ancestor))
+
+        return nearest, OrderedDict((level, units) for level, units in by_level.items() if units)
+
     @staticmethod
     def level_names(max_level=None):
         if max_level is None:
@@ -152,15 +337,30 @@ class OrgUnit(MPTTModel):
     @staticmethod
     def level_dbfields(max_level=None, *ignore, prefix=''):
         if max_level is None:
-            level_count = len(settings.ORG_UNIT_LEVELS)
-        else:
-            level_count = max_level + 1
-        return tuple(reversed([prefix+(''.join(('parent__',)*i)+'name') for i in range(level_count)]))
+            max_level = max(settings.ORG_UNIT_LEVELS)
+        # names of the ancestors come from the denormalized columns, no self-joins
+        ancestor_fields = OrgUnit.ancestor_fields()
+        return tuple(prefix+ancestor_fields[i][1] for i in range(max_level) if i in ancestor_fields) + (prefix+'name',)
 
     @staticmethod
     def level_annotations(max_level=None, *ignore, prefix=''):
         return dict(zip(OrgUnit.level_fields(max_level), [F(f) for f in OrgUnit.level_dbfields(max_level, prefix=prefix)]))
 
+    @staticmethod
+    def ancestor_fields():
+        '''
+        Denormalized ancestor columns, {level: (id_field, name_field)} such as
+        {3: ('district_id', 'district_name')}, for every level but the lowest
+        '''
+        return OrderedDict((level, (OrgUnit.get_level_field(level)+'_id', OrgUnit.get_level_field(level)+'_name')) for level in sorted(settings.ORG_UNIT_LEVELS)[:-1])
+
+    @property
+    def hierarchy(self):
+        '''
+        Names of the ancestors by level field, root first
+        '''
+        return OrderedDict((self.get_level_field(level), getattr(self, name_field)) for level, (_, name_field) in self.ancestor_fields().items() if getattr(self, name_field))
+
     @staticmethod
     def get_level_field(level):
         #TODO: escape/replace any characters that would be an invalid field name
@@ -182,3 +382,303 @@ class OrgUnit(MPTTModel):
 
     def __str__(self):
         return '%s [parent_id: %s]' % (self.name, str(self.parent_id),)
+
+# Denormalized ancestors, <level>_id and <level>_name for every level of settings.ORG_UNIT_LEVELS but the
+# lowest (e.g. district_id/district_name), so hierarchy listings and filters need no parent__parent__... joins.
+# Maintained by OrgUnit.save() and facilities.hierarchy. Changing ORG_UNIT_LEVELS needs a new migration.
+for _level, (_id_field, _name_field) in OrgUnit.ancestor_fields().items():
+    OrgUnit.add_to_class(_id_field, models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='%s id' % settings.ORG_UNIT_LEVELS[_level].lower()))
+    OrgUnit.add_to_class(_name_field, models.CharField(max_length=96, blank=True, default='', editable=False, verbose_name='%s name' % settings.ORG_UNIT_LEVELS[_level].lower()))
+
+class OrgUnitGeometry(models.Model):
+    '''
+    Simplified copy of an orgunit's boundary (any geometry but a point) at
+    one of the resolutions of facilities.boundaries, for maps that don't need
+    every vertex. Derived from OrgUnit.geometry_str when it's saved, the
+    source hash tells whether it still matches.
+    '''
+    LOW = 1
+    MEDIUM = 2
+    HIGH = 3
+    RESOLUTION_CHOICES = (
+        (LOW, 'low'),
+        (MEDIUM, 'medium'),
+        (HIGH, 'high'),
+    )
+
+    orgunit_id = models.IntegerField(db_index=True)
+    resolution = models.PositiveSmallIntegerField(choices=RESOLUTION_CHOICES)
+    geometry_str = models.TextField(verbose_name='geometry (GeoJSON string)')
+    source_hash = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = (('orgunit_id', 'resolution'),)
+        verbose_name = 'orgunit geometry'
+
+    def __str__(self):
+        return '%d: %s' % (self.orgunit_id, self.get_resolution_display())
+
+class OrgUnitNameGram(models.Model):
+    '''
+    Trigram index of the orgunit names for facilities.search: one row per
+    distinct trigram of OrgUnit.search_name. A plain table, so it works the
+    same on every database without extensions. No foreign key, it's
+    maintained by facilities.search (which deletes without signals).
+    '''
+    orgunit_id = models.IntegerField(db_index=True)
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        index_together = (('gram', 'orgunit_id'),)
+        verbose_name = 'orgunit name trigram'
+
+    def __str__(self):
+        return '%d: %r' % (self.orgunit_id, self.gram)
+
+class OrgUnitChange(models.Model):
+    '''
+    Append-only log of orgunit writes. Deletions stay in the log as
+    tombstones after the orgunit itself is gone (hence no foreign key).
+
+    `seq` is the change sequence that downstream systems page through. It is
+    given out in commit order, not at insert like the primary key: a long
+    transaction (an import) allocates low ids but may commit after shorter
+    ones with higher ids, and a client that synced in between would skip
+    its changes for good. Changes are numbered once committed (see
+    assign_sequence), until then they are invisible to the feed and the
+    data version.
+    '''
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ACTION_CHOICES = (
+        (CREATED, 'Created'),
+        (UPDATED, 'Updated'),
+        (DELETED, 'Deleted'),
+    )
+
+    orgunit_id = models.IntegerField(db_index=True)
+    uuid = models.UUIDField(db_index=True)
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES)
+    changed_at = models.DateTimeField(default=timezone.now, db_index=True)
+    seq = models.BigIntegerField(null=True, blank=True, unique=True, editable=False, verbose_name='sequence number')
+
+    SEQUENCE_LOCK = 7105 # PostgreSQL advisory lock serializing assign_sequence()
+
+    class Meta:
+        verbose_name = 'organisation unit change'
+
+    @classmethod
+    def data_version(cls):
+        '''
+        Sequence number of the latest change, increases with every committed
+        write to the registry. Cheap (max of an indexed column) and usable as
+        a cache key.
+        '''
+        return cls.objects.aggregate(version=models.Max('seq'))['version'] or 0
+
+    @classmethod
+    def latest_change(cls):
+        '''
+        (data version, time of the change) of the latest change, (0, None)
+        while the log is empty
+        '''
+        return cls.objects.filter(seq__isnull=False).order_by('-seq').values_list('seq', 'changed_at').first() or (0, None)
+
+    @classmethod
+    def assign_sequence(cls):
+        '''
+        Number the committed changes without a sequence number, in id order
+        and after every numbered one. Returns the number of changes numbered.
+        '''
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # one at a time, the next one has to see the numbers given out
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [cls.SEQUENCE_LOCK])
+            cursor.execute(
+                'UPDATE {0} SET seq = (SELECT COALESCE(MAX(seq), 0) FROM {0}) + 1 + id - (SELECT MIN(id) FROM {0} WHERE seq IS NULL) '
+                'WHERE seq IS NULL'.format(table)
+            )
+            return cursor.rowcount
+
+    @classmethod
+    def record(cls, action, orgunits):
+        '''
+        Log `action` for an iterable of (pk, uuid) pairs with one bulk insert
+        '''
+        from facilities.snapshot import expire_snapshot
+
+        changed_at = timezone.now()
+        cls.objects.bulk_create([cls(orgunit_id=pk, uuid=ou_uuid, action=action, changed_at=changed_at) for pk, ou_uuid in orgunits], batch_size=500)
+        if connection.vendor == 'sqlite':
+            # one writer at a time, nothing can commit before this transaction does
+            cls.assign_sequence()
+        elif not any(func == cls.assign_sequence for _, func in connection.run_on_commit):
+            transaction.on_commit(cls.assign_sequence)
+        # this process sees its own writes at once, other threads once they're committed
+        expire_snapshot()
+        transaction.on_commit(expire_snapshot)
+
+    def __str__(self):
+        return '%s: %s %s' % (self.seq, self.action, self.uuid)
+
+class OrgUnitSummary(models.Model):
+    '''
+    Materialized orgunit counts for the dashboards, one row per combination of
+    level, type, ownership, authority and enclosing region/district (0 when
+    there is none). Maintained by facilities.summary.
+    '''
+    level = models.PositiveIntegerField()
+    orgunit_type = models.CharField(max_length=16)
+    ownership = models.CharField(max_length=16)
+    authority = models.CharField(max_length=16)
+    region_id = models.IntegerField(default=0)
+    district_id = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+    with_coordinates = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('level', 'orgunit_type', 'ownership', 'authority', 'region_id', 'district_id'),)
+        verbose_name = 'organisation unit summary'
+        verbose_name_plural = 'organisation unit summaries'
+
+    def __str__(self):
+        return '%s/%s/%s/%s region: %d district: %d = %d' % (self.level, self.orgunit_type, self.ownership, self.authority, self.region_id, self.district_id, self.count)
+
+class AuditChangeSet(models.Model):
+    '''
+    One audit record for a whole bulk operation (an import, a restructuring,
+    an API batch) instead of a CRUD event per saved row. The per-object
+    changes are kept zlib-compressed, see facilities.audit.
+    '''
+    operation = models.CharField(max_length=64, db_index=True)
+    description = models.TextField(blank=True, default='')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    started_at = models.DateTimeField(default=timezone.now, db_index=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    object_count = models.IntegerField(default=0)
+    counts = models.TextField(blank=True, default='') # JSON: {model label: {action: count}}
+    changes = models.BinaryField(blank=True, default=b'')
+
+    class Meta:
+        ordering = ['-started_at']
+        verbose_name = 'audit change set'
+
+    def get_counts(self):
+        return json.loads(self.counts) if self.counts else {}
+
+    def get_changes(self):
+        '''
+        {model label: {action: [[pk, detail], ...]}}, the detail being the
+        object's text for creations and deletions and {field: [old, new]}
+        for updates
+        '''
+        return json.loads(zlib.decompress(bytes(self.changes)).decode()) if self.changes else {}
+
+    def __str__(self):
+        return '%s %s (%d objects)' % (self.operation, self.started_at, self.object_count)
+
+class DuplicateCandidate(models.Model):
+    '''
+    Two facilities that may be the same one, as found by facilities.duplicates
+    (orgunit_a_id < orgunit_b_id). Later runs rescore open pairs and keep the
+    review decision of confirmed and dismissed ones.
+    '''
+    OPEN = 'open'
+    CONFIRMED = 'confirmed'
+    DISMISSED = 'dismissed'
+    STATUS_CHOICES = (
+        (OPEN, 'Open'),
+        (CONFIRMED, 'Confirmed duplicate'),
+        (DISMISSED, 'Not a duplicate'),
+    )
+
+    orgunit_a_id = models.IntegerField(db_index=True)
+    orgunit_b_id = models.IntegerField(db_index=True)
+    score = models.FloatField(db_index=True)
+    name_similarity = models.FloatField()
+    distance_km = models.FloatField(null=True, blank=True)
+    reasons = models.CharField(max_length=200, blank=True, default='')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=OPEN, db_index=True)
+    detected_at = models.DateTimeField(default=timezone.now)
+    reviewed_at = models.DateTimeField(null=True, blank=True)
+    reviewed_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        unique_together = (('orgunit_a_id', 'orgunit_b_id'),)
+        verbose_name = 'duplicate candidate'
+
+    def __str__(self):
+        return '%d/%d: %.2f %s' % (self.orgunit_a_id, self.orgunit_b_id, self.score, self.status)
+
+class DuplicateScan(models.Model):
+    '''
+    One run of the duplicate detection. `change_id` is the change log
+    position it covers, the next incremental run starts from there.
+    '''
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    change_id = models.BigIntegerField(default=0)
+    full = models.BooleanField(default=False)
+    orgunits_checked = models.IntegerField(default=0)
+    pairs_compared = models.IntegerField(default=0)
+    candidates = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'duplicate scan'
+
+    def __str__(self):
+        return '%s: %d orgunits, %d candidates' % (self.started_at, self.orgunits_checked, self.candidates)
+
+class OrgUnitExtent(models.Model):
+    '''
+    Crude extent of an admin unit without a boundary polygon, derived from
+    the coordinates of the facilities below it leaving out the outliers, so
+    those can still be checked (see facilities.placement). Rebuilt by every
+    full placement check.
+    '''
+    orgunit_id = models.IntegerField(unique=True)
+    level = models.PositiveIntegerField()
+    west = models.FloatField()
+    south = models.FloatField()
+    east = models.FloatField()
+    north = models.FloatField()
+    # median facility position, ranks overlapping extents
+    centre_lat = models.FloatField()
+    centre_lon = models.FloatField()
+    facility_count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'orgunit extent'
+
+    def __str__(self):
+        return '%d: %.4f,%.4f %.4f,%.4f' % (self.orgunit_id, self.west, self.south, self.east, self.north)
+
+class MisplacedFacility(models.Model):
+    '''
+    A facility whose coordinates are outside one of its admin units, as found
+    by facilities.placement: the highest such unit (expected), whether its
+    polygon or its derived extent was checked, and the admin unit of the same
+    level that contains the point instead, if any.
+    '''
+    POLYGON = 'polygon'
+    EXTENT = 'extent'
+    METHOD_CHOICES = (
+        (POLYGON, 'Boundary polygon'),
+        (EXTENT, 'Extent of the facilities'),
+    )
+
+    orgunit_id = models.IntegerField(unique=True)
+    level = models.PositiveIntegerField(db_index=True)
+    expected_id = models.IntegerField()
+    found_id = models.IntegerField(null=True, blank=True)
+    method = models.CharField(max_length=8, choices=METHOD_CHOICES)
+    checked_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'misplaced facility'
+        verbose_name_plural = 'misplaced facilities'
+
+    def __str__(self):
+        return '%d: outside %d (%s), in %s' % (self.orgunit_id, self.expected_id, self.method, self.found_id)
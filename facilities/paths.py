@@ -0,0 +1,119 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import CharField, Value
+from django.db.models.functions import Concat, Substr
+
+from functools import partial
+import hashlib
+
+from facilities.bulk import bulk_fetch, bulk_update
+from facilities.models import OrgUnit, orgunit_cleanup_name
+
+# Path -> orgunit resolution. Every orgunit stores its normalized full path in
+# the indexed OrgUnit.path_key column, so resolving a path is one indexed
+# lookup. Results (primary keys only, never model instances) are kept in the
+# Django cache, which all worker processes share when CACHES points at
+# memcached/redis. Renames, moves and deletes drop the affected entries, again
+# when they commit.
+
+PATH_SEPARATOR = '/'
+CACHE_PREFIX = 'orgunit_path:'
+CACHE_TIMEOUT = 24*60*60
+
+def path_key(path_parts):
+    """
+    Normalized form of an orgunit path (root first): names cleaned up with
+    orgunit_cleanup_name and lowercased, since names are matched with iexact
+    """
+    return PATH_SEPARATOR.join((orgunit_cleanup_name(p) or '').lower() for p in path_parts)
+
+def child_path_key(parent_key, name):
+    name_key = path_key([name])
+    return parent_key + PATH_SEPARATOR + name_key if parent_key else name_key
+
+def cache_key(key):
+    # paths are long and contain spaces, neither of which memcached accepts
+    return CACHE_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def resolve_paths(paths):
+    """
+    Primary keys of the orgunits at `paths` (iterables of names), as a dict
+    path key -> pk. Paths that don't exist are left out.
+    """
+    keys = set(path_key(p) for p in paths)
+    cached = cache.get_many([cache_key(k) for k in keys])
+    resolved = dict((k, cached[cache_key(k)]) for k in keys if cache_key(k) in cached)
+
+    missing = sorted(keys - set(resolved))
+    found = {}
+    for key, pk in bulk_fetch(OrgUnit.objects.order_by('-pk'), 'path_key', missing, 'path_key', 'pk'):
+        found[key] = pk # lowest pk wins when names only differ by case
+    if found:
+        cache.set_many(dict((cache_key(k), pk) for k, pk in found.items()), CACHE_TIMEOUT)
+    resolved.update(found)
+    return resolved
+
+def resolve_path(path_parts):
+    """
+    Primary key of the orgunit at `path_parts`, None if there is none
+    """
+    return resolve_paths([path_parts]).get(path_key(path_parts))
+
+def forget_paths(keys):
+    """
+    Drop the cached resolutions of the path `keys`, now for lookups in this
+    transaction and again once it commits: a concurrent resolve_paths() still
+    sees the old rows until then and may have cached them again
+    """
+    cache_keys = [cache_key(k) for k in keys]
+    if cache_keys:
+        cache.delete_many(cache_keys)
+        transaction.on_commit(partial(cache.delete_many, cache_keys))
+
+def move_path_keys(old_key, new_key):
+    """
+    An orgunit was renamed or moved from `old_key` to `new_key`: rewrite the
+    path of everything below it with one UPDATE and drop the old paths from
+    the cache
+    """
+    descendants = OrgUnit._base_manager.filter(path_key__startswith=old_key + PATH_SEPARATOR)
+    old_keys = [old_key] + list(descendants.values_list('path_key', flat=True))
+    descendants.update(path_key=Concat(Value(new_key), Substr('path_key', len(old_key)+1), output_field=CharField()))
+    forget_paths(old_keys)
+
+def compute_path_keys(nodes):
+    """
+    Given `nodes` as an iterable of (pk, parent_pk, name) compute the path key
+    of every node from the parent links. Returns a dict pk -> path key.
+    """
+    nodes = dict((pk, (parent_pk, name)) for pk, parent_pk, name in nodes)
+    keys = {}
+    for pk in nodes:
+        # walk up to the first node with a known path, then back down
+        chain = []
+        ancestor_pk = pk
+        while ancestor_pk is not None and ancestor_pk not in keys:
+            chain.append(ancestor_pk)
+            ancestor_pk = nodes[ancestor_pk][0]
+        parent_key = keys.get(ancestor_pk, '')
+        for node_pk in reversed(chain):
+            keys[node_pk] = parent_key = child_path_key(parent_key, nodes[node_pk][1])
+    return keys
+
+def rebuild_path_keys(orgunit_model=OrgUnit):
+    """
+    Recompute the stored path of every orgunit with a single SELECT, writing
+    back only the rows that changed, and clear their cached resolutions.
+    For bulk writers that bypass save(). Returns the number of rows updated.
+    """
+    current = {}
+    nodes = []
+    for pk, parent_pk, name, key in orgunit_model._base_manager.values_list('pk', 'parent_id', 'name', 'path_key').iterator():
+        nodes.append((pk, parent_pk, name))
+        current[pk] = key
+
+    changed = [(pk, {'path_key': key}) for pk, key in compute_path_keys(nodes).items() if current[pk] != key]
+    if changed:
+        bulk_update(orgunit_model, changed, ('path_key',))
+        forget_paths(set(current[pk] for pk, _ in changed if current[pk]))
+    return len(changed)
@@ -0,0 +1,347 @@
+from django.db import transaction
+from django.db.models import Q
+from django.conf import settings
+from django.utils import timezone
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import math
+import threading
+
+from facilities.bulk import bulk_delete, bulk_fetch, chunked
+from facilities.duplicates import orgunit_rows
+from facilities.geo import parse_geometry, polygon_rings
+from facilities.models import MisplacedFacility, OrgUnit, OrgUnitExtent, OrgUnitGeometry
+
+# Spatial validation of the facility coordinates: a facility should be
+# inside every admin unit above it. Each one is checked against
+#
+# - the boundary polygon of the unit, at the high level of detail of
+#   facilities.boundaries (~10m), when it has one
+# - otherwise a crude extent derived from the coordinates of the facilities
+#   below it, stored as OrgUnitExtents by every full check. For the units
+#   directly above facilities that is the quartiles widened by EXTENT_FENCE
+#   times the interquartile range (so the outliers being looked for don't
+#   stretch it), the units above those get the box around their extents.
+#
+# The bounding box of a unit is tested first, the polygon test then only
+# looks at the edges in the horizontal strip of the point. A facility
+# outside one of its units is kept as a MisplacedFacility with the highest
+# such unit and the unit of the same level that contains the point instead,
+# looked up in a grid index of the units' bounding boxes.
+#
+# orgunit_load runs a full check after writing (if it wrote anything),
+# single saves of a facility check it (with the stored extents), a new
+# boundary rechecks the facilities below the unit. Saves inside
+# deferred_checks() leave it to the full check.
+
+MIN_EXTENT_FACILITIES = 8 # fewer facilities make no extent, their box only widens the units above
+EXTENT_FENCE = 1.5 # interquartile ranges beyond the quartiles, Tukey's fences
+EXTENT_MIN_MARGIN = 0.05 # degrees (~5km), for units with closely grouped facilities
+GRID_SIZE = 0.25 # degrees, cells of the bounding box index
+MAX_GRID_CELLS = 4096 # larger bounding boxes are tried for every point
+EDGES_PER_STRIP = 8
+
+_local = threading.local()
+
+@contextmanager
+def deferred_checks():
+    """
+    Skip the checks on save in the block, for writers that run a full
+    check_placement() afterwards
+    """
+    deferred = getattr(_local, 'deferred', False)
+    _local.deferred = True
+    try:
+        yield
+    finally:
+        _local.deferred = deferred
+
+def checks_deferred():
+    return getattr(_local, 'deferred', False)
+
+def ancestor_levels():
+    """
+    (level, id field) of the admin levels a facility is checked against,
+    highest first
+    """
+    return [(level, id_field) for level, (id_field, _) in OrgUnit.ancestor_fields().items()]
+
+class PolygonIndex:
+    """
+    Point in (multi)polygon test by ray casting, against the edges of one
+    horizontal strip of the polygon instead of all of them
+    """
+    def __init__(self, rings):
+        edges = []
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                if y1 != y2: # horizontal edges never cross the ray
+                    edges.append((x1, y1, x2, y2))
+        xs = [x for ring in rings for x, _ in ring]
+        ys = [y for ring in rings for _, y in ring]
+        self.west, self.south, self.east, self.north = min(xs), min(ys), max(xs), max(ys)
+        self.strip_count = max(1, len(edges) // EDGES_PER_STRIP)
+        self.strip_height = (self.north - self.south) / self.strip_count or 1.0
+        self.strips = [[] for _ in range(self.strip_count)]
+        for edge in edges:
+            for strip in range(self.strip(min(edge[1], edge[3])), self.strip(max(edge[1], edge[3])) + 1):
+                self.strips[strip].append(edge)
+
+    def strip(self, lat):
+        return max(0, min(self.strip_count - 1, int((lat - self.south) / self.strip_height)))
+
+    def contains(self, lat, lon):
+        inside = False
+        for x1, y1, x2, y2 in self.strips[self.strip(lat)]:
+            if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+class AdminArea:
+    """
+    The area a facility of an admin unit should be in: a polygon or an
+    extent
+    """
+    __slots__ = ('pk', 'level', 'method', 'west', 'south', 'east', 'north', 'polygon', 'centre')
+
+    def __init__(self, pk, level, method, bbox, polygon=None, centre=None):
+        self.pk = pk
+        self.level = level
+        self.method = method
+        self.west, self.south, self.east, self.north = bbox
+        self.polygon = polygon
+        self.centre = centre
+
+    def contains(self, lat, lon):
+        if not (self.south <= lat <= self.north and self.west <= lon <= self.east):
+            return False
+        return self.polygon is None or self.polygon.contains(lat, lon)
+
+class AreaGrid:
+    """
+    Spatial index of AdminAreas: the areas whose bounding box overlaps each
+    GRID_SIZE cell
+    """
+    def __init__(self, areas):
+        self.cells = {}
+        self.large = []
+        for area in areas:
+            x0, x1 = int(math.floor(area.west / GRID_SIZE)), int(math.floor(area.east / GRID_SIZE))
+            y0, y1 = int(math.floor(area.south / GRID_SIZE)), int(math.floor(area.north / GRID_SIZE))
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_GRID_CELLS:
+                self.large.append(area)
+                continue
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    self.cells.setdefault((x, y), []).append(area)
+
+    def containing(self, lat, lon, level):
+        """
+        The area of `level` containing (lat, lon), None if there is none.
+        Polygons win over extents, which may overlap; of those the one with
+        the closest centre is taken.
+        """
+        cell = (int(math.floor(lon / GRID_SIZE)), int(math.floor(lat / GRID_SIZE)))
+        found = [area for area in self.cells.get(cell, []) + self.large if area.level == level and area.contains(lat, lon)]
+        if not found:
+            return None
+        return min(found, key=lambda a: (a.method != MisplacedFacility.POLYGON, (a.centre[0] - lat)**2 + (a.centre[1] - lon)**2 if a.centre else 0))
+
+def fenced_range(values):
+    """
+    (low, high, median) of a list of coordinates, the quartiles widened by
+    EXTENT_FENCE interquartile ranges (EXTENT_MIN_MARGIN at least)
+    """
+    values.sort()
+    n = len(values)
+    q1, median, q3 = values[n // 4], values[n // 2], values[(3 * n) // 4]
+    margin = max((q3 - q1) * EXTENT_FENCE, EXTENT_MIN_MARGIN)
+    return q1 - margin, q3 + margin, median
+
+def derive_extents(facilities, skip=()):
+    """
+    OrgUnitExtents of the admin units (but those in `skip`) above the
+    facility rows. The extent of the unit directly above facilities is
+    fenced, if there are at least MIN_EXTENT_FACILITIES of them; the units
+    higher up get the bounding box of the ones below, as clustered positions
+    are no good for fences.
+    """
+    levels = ancestor_levels()
+    parents = {} # pk of the unit directly above facilities -> ([(level, pk) of it and its ancestors], [lat, ...], [lon, ...])
+    for row in facilities:
+        ancestors = [(level, pk) for (level, _), pk in zip(levels, row[3:]) if pk is not None]
+        if ancestors:
+            parent = parents.setdefault(ancestors[-1][1], (ancestors, [], []))
+            parent[1].append(row[1])
+            parent[2].append(row[2])
+
+    boxes = {} # pk -> [level, west, south, east, north, facilities, sum of centre lat, sum of centre lon]
+    for ancestors, lats, lons in parents.values():
+        count = len(lats)
+        if count >= MIN_EXTENT_FACILITIES:
+            south, north, centre_lat = fenced_range(lats)
+            west, east, centre_lon = fenced_range(lons)
+        else:
+            south, north, centre_lat = min(lats), max(lats), sum(lats) / count
+            west, east, centre_lon = min(lons), max(lons), sum(lons) / count
+        for level, pk in ancestors:
+            box = boxes.get(pk)
+            if box is None:
+                boxes[pk] = [level, west, south, east, north, count, centre_lat * count, centre_lon * count]
+            else:
+                box[1:] = [min(box[1], west), min(box[2], south), max(box[3], east), max(box[4], north),
+                    box[5] + count, box[6] + centre_lat * count, box[7] + centre_lon * count]
+
+    return [
+        OrgUnitExtent(
+            orgunit_id=pk, level=level, west=west, south=south, east=east, north=north,
+            centre_lat=lat_sum / count, centre_lon=lon_sum / count, facility_count=count,
+        )
+        for pk, (level, west, south, east, north, count, lat_sum, lon_sum) in boxes.items()
+        if count >= MIN_EXTENT_FACILITIES and pk not in skip
+    ]
+
+def extent_area(extent):
+    return AdminArea(
+        extent.orgunit_id, extent.level, MisplacedFacility.EXTENT,
+        (extent.west, extent.south, extent.east, extent.north), centre=(extent.centre_lat, extent.centre_lon)
+    )
+
+def load_areas(bounds=None, pks=(), extents=True):
+    """
+    {pk: AdminArea} of the admin units with a boundary polygon or (with
+    `extents`) a stored extent. Only those overlapping `bounds` (west, south,
+    east, north) and the ones in `pks` if `bounds` is given.
+    """
+    units = OrgUnit.objects.filter(orgunit_type='ADMIN', latitude__isnull=True, bbox_west__isnull=False)
+    extents = OrgUnitExtent.objects.all() if extents else OrgUnitExtent.objects.none()
+    if bounds is not None:
+        west, south, east, north = bounds
+        units = units.filter(Q(bbox_west__lte=east, bbox_east__gte=west, bbox_south__lte=north, bbox_north__gte=south) | Q(pk__in=pks))
+        extents = extents.filter(Q(west__lte=east, east__gte=west, south__lte=north, north__gte=south) | Q(orgunit_id__in=pks))
+    levels = dict(units.values_list('pk', 'level'))
+
+    areas = {}
+    for pk, geometry_str in bulk_fetch(OrgUnitGeometry.objects.filter(resolution=OrgUnitGeometry.HIGH), 'orgunit_id', sorted(levels), 'orgunit_id', 'geometry_str'):
+        rings = polygon_rings(parse_geometry(geometry_str))
+        if rings:
+            polygon = PolygonIndex(rings)
+            areas[pk] = AdminArea(pk, levels[pk], MisplacedFacility.POLYGON, (polygon.west, polygon.south, polygon.east, polygon.north), polygon)
+    for extent in extents.iterator():
+        if extent.orgunit_id not in areas:
+            areas[extent.orgunit_id] = extent_area(extent)
+    return areas
+
+def find_misplaced(facilities, areas, grid):
+    """
+    MisplacedFacility (unsaved) for each facility row outside one of its
+    admin units
+    """
+    levels = ancestor_levels()
+    checked_at = timezone.now()
+    misplaced = []
+    for row in facilities:
+        pk, lat, lon = row[:3]
+        for i, (level, _) in enumerate(levels):
+            area = areas.get(row[3 + i])
+            if area is not None and not area.contains(lat, lon):
+                found = grid.containing(lat, lon, level)
+                misplaced.append(MisplacedFacility(
+                    orgunit_id=pk, level=level, expected_id=area.pk, found_id=found.pk if found is not None else None,
+                    method=area.method, checked_at=checked_at,
+                ))
+                break # the highest unit it's outside of
+    return misplaced
+
+def facility_rows(queryset):
+    """
+    (pk, latitude, longitude, <ancestor ids>...) of the facilities with
+    coordinates in `queryset`
+    """
+    fields = ('pk', 'latitude', 'longitude') + tuple(id_field for _, id_field in ancestor_levels())
+    return list(queryset.exclude(orgunit_type='ADMIN').filter(latitude__isnull=False).values_list(*fields).iterator())
+
+def check_placement(pks=None):
+    """
+    Check the coordinates of the facilities in `pks` against their admin
+    units, all of them by default (which also derives the extents again),
+    and update the stored MisplacedFacilities. Returns counts.
+    """
+    with transaction.atomic():
+        if pks is None:
+            facilities = facility_rows(OrgUnit.objects.all())
+            areas = load_areas(extents=False) # derived again below
+            extents = derive_extents(facilities, skip=set(areas))
+            OrgUnitExtent.objects.all().delete()
+            OrgUnitExtent.objects.bulk_create(extents, batch_size=500)
+            areas.update((extent.orgunit_id, extent_area(extent)) for extent in extents)
+        else:
+            pks = list(pks)
+            facilities = [row for chunk in chunked(pks, 900) for row in facility_rows(OrgUnit.objects.filter(pk__in=chunk))]
+            if facilities:
+                bounds = (min(r[2] for r in facilities), min(r[1] for r in facilities), max(r[2] for r in facilities), max(r[1] for r in facilities))
+                areas = load_areas(bounds, sorted(set(pk for row in facilities for pk in row[3:] if pk is not None)))
+            else:
+                areas = {}
+
+        misplaced = find_misplaced(facilities, areas, AreaGrid(areas.values()))
+        if pks is None:
+            MisplacedFacility.objects.all().delete()
+        else:
+            bulk_delete(MisplacedFacility.objects, 'orgunit_id', pks)
+        MisplacedFacility.objects.bulk_create(misplaced, batch_size=500)
+
+    return OrderedDict([
+        ('facilities_checked', len(facilities)),
+        ('boundary_polygons', sum(1 for area in areas.values() if area.method == MisplacedFacility.POLYGON)),
+        ('derived_extents', sum(1 for area in areas.values() if area.method == MisplacedFacility.EXTENT)),
+        ('facilities_misplaced', len(misplaced)),
+    ])
+
+def facilities_below(orgunit):
+    """
+    pks of the facilities below an admin unit
+    """
+    ancestor_fields = OrgUnit.ancestor_fields()
+    if orgunit.level not in ancestor_fields:
+        return []
+    return OrgUnit.objects.filter(**{ancestor_fields[orgunit.level][0]: orgunit.pk}).exclude(orgunit_type='ADMIN').values_list('pk', flat=True)
+
+def forget_orgunits(pks):
+    bulk_delete(MisplacedFacility.objects, 'orgunit_id', list(pks))
+    bulk_delete(OrgUnitExtent.objects, 'orgunit_id', list(pks))
+
+def placement_report(limit=None, offset=0, level=None):
+    """
+    Misplaced facilities, by level (highest first) and name, as flat dicts
+    for listings and CSV files
+    """
+    misplaced = MisplacedFacility.objects.order_by('level', 'orgunit_id')
+    if level is not None:
+        misplaced = misplaced.filter(level=level)
+    if limit is not None:
+        misplaced = misplaced[offset:offset + limit]
+    elif offset:
+        misplaced = misplaced[offset:]
+    fields = ('orgunit_id', 'level', 'expected_id', 'found_id', 'method', 'checked_at')
+    for chunk in chunked(misplaced.values_list(*fields).iterator(), 1000):
+        orgunits = orgunit_rows([pk for row in chunk for pk in row[:4] if pk is not None])
+        for orgunit_id, level, expected_id, found_id, method, checked_at in chunk:
+            facility, expected, found = orgunits.get(orgunit_id), orgunits.get(expected_id), orgunits.get(found_id)
+            if facility is None or expected is None:
+                continue # deleted since the check
+            yield OrderedDict([
+                ('uuid', str(facility['uuid'])),
+                ('name', facility['name']),
+                ('path', '/'.join(facility['path'])),
+                ('latitude', facility['latitude']),
+                ('longitude', facility['longitude']),
+                ('level', settings.ORG_UNIT_LEVELS.get(level, level)),
+                ('method', method),
+                ('expected_uuid', str(expected['uuid'])),
+                ('expected', '/'.join(expected['path'] + [expected['name']])),
+                ('found_uuid', str(found['uuid']) if found else None),
+                ('found', '/'.join(found['path'] + [found['name']]) if found else None),
+                ('checked_at', checked_at),
+            ])
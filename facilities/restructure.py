@@ -0,0 +1,308 @@
+from django.db import transaction
+from django.utils import timezone
+
+from collections import OrderedDict
+import re
+
+from facilities.audit import CREATED, UPDATED, audit_batch
+from facilities.bulk import bulk_fetch, bulk_update, rebuild_tree
+from facilities.hierarchy import rebuild_ancestor_fields
+from facilities.models import OrgUnit, OrgUnitChange
+from facilities.paths import PATH_SEPARATOR, child_path_key, path_key, rebuild_path_keys
+from facilities.search import index_names, normalize_name
+from facilities.subtree import invalidate_all_subtrees
+from facilities.summary import rebuild_summary
+
+# Administrative boundary changes (district splits, new subcounties, merges)
+# applied as one set of parent changes: every move is planned in memory
+# against a single read of the tree, written with bulk UPDATEs in one
+# transaction, and the nested set and the other derived columns are
+# recomputed once at the end, instead of mptt shifting lft/rght per move.
+#
+# A spec is a dict with any of these lists, REF being an orgunit UUID or its
+# path (a list of names, or a '/' separated string):
+#
+#   "create": [{"parent": REF, "name": "Kampala North"}, ...]
+#   "moves":  [{"orgunit": REF, "parent": REF}, ...]
+#   "splits": [{"orgunit": REF, "into": [{"name": "...", "children": [REF, ...]}, ...]}, ...]
+#   "merges": [{"orgunits": [REF, ...], "into": REF}, ...]
+#
+# Units created by "create" or "splits" can be referred to by path in the
+# rest of the spec. A split creates new siblings of the unit and moves the
+# listed children into them, a merge moves all children of the units into
+# the target and deletes the emptied units.
+
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
+
+class RestructureError(Exception):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+class Restructure:
+    def __init__(self, spec, batch_size=500):
+        self.spec = spec
+        self.batch_size = batch_size
+        self.errors = []
+        self.nodes = {} # pk (or ('new', n) for units to create) -> dict of the tree columns we need
+        self.pk_by_uuid = {}
+        self.pk_by_path = {}
+        self.new_parents = OrderedDict() # pk -> new parent pk, explicit moves (from moves, splits and merges)
+        self.new_units = [] # ('new', n) keys in creation order
+        self.deletes = []
+
+    def error(self, location, message):
+        self.errors.append('{0}: {1}'.format(location, message))
+
+    def load_tree(self):
+        for pk, ou_uuid, parent_id, name, orgunit_type, key in OrgUnit.objects.values_list('pk', 'uuid', 'parent_id', 'name', 'orgunit_type', 'path_key').iterator():
+            self.nodes[pk] = {'parent_id': parent_id, 'name': name, 'orgunit_type': orgunit_type, 'uuid': ou_uuid}
+            self.pk_by_uuid[str(ou_uuid)] = pk
+            self.pk_by_path.setdefault(key, pk)
+
+    def resolve(self, ref, location):
+        if isinstance(ref, str) and UUID_RE.match(ref.strip()):
+            pk = self.pk_by_uuid.get(ref.strip().lower())
+        elif isinstance(ref, str) and ref.strip():
+            pk = self.pk_by_path.get(path_key(ref.split(PATH_SEPARATOR)))
+        elif isinstance(ref, list) and ref and all(isinstance(x, str) for x in ref):
+            pk = self.pk_by_path.get(path_key(ref))
+        else:
+            self.error(location, 'expected a UUID or a path')
+            return None
+        if pk is None:
+            self.error(location, 'orgunit {0} not found'.format(ref))
+        return pk
+
+    def spec_list(self, name):
+        items = self.spec.get(name, [])
+        if not isinstance(items, list) or not all(isinstance(x, dict) for x in items):
+            self.error(name, 'expected a list of objects')
+            return []
+        return items
+
+    def add_unit(self, parent_pk, name, location):
+        if not isinstance(name, str) or not name.strip():
+            self.error(location, 'a name is required')
+            return None
+        key = ('new', len(self.new_units))
+        self.nodes[key] = {'parent_id': parent_pk, 'name': name.strip(), 'orgunit_type': 'ADMIN', 'uuid': None}
+        self.new_units.append(key)
+        self.pk_by_path.setdefault(child_path_key(self.path_key_of(parent_pk), name), key)
+        return key
+
+    def path_key_of(self, pk, parents=None):
+        names = []
+        while pk is not None:
+            names.append(self.nodes[pk]['name'])
+            pk = (parents or {}).get(pk, self.nodes[pk]['parent_id'])
+        return path_key(reversed(names))
+
+    def path_names(self, pk, parents=None):
+        names = []
+        while pk is not None:
+            names.append(self.nodes[pk]['name'])
+            pk = (parents or {}).get(pk, self.nodes[pk]['parent_id'])
+        return PATH_SEPARATOR.join(reversed(names))
+
+    def move(self, pk, parent_pk, location):
+        if pk is None or parent_pk is None:
+            return
+        if isinstance(pk, tuple):
+            self.error(location, '{0} is created by this restructuring, create it under its parent instead'.format(self.path_names(pk)))
+            return
+        if pk in self.new_parents:
+            self.error(location, '{0} is moved more than once'.format(self.path_names(pk)))
+        self.new_parents[pk] = parent_pk
+
+    def plan(self):
+        """
+        Resolve and check the spec against the current tree. Returns the
+        summary of the changes, raises RestructureError if the spec can't be
+        applied.
+        """
+        self.load_tree()
+
+        for i, item in enumerate(self.spec_list('create')):
+            self.add_unit(self.resolve(item.get('parent'), 'create[{0}].parent'.format(i)), item.get('name'), 'create[{0}]'.format(i))
+
+        for i, item in enumerate(self.spec_list('splits')):
+            pk = self.resolve(item.get('orgunit'), 'splits[{0}].orgunit'.format(i))
+            if pk is None:
+                continue
+            for j, part in enumerate(item.get('into') or []):
+                location = 'splits[{0}].into[{1}]'.format(i, j)
+                new_pk = self.add_unit(self.nodes[pk]['parent_id'], part.get('name'), location)
+                for k, child_ref in enumerate(part.get('children') or []):
+                    child_pk = self.resolve(child_ref, '{0}.children[{1}]'.format(location, k))
+                    if child_pk is not None and self.nodes[child_pk]['parent_id'] != pk:
+                        self.error('{0}.children[{1}]'.format(location, k), '{0} is not in {1}'.format(self.path_names(child_pk), self.path_names(pk)))
+                    self.move(child_pk, new_pk, location)
+
+        for i, item in enumerate(self.spec_list('moves')):
+            location = 'moves[{0}]'.format(i)
+            self.move(self.resolve(item.get('orgunit'), location+'.orgunit'), self.resolve(item.get('parent'), location+'.parent'), location)
+
+        children = {}
+        for pk, node in self.nodes.items():
+            children.setdefault(node['parent_id'], []).append(pk)
+        for i, item in enumerate(self.spec_list('merges')):
+            location = 'merges[{0}]'.format(i)
+            target_pk = self.resolve(item.get('into'), location+'.into')
+            for j, ref in enumerate(item.get('orgunits') or []):
+                pk = self.resolve(ref, '{0}.orgunits[{1}]'.format(location, j))
+                if pk is None or target_pk is None:
+                    continue
+                if pk == target_pk or isinstance(pk, tuple) or pk in self.new_parents:
+                    self.error(location, 'can not merge {0} into {1}'.format(self.path_names(pk), self.path_names(target_pk)))
+                    continue
+                for child_pk in children.get(pk, []):
+                    if child_pk not in self.new_parents:
+                        self.move(child_pk, target_pk, location)
+                self.deletes.append(pk)
+
+        if not self.errors:
+            self.check()
+        if self.errors:
+            raise RestructureError(self.errors)
+        return self.summary()
+
+    def check(self):
+        parents = dict((pk, node['parent_id']) for pk, node in self.nodes.items())
+        parents.update(self.new_parents)
+        deleted = set(self.deletes)
+
+        for pk, parent_pk in self.new_parents.items():
+            if self.nodes[parent_pk]['orgunit_type'] != 'ADMIN':
+                self.error(self.path_names(pk), 'the new parent {0} is not an administrative unit'.format(self.path_names(parent_pk)))
+            if parent_pk in deleted:
+                self.error(self.path_names(pk), 'the new parent {0} is merged away'.format(self.path_names(parent_pk)))
+            # the new parent must not be inside the moved unit
+            seen = set()
+            ancestor_pk = parent_pk
+            while ancestor_pk is not None and ancestor_pk not in seen:
+                if ancestor_pk == pk:
+                    self.error(self.path_names(pk), 'can not move a unit into itself')
+                    break
+                seen.add(ancestor_pk)
+                ancestor_pk = parents[ancestor_pk]
+
+        # the name of every unit is unique under its parent, compared like paths are
+        positions = {}
+        for pk, parent_pk in parents.items():
+            if pk not in deleted:
+                positions.setdefault((parent_pk, path_key([self.nodes[pk]['name']])), []).append(pk)
+        for (parent_pk, _), pks in positions.items():
+            if len(pks) > 1 and any(pk in self.new_parents or pk in self.new_units for pk in pks):
+                self.error(self.path_names(pks[0], parents), 'more than one unit with this name')
+
+    def summary(self):
+        parents = dict((pk, node['parent_id']) for pk, node in self.nodes.items())
+        parents.update(self.new_parents)
+        children = {}
+        for pk, parent_pk in parents.items():
+            children.setdefault(parent_pk, []).append(pk)
+        def descendant_count(pk):
+            stack, count = list(children.get(pk, [])), 0
+            while stack:
+                count += 1
+                stack.extend(children.get(stack.pop(), []))
+            return count
+
+        summary = OrderedDict()
+        summary['created'] = [self.path_names(pk, parents) for pk in self.new_units]
+        summary['moved'] = [
+            OrderedDict([
+                ('name', self.nodes[pk]['name']),
+                ('uuid', str(self.nodes[pk]['uuid'])),
+                ('from', self.path_names(self.nodes[pk]['parent_id'])),
+                ('to', self.path_names(parent_pk, parents)),
+                ('descendants', descendant_count(pk)),
+            ])
+            for pk, parent_pk in self.new_parents.items() if parent_pk != self.nodes[pk]['parent_id']
+        ]
+        summary['deleted'] = [self.path_names(pk) for pk in self.deletes]
+        summary['orgunits_moved'] = sum(1 + m['descendants'] for m in summary['moved'])
+        return summary
+
+    def affected_pks(self):
+        """
+        Existing orgunits whose path changes: the moved units and everything
+        below them
+        """
+        children = {}
+        for pk, node in self.nodes.items():
+            children.setdefault(node['parent_id'], []).append(pk)
+        affected = set()
+        stack = [pk for pk, parent_pk in self.new_parents.items() if parent_pk != self.nodes[pk]['parent_id']]
+        while stack:
+            pk = stack.pop()
+            if pk not in affected and not isinstance(pk, tuple):
+                affected.add(pk)
+                stack.extend(children.get(pk, []))
+        return affected - set(self.deletes)
+
+    def lock(self):
+        """
+        Lock the rows of the moved units, their new parents and the merged
+        units for the rest of the transaction
+        """
+        pks = set(self.deletes) | set(self.new_parents) | set(self.new_parents.values()) | set(self.nodes[key]['parent_id'] for key in self.new_units)
+        list(OrgUnit.objects.select_for_update().filter(pk__in=[pk for pk in pks if not isinstance(pk, tuple)]).values_list('pk', flat=True))
+
+    def apply(self):
+        """
+        Plan the spec and write it in one transaction. Returns the summary,
+        with the number of rows whose nested set values changed.
+        """
+        now = timezone.now()
+        with audit_batch('restructure') as audit, transaction.atomic():
+            # plan against the tree as this transaction sees it, then hold
+            # the units it touches: a unit can't be created under or moved
+            # into a locked one until we commit
+            summary = self.plan()
+            self.lock()
+            # new units, parents before children
+            created = {}
+            pending = list(self.new_units)
+            while pending:
+                ready = [key for key in pending if not isinstance(self.nodes[key]['parent_id'], tuple) or self.nodes[key]['parent_id'] in created]
+                units = [
+                    OrgUnit(name=self.nodes[key]['name'], parent_id=created.get(self.nodes[key]['parent_id'], self.nodes[key]['parent_id']), search_name=normalize_name(self.nodes[key]['name']), lft=0, rght=0, tree_id=0, level=0)
+                    for key in ready
+                ]
+                OrgUnit.objects.bulk_create(units, batch_size=self.batch_size)
+                pk_by_uuid = dict(bulk_fetch(OrgUnit.objects, 'uuid', [ou.uuid for ou in units], 'uuid', 'pk'))
+                for key, ou in zip(ready, units):
+                    created[key] = pk_by_uuid[ou.uuid]
+                    self.nodes[key]['uuid'] = ou.uuid
+                    audit.add(OrgUnit, CREATED, created[key], str(ou))
+                index_names((created[key], ou.search_name) for key, ou in zip(ready, units))
+                pending = [key for key in pending if key not in created]
+
+            moves = [
+                (pk, {'parent': created.get(parent_pk, parent_pk), 'updatedAt': now})
+                for pk, parent_pk in self.new_parents.items() if parent_pk != self.nodes[pk]['parent_id']
+            ]
+            bulk_update(OrgUnit, moves, ('parent', 'updatedAt'), batch_size=self.batch_size)
+            for pk, values in moves:
+                audit.add(OrgUnit, UPDATED, pk, {'parent': [self.nodes[pk]['parent_id'], values['parent']]})
+            affected = self.affected_pks()
+            if self.deletes:
+                # anything still below a merged unit was added after the plan,
+                # deleting it would take it (and its facilities) along
+                stray = OrgUnit.objects.filter(parent_id__in=self.deletes).values_list('parent_id', 'name')
+                if stray:
+                    raise RestructureError(['{0}{1}{2}: added while restructuring, apply the spec again'.format(self.path_names(parent_pk), PATH_SEPARATOR, name) for parent_pk, name in stray])
+                OrgUnit.objects.filter(pk__in=self.deletes).delete() # emptied by the moves above, logged by the delete signals (and the audit batch)
+
+            summary['tree_rows_updated'] = rebuild_tree(OrgUnit)
+            rebuild_path_keys()
+            rebuild_ancestor_fields()
+
+            OrgUnitChange.record(OrgUnitChange.CREATED, [(created[key], self.nodes[key]['uuid']) for key in self.new_units])
+            OrgUnitChange.record(OrgUnitChange.UPDATED, sorted((pk, self.nodes[pk]['uuid']) for pk in affected))
+            rebuild_summary()
+            invalidate_all_subtrees()
+
+        return summary
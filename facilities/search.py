@@ -0,0 +1,147 @@
+from django.db.models import Count
+
+from collections import OrderedDict
+import re
+import unicodedata
+
+from facilities.bulk import bulk_delete, bulk_fetch, bulk_update, chunked
+from facilities.models import OrgUnit, OrgUnitNameGram, orgunit_cleanup_name
+
+# Typo-tolerant name search. Every orgunit stores its name normalized
+# (OrgUnit.search_name: cleaned up like the importer does, lowercased, without
+# accents or punctuation) and OrgUnitNameGram holds its trigrams, the words
+# padded like pg_trgm does so that word starts count. A search looks up the
+# trigrams of the query with one grouped query on the index, keeps the
+# orgunits sharing enough of them and ranks those in Python by how much of
+# the query they cover and how similar they are overall, with a bonus for
+# prefix matches (typeahead).
+#
+# OrgUnit.save() and the delete signal keep the index current for single
+# writes, bulk writers set search_name on the rows they write and pass the
+# new and renamed ones to index_names(). rebuild_name_index() checks every
+# orgunit.
+
+# spellings of the facility levels that orgunit_cleanup_name only fixes in its exact case
+NAME_VARIANTS = (
+    (re.compile(r'\bh ?c\b'), 'hc'), # h/c, h.c, h c
+    (re.compile(r'\bhealth cent(re|er)\b'), 'hc'),
+    (re.compile(r'\bhc(iv|ii|iii)\b'), r'hc \1'),
+)
+
+# very frequent words whose trigrams are only used for ranking, unless the query has nothing else
+COMMON_WORDS = frozenset(('hc', 'i', 'ii', 'iii', 'iv', 'clinic', 'hospital', 'health', 'centre', 'center', 'medical', 'district', 'subcounty', 'town', 'council', 'division'))
+
+MIN_SHARED_GRAMS = 0.5 # share of the query trigrams a candidate must have
+CANDIDATES = 200 # candidates ranked per search
+MAX_RESULTS = 50
+
+def normalize_name(name):
+    """
+    Form of a name that searches are matched against
+    """
+    name = orgunit_cleanup_name(name or '') or ''
+    name = ''.join(c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c)).lower()
+    name = re.sub(r'[\W_]+', ' ', name).strip()
+    for pattern, replacement in NAME_VARIANTS:
+        name = pattern.sub(replacement, name)
+    # decomposing (ligatures) and splitting (hciii) can make it longer than the name
+    return name[:OrgUnit._meta.get_field('search_name').max_length].rstrip()
+
+def word_grams(word):
+    padded = '  ' + word + ' '
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+def name_grams(search_name):
+    grams = set()
+    for word in search_name.split():
+        grams |= word_grams(word)
+    return grams
+
+def index_names(names):
+    """
+    (Re)index orgunits given as (pk, search_name) pairs
+    """
+    names = list(names)
+    bulk_delete(OrgUnitNameGram.objects, 'orgunit_id', [pk for pk, _ in names])
+    OrgUnitNameGram.objects.bulk_create(
+        (OrgUnitNameGram(orgunit_id=pk, gram=gram) for pk, search_name in names for gram in sorted(name_grams(search_name))),
+        batch_size=500
+    )
+
+def unindex_orgunits(pks):
+    bulk_delete(OrgUnitNameGram.objects, 'orgunit_id', list(pks))
+
+def rebuild_name_index(orgunit_model=OrgUnit, gram_model=OrgUnitNameGram):
+    """
+    Recompute the search name of every orgunit with a single SELECT, writing
+    back and reindexing only the ones that changed (all of them when the
+    index is first built). Returns the number of orgunits reindexed.
+    """
+    changed = []
+    for pk, name, search_name in orgunit_model._base_manager.values_list('pk', 'name', 'search_name').iterator():
+        normalized = normalize_name(name)
+        if normalized != search_name:
+            changed.append((pk, {'search_name': normalized}))
+    if changed:
+        bulk_update(orgunit_model, changed, ('search_name',))
+        for batch in chunked(changed, 1000):
+            bulk_delete(gram_model.objects, 'orgunit_id', [pk for pk, _ in batch])
+            gram_model.objects.bulk_create(
+                (gram_model(orgunit_id=pk, gram=gram) for pk, values in batch for gram in sorted(name_grams(values['search_name']))),
+                batch_size=500
+            )
+    return len(changed)
+
+def query_grams(search_name):
+    """
+    Trigrams to look up for a normalized query: those of its uncommon words,
+    all of them if it has none
+    """
+    words = search_name.split()
+    lookup_words = [w for w in words if w not in COMMON_WORDS] or words
+    grams = set()
+    for word in lookup_words:
+        grams |= word_grams(word)
+    return grams
+
+def score(query, query_all_grams, search_name):
+    """
+    Rank of a candidate: the share of the query trigrams it has, plus half
+    its trigram similarity to the query as a whole, plus a bonus when the
+    query is a prefix of the name (or of its words)
+    """
+    grams = name_grams(search_name)
+    shared = len(query_all_grams & grams)
+    value = shared / len(query_all_grams) + 0.5 * shared / len(query_all_grams | grams)
+    if search_name.startswith(query):
+        value += 0.5
+    else:
+        words = search_name.split()
+        if all(any(w.startswith(q) for w in words) for q in query.split()):
+            value += 0.25
+    return value
+
+def search_orgunits(query, queryset=None, limit=10, fields=('pk', 'name')):
+    """
+    Orgunits whose names best match `query`, as a list of (score, values
+    dict of `fields`), best first. `queryset` restricts the orgunits searched
+    (e.g. to the descendants of an ancestor, or to a type).
+    """
+    query = normalize_name(query)
+    grams = query_grams(query)
+    if not grams:
+        return []
+
+    hits = OrgUnitNameGram.objects.filter(gram__in=grams)
+    if queryset is not None and queryset.query.has_filters():
+        hits = hits.filter(orgunit_id__in=queryset.order_by().values('pk'))
+    candidates = hits.values('orgunit_id').annotate(shared=Count('pk')).filter(shared__gte=max(1, round(len(grams) * MIN_SHARED_GRAMS)))
+    candidate_pks = [row['orgunit_id'] for row in candidates.order_by('-shared', 'orgunit_id')[:CANDIDATES]]
+
+    all_grams = name_grams(query)
+    results = []
+    for values in bulk_fetch(OrgUnit.objects, 'pk', candidate_pks, *(('search_name',) + tuple(fields))):
+        row = OrderedDict(zip(fields, values[1:]))
+        results.append((round(score(query, all_grams, values[0]), 4), row))
+    results.sort(key=lambda r: (-r[0], len(r[1].get('name', '')), r[1].get('pk', 0)))
+    return results[:limit]
@@ -0,0 +1,132 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from facilities.models import Identifier, OrgUnit, OrgUnitChange
+from facilities import boundaries, paths, placement, search, subtree, summary, tiles
+
+# Feed every orgunit and identifier write into the change log (which also
+# versions the registry for conditional requests) and the dashboard summary.
+# Bulk writers (orgunit_load --bulk) bypass these signals and call
+# OrgUnitChange.record(), summary.rebuild_summary(), search.index_names(),
+# subtree.invalidate_all_subtrees(), tiles.invalidate_tiles() and
+# boundaries.store_geometries() themselves, orgunit_load then runs a full
+# placement.check_placement().
+
+@receiver(post_save, sender=OrgUnit)
+def log_orgunit_save(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        OrgUnitChange.record(OrgUnitChange.CREATED if created else OrgUnitChange.UPDATED, [(instance.pk, instance.uuid)])
+
+@receiver(post_delete, sender=OrgUnit)
+def log_orgunit_delete(sender, instance, **kwargs):
+    OrgUnitChange.record(OrgUnitChange.DELETED, [(instance.pk, instance.uuid)])
+
+@receiver(post_delete, sender=OrgUnit)
+def forget_orgunit_path(sender, instance, **kwargs):
+    # descendants deleted in the same cascade get their own post_delete
+    paths.forget_paths([instance.path_key])
+
+@receiver(post_save, sender=OrgUnit)
+def index_orgunit_name(sender, instance, created, raw=False, **kwargs):
+    before = getattr(instance, '_stored_row', None)
+    if raw or before is None or before['name'] != instance.name:
+        search.index_names([(instance.pk, search.normalize_name(instance.name))])
+
+@receiver(post_delete, sender=OrgUnit)
+def unindex_orgunit_name(sender, instance, **kwargs):
+    search.unindex_orgunits([instance.pk])
+
+@receiver(post_save, sender=OrgUnit)
+def invalidate_orgunit_subtrees(sender, instance, raw=False, **kwargs):
+    # the subtrees containing the orgunit, before and after a move
+    subtree.invalidate_subtrees(subtree.orgunit_and_ancestor_pks(instance, getattr(instance, '_stored_row', None)))
+
+@receiver(post_delete, sender=OrgUnit)
+def invalidate_deleted_subtrees(sender, instance, **kwargs):
+    subtree.invalidate_subtrees(subtree.orgunit_and_ancestor_pks(instance))
+
+@receiver(post_save, sender=OrgUnit)
+def invalidate_orgunit_tiles(sender, instance, raw=False, **kwargs):
+    # the map tiles at its position, before and after a move
+    before = getattr(instance, '_stored_row', None) or {}
+    tiles.invalidate_tiles([(before.get('latitude'), before.get('longitude')), (instance.latitude, instance.longitude)])
+
+@receiver(post_delete, sender=OrgUnit)
+def invalidate_deleted_tiles(sender, instance, **kwargs):
+    tiles.invalidate_tiles([(instance.latitude, instance.longitude)])
+
+@receiver(post_save, sender=OrgUnit)
+def store_orgunit_geometry(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'geometry_str' in update_fields:
+        if boundaries.store_geometries([(instance.pk, instance.geometry_str)]) and instance.orgunit_type == 'ADMIN' and not placement.checks_deferred():
+            # a new boundary, check the facilities it should hold again
+            placement.check_placement(placement.facilities_below(instance))
+
+@receiver(post_delete, sender=OrgUnit)
+def forget_orgunit_geometry(sender, instance, **kwargs):
+    boundaries.forget_geometries([instance.pk])
+
+@receiver(post_save, sender=OrgUnit)
+def check_orgunit_placement(sender, instance, raw=False, **kwargs):
+    # a facility that moved on the map or in the hierarchy
+    before = getattr(instance, '_stored_row', None) or {}
+    fields = ('latitude', 'longitude') + tuple(id_field for _, id_field in placement.ancestor_levels())
+    if not raw and not placement.checks_deferred() and instance.orgunit_type != 'ADMIN' and any(before.get(f) != getattr(instance, f) for f in fields):
+        placement.check_placement([instance.pk])
+
+@receiver(post_delete, sender=OrgUnit)
+def forget_orgunit_placement(sender, instance, **kwargs):
+    placement.forget_orgunits([instance.pk])
+
+@receiver(m2m_changed, sender=OrgUnit.identifiers.through)
+def log_orgunit_identifiers(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        OrgUnitChange.record(OrgUnitChange.UPDATED, [(instance.pk, instance.uuid)])
+    elif pk_set:
+        OrgUnitChange.record(OrgUnitChange.UPDATED, OrgUnit.objects.filter(pk__in=pk_set).values_list('pk', 'uuid'))
+
+@receiver(post_save, sender=Identifier)
+def log_identifier_save(sender, instance, created, raw=False, **kwargs):
+    # an edited identifier changes the orgunits it's linked to (a new one isn't linked yet)
+    if not raw and not created:
+        OrgUnitChange.record(OrgUnitChange.UPDATED, instance.orgunit_set.values_list('pk', 'uuid'))
+
+@receiver(pre_delete, sender=Identifier)
+def log_identifier_delete(sender, instance, **kwargs):
+    # the links are gone by post_delete
+    OrgUnitChange.record(OrgUnitChange.UPDATED, instance.orgunit_set.values_list('pk', 'uuid'))
+
+@receiver(pre_save, sender=OrgUnit)
+def summary_before_save(sender, instance, raw=False, **kwargs):
+    instance._summary_before = None
+    if not raw and instance.pk is not None:
+        instance._summary_before = summary.orgunit_summary_key(instance.pk)
+        instance._parent_before = OrgUnit.objects.filter(pk=instance.pk).values_list('parent_id', flat=True).first()
+
+@receiver(post_save, sender=OrgUnit)
+def summary_after_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    before = getattr(instance, '_summary_before', None)
+    if before is not None and instance._parent_before != instance.parent_id and not instance.is_leaf_node():
+        # a whole subtree moved, every orgunit below may have a new region/district
+        summary.rebuild_summary_on_commit()
+        return
+    after = summary.orgunit_summary_key(instance.pk)
+    if before != after:
+        if before is not None:
+            summary.apply_delta(before[0], -1, -int(before[1]))
+        summary.apply_delta(after[0], 1, int(after[1]))
+
+@receiver(pre_delete, sender=OrgUnit)
+def summary_before_delete(sender, instance, **kwargs):
+    # ancestors may be deleted first in a cascade, look them up while they exist
+    instance._summary_before = summary.orgunit_summary_key(instance.pk)
+
+@receiver(post_delete, sender=OrgUnit)
+def summary_after_delete(sender, instance, **kwargs):
+    before = getattr(instance, '_summary_before', None)
+    if before is not None:
+        summary.apply_delta(before[0], -1, -int(before[1]))
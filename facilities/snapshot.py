@@ -0,0 +1,179 @@
+from django.conf import settings
+
+import threading
+import time
+import uuid
+
+from facilities.models import Identifier, OrgUnit, OrgUnitChange
+from facilities.paths import child_path_key, path_key
+
+# Process-local, read-only copy of the orgunit tree and the identifiers, for
+# read endpoints that would otherwise query the database for every uuid,
+# path or identifier lookup. Enabled with settings.REGISTRY_SNAPSHOT.
+#
+# A snapshot is loaded with two queries and tagged with the data version
+# (OrgUnitChange.latest_change()) it was read at. The version is checked at
+# most every REGISTRY_SNAPSHOT_MAX_AGE seconds; when it moved a new snapshot
+# is built on the side and swapped in with a single assignment, so readers
+# always see one consistent snapshot. Writes from this process expire it
+# right away. Geometries are left out to keep it small, and since it can be
+# slightly behind the database it must not be used to validate writes.
+
+class SnapshotOrgUnit:
+    """
+    One orgunit in a snapshot. `parent` is the parent SnapshotOrgUnit (None
+    for a root) and `identifiers` a tuple of 'agency::context::external_id'
+    strings.
+    """
+    __slots__ = ('pk', 'uuid', 'name', 'level', 'orgunit_type', 'ownership', 'authority', 'active', 'latitude', 'longitude', 'parent', 'identifiers')
+
+    def __init__(self, pk, uuid, name, level, orgunit_type, ownership, authority, active, latitude, longitude, parent):
+        self.pk = pk
+        self.uuid = uuid
+        self.name = name
+        self.level = level
+        self.orgunit_type = orgunit_type
+        self.ownership = ownership
+        self.authority = authority
+        self.active = active
+        self.latitude = latitude
+        self.longitude = longitude
+        self.parent = parent
+        self.identifiers = ()
+
+    def ancestors(self, include_self=False):
+        """
+        Ancestors from the root down, like OrgUnit.get_ancestors()
+        """
+        chain = []
+        node = self if include_self else self.parent
+        while node is not None:
+            chain.append(node)
+            node = node.parent
+        return chain[::-1]
+
+    def __repr__(self):
+        return '<SnapshotOrgUnit %d: %s>' % (self.pk, self.name)
+
+class RegistrySnapshot:
+    FIELDS = ('pk', 'uuid', 'name', 'level', 'orgunit_type', 'ownership', 'authority', 'active', 'latitude', 'longitude', 'parent_id')
+
+    __slots__ = ('version', 'last_modified', 'by_pk', 'by_uuid', 'by_path_key', 'by_external_id')
+
+    def __init__(self, version, last_modified=None):
+        self.version = version
+        self.last_modified = last_modified
+        self.by_pk = {}
+        self.by_uuid = {}
+        self.by_path_key = {}
+        self.by_external_id = {} # external_id -> tuple of (agency, context, SnapshotOrgUnit)
+
+    @classmethod
+    def load(cls, latest_change=None):
+        """
+        Read the whole registry: the orgunits in tree order, so that parents
+        come before their children, then the identifier links
+        """
+        snapshot = cls(*(latest_change or OrgUnitChange.latest_change()))
+        path_keys = {}
+        strings = {} # one copy of the repeated type/ownership/authority strings
+        for pk, ou_uuid, name, level, orgunit_type, ownership, authority, active, latitude, longitude, parent_id in OrgUnit.objects.order_by('tree_id', 'lft').values_list(*cls.FIELDS).iterator():
+            parent = snapshot.by_pk.get(parent_id)
+            ou = SnapshotOrgUnit(
+                pk, ou_uuid, name, level,
+                strings.setdefault(orgunit_type, orgunit_type), strings.setdefault(ownership, ownership), strings.setdefault(authority, authority),
+                active, latitude, longitude, parent,
+            )
+            snapshot.by_pk[pk] = ou
+            snapshot.by_uuid[ou_uuid] = ou
+            path_keys[pk] = child_path_key(path_keys.get(parent_id, ''), name)
+            snapshot.by_path_key.setdefault(path_keys[pk], ou)
+
+        links = {}
+        by_external_id = {}
+        for orgunit_id, agency, context, external_id in OrgUnit.identifiers.through.objects.order_by('pk').values_list('orgunit_id', 'identifier__agency', 'identifier__context', 'identifier__external_id').iterator():
+            ou = snapshot.by_pk.get(orgunit_id)
+            if ou is not None:
+                links.setdefault(ou, []).append('::'.join([agency, context, external_id]))
+                by_external_id.setdefault(external_id, []).append((strings.setdefault(agency, agency), strings.setdefault(context, context), ou))
+        for ou, id_strs in links.items():
+            ou.identifiers = tuple(id_strs)
+        snapshot.by_external_id = dict((external_id, tuple(matches)) for external_id, matches in by_external_id.items())
+        return snapshot
+
+    def get(self, pk):
+        return self.by_pk.get(pk)
+
+    def get_by_uuid(self, ou_uuid):
+        """
+        The orgunit with `ou_uuid` (a UUID or a string), None if there is none
+        """
+        if not isinstance(ou_uuid, uuid.UUID):
+            try:
+                ou_uuid = uuid.UUID(str(ou_uuid))
+            except ValueError:
+                return None
+        return self.by_uuid.get(ou_uuid)
+
+    def resolve_path(self, path_parts):
+        """
+        The orgunit at `path_parts` (names, root first), matched like
+        facilities.paths.resolve_path
+        """
+        return self.by_path_key.get(path_key(path_parts))
+
+    def resolve_identifiers(self, id_strs, *orgunit_fields):
+        """
+        Same as Identifier.resolve(), without the database
+        """
+        results = {}
+        for id_str in id_strs:
+            agency, context, external_id = Identifier.split_identifier_str(id_str)
+            matches = []
+            for match_agency, match_context, ou in self.by_external_id.get(external_id, ()):
+                if agency is None or (agency, context) == (match_agency, match_context):
+                    match = dict((f, getattr(ou, f)) for f in orgunit_fields)
+                    match['identifier'] = '::'.join([match_agency, match_context, external_id])
+                    matches.append(match)
+            results[id_str] = matches
+        return results
+
+    def __len__(self):
+        return len(self.by_pk)
+
+_snapshot = None
+_checked_at = 0
+_reload_lock = threading.Lock()
+
+def get_snapshot():
+    """
+    The current registry snapshot, loading or reloading it if needed. None
+    when snapshots are disabled.
+    """
+    global _snapshot, _checked_at
+    if not getattr(settings, 'REGISTRY_SNAPSHOT', False):
+        return None
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - _checked_at < getattr(settings, 'REGISTRY_SNAPSHOT_MAX_AGE', 5):
+        return snapshot
+
+    # one thread reloads, the others carry on with the snapshot they have
+    if not _reload_lock.acquire(blocking=snapshot is None):
+        return snapshot
+    try:
+        if _snapshot is not snapshot:
+            return _snapshot # reloaded while we waited
+        latest_change = OrgUnitChange.latest_change()
+        if snapshot is None or snapshot.version != latest_change[0]:
+            _snapshot = RegistrySnapshot.load(latest_change)
+        _checked_at = time.monotonic()
+        return _snapshot
+    finally:
+        _reload_lock.release()
+
+def expire_snapshot():
+    """
+    Make the next get_snapshot() check the data version
+    """
+    global _checked_at
+    _checked_at = 0
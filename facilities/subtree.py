@@ -0,0 +1,183 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Subquery
+
+from collections import OrderedDict
+from functools import partial
+import hashlib
+import json
+import uuid
+
+from rest_framework import serializers
+
+from facilities.models import OrgUnit
+
+# Subtrees are read with a single nested-set range query: the root row is
+# looked up in subqueries, so the node and everything below it come back in
+# one statement, in tree (lft) order.
+#
+# Rendered subtrees (API data, listing page fragments) are cached per node.
+# Every node has a version token in the cache that is dropped whenever the
+# node or anything below it changes, which orphans the cached fragments of
+# that node and of all its ancestors. Bulk writers bump a generation instead.
+# Both happen again when the write commits.
+
+# fields a client can ask for, and the values() columns they're built from
+SUBTREE_FIELDS = OrderedDict([
+    ('href', ('id',)),
+    ('name', ('name',)),
+    ('uuid', ('uuid',)),
+    ('level', ('level',)),
+    ('orgunit_type', ('orgunit_type',)),
+    ('ownership', ('ownership',)),
+    ('authority', ('authority',)),
+    ('active', ('active',)),
+    ('createdAt', ('createdAt',)),
+    ('updatedAt', ('updatedAt',)),
+    ('geometry', ('geometry_str',)),
+])
+DEFAULT_SUBTREE_FIELDS = ('href', 'name', 'uuid', 'level', 'orgunit_type')
+
+CACHE_PREFIX = 'subtree:'
+CACHE_TIMEOUT = 24*60*60
+
+def subtree_queryset(pk, max_depth=None, queryset=None):
+    """
+    The orgunit `pk` and its descendants (down to `max_depth` levels below
+    it) in tree order, as one query
+    """
+    if queryset is None:
+        queryset = OrgUnit.objects.all()
+    root = OrgUnit._base_manager.filter(pk=pk)
+    subtree = queryset.filter(
+        tree_id=Subquery(root.values('tree_id')),
+        lft__gte=Subquery(root.values('lft')),
+        lft__lte=Subquery(root.values('rght')),
+    )
+    if max_depth is not None:
+        subtree = subtree.filter(level__lte=Subquery(root.values('level')) + max_depth)
+    return subtree.order_by('lft')
+
+def subtree_rows(pk, fields, max_depth=None):
+    """
+    values() rows of the subtree under `pk` with the columns needed for
+    `fields` plus the tree structure. Empty if `pk` doesn't exist.
+    """
+    columns = set(['id', 'parent_id', 'level', 'lft', 'rght'])
+    for field in fields:
+        columns.update(SUBTREE_FIELDS[field])
+    return list(subtree_queryset(pk, max_depth).values(*columns))
+
+datetime_field = serializers.DateTimeField()
+
+def row_data(row, fields, href):
+    # same representation as OrgUnitSerializer
+    to_value = {
+        'href': lambda row: href.format(row['id']),
+        'uuid': lambda row: str(row['uuid']),
+        'createdAt': lambda row: datetime_field.to_representation(row['createdAt']),
+        'updatedAt': lambda row: datetime_field.to_representation(row['updatedAt']),
+        'geometry': lambda row: json.loads(row['geometry_str']) if row['geometry_str'] else None,
+    }
+    return OrderedDict((f, to_value[f](row) if f in to_value else row[f]) for f in fields)
+
+def flat_subtree(rows, fields, href):
+    """
+    Subtree as a list in tree order, each node with its depth below the root
+    and its parent's href
+    """
+    if not rows:
+        return []
+    root_level = rows[0]['level']
+    data = []
+    for row in rows:
+        node = row_data(row, fields, href)
+        node['depth'] = row['level'] - root_level
+        node['parent'] = None if row['parent_id'] is None else href.format(row['parent_id'])
+        node['leaf'] = row['rght'] == row['lft'] + 1
+        data.append(node)
+    return data
+
+def nested_subtree(rows, fields, href):
+    """
+    Subtree as nested objects, each with its 'children'. 'leaf' tells apart
+    nodes without children from those cut off by the maximum depth.
+    """
+    if not rows:
+        return None
+    stack = []
+    root = None
+    for row in rows:
+        node = row_data(row, fields, href)
+        node['leaf'] = row['rght'] == row['lft'] + 1
+        node['children'] = []
+        while stack and stack[-1][0]['rght'] < row['lft']:
+            stack.pop()
+        if stack:
+            stack[-1][1]['children'].append(node)
+        else:
+            root = node
+        stack.append((row, node))
+    return root
+
+def subtree_version(pk):
+    generation = cache.get(CACHE_PREFIX + 'generation', 0)
+    version_key = '{0}version:{1}:{2}'.format(CACHE_PREFIX, generation, pk)
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, CACHE_TIMEOUT):
+            version = cache.get(version_key, version) # set concurrently
+    return '{0}:{1}'.format(generation, version)
+
+def cached_subtree(pk, variant, build):
+    """
+    Cached result of `build()` for the subtree under `pk`, `variant` telling
+    apart the different renderings of one subtree
+    """
+    variant_hash = hashlib.sha1(json.dumps(variant, sort_keys=True).encode('utf-8')).hexdigest()
+    key = '{0}{1}:{2}:{3}'.format(CACHE_PREFIX, pk, subtree_version(pk), variant_hash)
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, CACHE_TIMEOUT)
+    return data
+
+def drop_versions(pks):
+    generation = cache.get(CACHE_PREFIX + 'generation', 0)
+    cache.delete_many(['{0}version:{1}:{2}'.format(CACHE_PREFIX, generation, pk) for pk in pks])
+
+def bump_generation():
+    try:
+        cache.incr(CACHE_PREFIX + 'generation')
+    except ValueError:
+        cache.set(CACHE_PREFIX + 'generation', 1, None)
+
+def invalidate_subtrees(pks):
+    """
+    Drop the cached renderings of the subtrees under `pks`, now and again
+    once the transaction commits, as a concurrent reader still sees the old
+    rows until then and may cache them again
+    """
+    pks = list(pks)
+    if pks:
+        drop_versions(pks)
+        transaction.on_commit(partial(drop_versions, pks))
+
+def invalidate_all_subtrees():
+    bump_generation()
+    transaction.on_commit(bump_generation)
+
+def orgunit_and_ancestor_pks(ou, stored_row=None):
+    """
+    pk of `ou` and of its ancestors, now and (given the stored_row read by
+    OrgUnit.save()) before the save, from the denormalized ancestor columns
+    """
+    pks = set([ou.pk])
+    for id_field, _ in OrgUnit.ancestor_fields().values():
+        pks.add(getattr(ou, id_field))
+        if stored_row is not None:
+            pks.add(stored_row[id_field])
+    pks.add(ou.parent_id)
+    pks.discard(None)
+    return pks
@@ -0,0 +1,122 @@
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+
+from collections import Counter
+
+from facilities.bulk import bulk_update
+from facilities.models import OrgUnit, OrgUnitSummary
+
+# OrgUnitSummary dimensions and the model fields they're read from
+KEY_FIELDS = ('level', 'orgunit_type', 'ownership', 'authority')
+
+def level_number(level_name):
+    for level, name in settings.ORG_UNIT_LEVELS.items():
+        if name == level_name:
+            return level
+    return None
+
+REGION_LEVEL = level_number('Region')
+DISTRICT_LEVEL = level_number('District')
+
+def summary_key(values, ancestors):
+    """
+    OrgUnitSummary key for an orgunit, given its field values and a dict
+    level -> pk of its ancestors (including itself)
+    """
+    key = dict((f, values[f]) for f in KEY_FIELDS)
+    key['region_id'] = ancestors.get(REGION_LEVEL, 0)
+    key['district_id'] = ancestors.get(DISTRICT_LEVEL, 0)
+    return key
+
+def orgunit_summary_key(pk):
+    """
+    Current OrgUnitSummary key and coordinate flag of one orgunit, read from
+    the database, None if it doesn't exist. Ancestors are found through the
+    parent links rather than lft/rght, which mptt has already shifted by the
+    time the pre_save/pre_delete signals of a move or delete fire.
+    """
+    row = OrgUnit.objects.filter(pk=pk).values('parent_id', 'latitude', *KEY_FIELDS).first()
+    if row is None:
+        return None
+    ancestors = {}
+    current_pk, current = pk, row
+    while current is not None:
+        if current['level'] in (REGION_LEVEL, DISTRICT_LEVEL):
+            ancestors[current['level']] = current_pk
+        if current['parent_id'] is None or current['level'] <= min(REGION_LEVEL, DISTRICT_LEVEL):
+            break
+        current_pk = current['parent_id']
+        current = OrgUnit.objects.filter(pk=current_pk).values('parent_id', 'level').first()
+    return summary_key(row, ancestors), row['latitude'] is not None
+
+def apply_delta(key, count, with_coordinates):
+    """
+    Add `count` and `with_coordinates` to the summary row for `key`
+    """
+    if not count and not with_coordinates:
+        return
+    summary_rows = OrgUnitSummary.objects.filter(**key)
+    if summary_rows.update(count=F('count')+count, with_coordinates=F('with_coordinates')+with_coordinates):
+        return
+    try:
+        with transaction.atomic():
+            OrgUnitSummary.objects.create(count=count, with_coordinates=with_coordinates, **key)
+    except IntegrityError:
+        # created concurrently
+        summary_rows.update(count=F('count')+count, with_coordinates=F('with_coordinates')+with_coordinates)
+
+def rebuild_summary_on_commit():
+    """
+    rebuild_summary() once the transaction commits, however many subtrees
+    it moves
+    """
+    if not any(func == rebuild_summary for _, func in connection.run_on_commit):
+        transaction.on_commit(rebuild_summary)
+
+def rebuild_summary(orgunit_model=OrgUnit, summary_model=OrgUnitSummary):
+    """
+    Recompute all summary rows from a single pass over the orgunit table, used
+    after bulk imports and restructuring where per-row deltas would be too
+    many. Ancestors are resolved in memory from the parent links.
+    """
+    rows = dict(
+        (pk, (parent_id, dict(zip(KEY_FIELDS + ('latitude',), values))))
+        for pk, parent_id, *values in orgunit_model.objects.values_list('pk', 'parent_id', *(KEY_FIELDS + ('latitude',))).iterator()
+    )
+
+    ancestor_cache = {}
+    def ancestors_of(pk):
+        # level -> pk for the node and everything above it
+        if pk not in ancestor_cache:
+            parent_id, values = rows[pk]
+            ancestors = dict(ancestors_of(parent_id)) if parent_id is not None else {}
+            ancestors[values['level']] = pk
+            ancestor_cache[pk] = ancestors
+        return ancestor_cache[pk]
+
+    counts = Counter()
+    coordinates = Counter()
+    for pk, (_, values) in sorted(rows.items(), key=lambda x: x[1][1]['level']): # parents first, no deep recursion
+        key = tuple(sorted(summary_key(values, ancestors_of(pk)).items()))
+        counts[key] += 1
+        if values['latitude'] is not None:
+            coordinates[key] += 1
+
+    # write only the differences, rows that are no longer needed are kept with a count of 0 (the
+    # dashboards skip those) since deleting them would send a signal per row
+    fields = KEY_FIELDS + ('region_id', 'district_id')
+    with transaction.atomic():
+        current = {}
+        for pk, count, with_coordinates, *values in summary_model.objects.values_list('pk', 'count', 'with_coordinates', *fields).iterator():
+            current[tuple(sorted(zip(fields, values)))] = (pk, count, with_coordinates)
+        changed = []
+        for key, (pk, count, with_coordinates) in current.items():
+            if (counts.get(key, 0), coordinates.get(key, 0)) != (count, with_coordinates):
+                changed.append((pk, {'count': counts.get(key, 0), 'with_coordinates': coordinates.get(key, 0)}))
+        bulk_update(summary_model, changed, ('count', 'with_coordinates'))
+        summary_model.objects.bulk_create(
+            (summary_model(count=count, with_coordinates=coordinates[key], **dict(key)) for key, count in counts.items() if key not in current),
+            batch_size=500
+        )
+    return len(changed) + len([key for key in counts if key not in current])
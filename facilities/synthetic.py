@@ -0,0 +1,159 @@
+from django.conf import settings
+
+import csv
+import json
+import random
+import string
+
+from facilities.importer import PATH_COLUMNS
+
+# Synthetic registries for benchmarks: a tree with the shape of the Ugandan
+# MFL (4 regions, ~15 subregions, ~135 districts, ~1500 subcounties, ~8000
+# facilities) scaled to any number of orgunits, written as the CSV that
+# orgunit_load reads. The same size and seed always give the same file.
+
+CSV_HEADER = PATH_COLUMNS[:-1] + ('NAME', 'FACILITY_LEVEL', 'OWNERSHIP_NAME', 'AUTHORITY_NAME', 'OPERATIONAL STATUS', 'UID', 'COORDINATES')
+
+# mean number of children per level below the root, the registry grows by scaling all but the first
+BASE_FANOUT = (4, 3.75, 9, 11, 5.3)
+
+# (FACILITY_LEVEL, name suffix, weight)
+FACILITY_TYPES = (
+    ('HC II', 'HC II', 50),
+    ('HC III', 'HC III', 30),
+    ('HC IV', 'HC IV', 4),
+    ('Clinic', 'Clinic', 10),
+    ('Hospital', 'Hospital', 4),
+    ('SC', 'Special Clinic', 2),
+)
+OWNERSHIPS = (('Govt', 60), ('PNFP', 25), ('PFP', 15))
+AUTHORITIES = {'Govt': ('MOH', 'UPDF', 'UPF'), 'PNFP': ('UCMB', 'UPMB', 'UMMB', 'NGO'), 'PFP': ('Private',)}
+
+# longitude/latitude box of the country
+EXTENT = (29.6, -1.4, 35.0, 4.2)
+FUNCTIONAL_SHARE = 0.95
+COORDINATES_SHARE = 0.97
+
+SYLLABLES = ('ka', 'mu', 'ba', 'ga', 'lu', 'bu', 'ki', 'na', 'to', 'ro', 'ya', 'wa', 'se', 'mbe', 'nya', 'ko', 'bi', 'ra', 'ti', 'ndi', 'ma', 'gu', 'le', 'so')
+
+def parse_size(size):
+    """
+    Number of orgunits from '10000', '10k' or '1M'
+    """
+    size = str(size).strip().lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(size[-1:], 1)
+    return int(float(size.rstrip('km')) * multiplier)
+
+def scaled_fanout(orgunits):
+    """
+    Mean fanout per level giving about `orgunits` orgunits in total
+    """
+    def total(growth):
+        count = level_count = 1
+        for i, fanout in enumerate(BASE_FANOUT):
+            level_count *= fanout * (growth if i else 1)
+            count += level_count
+        return count
+
+    low, high = 0.01, 100.0
+    for _ in range(60):
+        growth = (low + high) / 2
+        low, high = (growth, high) if total(growth) < orgunits else (low, growth)
+    return [fanout * (growth if i else 1) for i, fanout in enumerate(BASE_FANOUT)]
+
+def weighted_choices(rng, choices, count):
+    # choices are tuples with the weight last
+    return rng.choices(choices, weights=[c[-1] for c in choices], k=count)
+
+class SyntheticRegistry:
+    def __init__(self, orgunits, seed=1):
+        self.orgunits = orgunits
+        self.seed = seed
+        self.fanout = scaled_fanout(orgunits)
+
+    def place_name(self, rng):
+        return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+
+    def child_names(self, rng, count, label):
+        # unique under the parent, case-insensitively like the importer compares them
+        names = []
+        seen = set()
+        while len(names) < count:
+            name = '{0} {1}'.format(self.place_name(rng), label) if label else self.place_name(rng)
+            if name.lower() not in seen:
+                seen.add(name.lower())
+                names.append(name)
+        return names
+
+    def child_counts(self, rng, parents, depth):
+        """
+        Number of children of each of `parents` units at `depth`: uneven, but
+        adding up to the level total given by the fanout so that the registry
+        size stays close to the one asked for
+        """
+        level_total = 1
+        for fanout in self.fanout[:depth+1]:
+            level_total *= fanout
+        level_total = max(parents, int(round(level_total)))
+        weights = [rng.uniform(0.5, 1.5) for _ in range(parents)]
+        counts = [max(1, int(level_total * w / sum(weights))) for w in weights]
+        for i in range(level_total - sum(counts)):
+            counts[i % parents] += 1
+        return counts
+
+    def rows(self):
+        """
+        Generate CSV rows (dicts keyed by CSV_HEADER), one per facility,
+        grouped by subcounty
+        """
+        rng = random.Random(self.seed)
+        admin_labels = [settings.ORG_UNIT_LEVELS.get(level, '') for level in range(1, len(PATH_COLUMNS))]
+        # (path, (west, south, east, north)) of the admin units at the current level
+        units = [((), EXTENT)]
+        for depth, label in enumerate(admin_labels):
+            children = []
+            for (path, box), count in zip(units, self.child_counts(rng, len(units), depth)):
+                for name in self.child_names(rng, count, label if depth < 2 else ''):
+                    children.append((path + (name,), self.child_box(rng, box, count)))
+            units = children
+
+        for (path, box), count in zip(units, self.child_counts(rng, len(units), len(admin_labels))):
+            names = self.child_names(rng, count, '')
+            facility_types = weighted_choices(rng, FACILITY_TYPES, count)
+            ownerships = weighted_choices(rng, OWNERSHIPS, count)
+            for name, (facility_level, suffix, _), (ownership, _) in zip(names, facility_types, ownerships):
+                row = dict(zip(PATH_COLUMNS[:-1], path))
+                row.update({
+                    'NAME': '{0} {1}'.format(name, suffix),
+                    'FACILITY_LEVEL': facility_level,
+                    'OWNERSHIP_NAME': ownership,
+                    'AUTHORITY_NAME': rng.choice(AUTHORITIES[ownership]),
+                    'OPERATIONAL STATUS': 'Functional' if rng.random() < FUNCTIONAL_SHARE else 'Not Functional',
+                    'UID': rng.choice(string.ascii_letters) + ''.join(rng.choices(string.ascii_letters + string.digits, k=10)),
+                    'COORDINATES': '',
+                })
+                if rng.random() < COORDINATES_SHARE:
+                    west, south, east, north = box
+                    row['COORDINATES'] = json.dumps([round(rng.uniform(west, east), 6), round(rng.uniform(south, north), 6)])
+                yield row
+
+    def child_box(self, rng, box, siblings):
+        # a box inside the parent's, smaller the more siblings share it
+        west, south, east, north = box
+        scale = siblings ** -0.5
+        width, height = (east - west) * scale, (north - south) * scale
+        x, y = rng.uniform(west, east - width), rng.uniform(south, north - height)
+        return (x, y, x + width, y + height)
+
+    def write_csv(self, csv_file):
+        """
+        Write the registry as an orgunit_load input file, returns the number
+        of facility rows
+        """
+        writer = csv.DictWriter(csv_file, CSV_HEADER)
+        writer.writeheader()
+        count = 0
+        for row in self.rows():
+            writer.writerow(row)
+            count += 1
+        return count
@@ -1,3 +1,1233 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import cache
+from django.http import FileResponse
+from django.db import OperationalError, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
-# Create your tests here.
+import csv
+import gzip
+import json
+import math
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from easyaudit.models import CRUDEvent
+
+from facilities.importer import BulkOrgUnitLoader, parse_row
+from facilities.duplicates import DuplicateDetector, duplicate_report
+from facilities.export import snapshot_path
+from facilities.geo import geohash_cell_size, geohash_covered_radius_km, geohash_encode, geohash_prefix_range, haversine_km
+from facilities.models import AuditChangeSet, DuplicateCandidate, Identifier, MisplacedFacility, OrgUnit, OrgUnitChange, OrgUnitExtent, OrgUnitGeometry, OrgUnitNameGram, OrgUnitSummary
+from facilities import audit, metrics, paths, snapshot, subtree, summary, tiles
+from facilities.benchmark import run_benchmarks
+from facilities.boundaries import store_geometries
+from facilities.paths import resolve_path
+from facilities.placement import check_placement, placement_report
+from facilities.restructure import Restructure, RestructureError
+from facilities.search import name_grams, normalize_name
+from facilities.synthetic import SyntheticRegistry
+from facilities.views import IdentifierViewSet, OrgUnitSerializer
+
+def facility_row(i, **kwargs):
+    row = {
+        'REGION': 'Region %d' % (i % 2),
+        'SUB_REGION': 'Subregion %d' % (i % 2),
+        'DISTRICT': 'District %d' % (i % 4),
+        'SUBCOUNTY': 'Subcounty %d' % (i % 8),
+        'NAME': 'Facility %d HC II' % i,
+        'FACILITY_LEVEL': 'HC II',
+        'OWNERSHIP_NAME': 'Govt',
+        'AUTHORITY_NAME': 'MOH',
+        'OPERATIONAL STATUS': 'Functional',
+        'UID': 'uid%04d' % i,
+        'COORDINATES': '[%f, %f]' % (32 + i/1000, 1 + i/1000),
+    }
+    row.update(kwargs)
+    return row
+
+def write_csv(rows):
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+def load_facilities(count):
+    BulkOrgUnitLoader().load([parse_row(facility_row(i)) for i in range(count)])
+
+class OrgUnitAPIQueryCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(40)
+
+    def test_list_query_count_independent_of_page_size(self):
+        # the registry version, then with page number pagination: COUNT(*), the page and the identifiers of the page
+        for page_size in (5, 50):
+            with self.assertNumQueries(4):
+                response = self.client.get('/api/orgunits/', {'page_size': page_size})
+            self.assertEqual(response.status_code, 200)
+
+        # keyset pagination: the page and its identifiers
+        for page_size in (5, 50):
+            with self.assertNumQueries(3):
+                response = self.client.get('/api/facilities/', {'page_size': page_size, 'paginate': 'cursor'})
+            self.assertEqual(response.status_code, 200)
+
+    def test_detail_query_count(self):
+        ou = OrgUnit.objects.filter(level=5).first()
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/orgunits/%d/' % ou.pk)
+        self.assertEqual(response.status_code, 200)
+
+    def test_fast_list_matches_serializer(self):
+        response = self.client.get('/api/orgunits/', {'page_size': 100})
+        request = response.wsgi_request
+        expected = OrgUnitSerializer(OrgUnit.objects.all(), many=True, context={'request': request}).data
+        self.assertEqual(response.json()['results'], [dict(x) for x in expected])
+
+class OrgUnitDumpAndCursorTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(40)
+
+    def test_dump_matches_listing(self):
+        response = self.client.get('/api/orgunits/dump/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        dumped = [json.loads(line) for line in lines]
+        self.assertEqual([d['uuid'] for d in dumped], [str(u) for u in OrgUnit.objects.order_by('pk').values_list('uuid', flat=True)])
+        listed = self.client.get('/api/orgunits/', {'page_size': 1000}).json()['results']
+        self.assertEqual(len(listed), len(dumped))
+        self.assertEqual(sorted(dumped, key=lambda d: d['uuid']), sorted(listed, key=lambda d: d['uuid']))
+
+        facilities = b''.join(self.client.get('/api/facilities/dump/', {'district': 'District 1'}).streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(facilities), 10)
+
+    def test_cursor_pages_visit_every_row_once(self):
+        seen = []
+        url, params = '/api/orgunits/', {'paginate': 'cursor', 'page_size': 7}
+        while url:
+            data = self.client.get(url, params).json()
+            seen += [row['uuid'] for row in data['results']]
+            if len(seen) == 7:
+                # a write between pages doesn't move rows across the cursor
+                ou = OrgUnit.objects.get(name='Facility 0 HC II')
+                ou.name = 'Facility 0 HC III'
+                ou.save()
+            url, params = data['next'], None
+            self.assertTrue(url is None or 'paginate=cursor' in url)
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(sorted(seen), sorted(str(u) for u in OrgUnit.objects.values_list('uuid', flat=True)))
+
+class OrgUnitPathTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+
+    def test_rename_and_move_update_paths(self):
+        facility = OrgUnit.objects.get(name='Facility 3 HC II')
+        path = [ou.name for ou in facility.get_ancestors(include_self=True)]
+        self.assertEqual(OrgUnit.from_path_recurse(*path).pk, facility.pk)
+        self.assertEqual(resolve_path([p.upper() for p in path]), facility.pk)
+
+        district = facility.parent.parent
+        district.name = 'Renamed District'
+        district.save()
+        self.assertIsNone(resolve_path(path))
+        renamed_path = path[:-3] + ['Renamed District'] + path[-2:]
+        self.assertEqual(resolve_path(renamed_path), facility.pk)
+
+        subcounty = OrgUnit.objects.get(pk=facility.parent_id)
+        subcounty.parent = OrgUnit.objects.get(name='District 0')
+        subcounty.save()
+        self.assertIsNone(resolve_path(renamed_path))
+        moved_path = [ou.name for ou in subcounty.parent.get_ancestors(include_self=True)] + path[-2:]
+        self.assertEqual(resolve_path(moved_path), facility.pk)
+
+        OrgUnit.objects.get(pk=facility.pk).delete()
+        self.assertIsNone(resolve_path(moved_path))
+
+    def test_path_key_fits_longest_names(self):
+        parent = None
+        for level in sorted(settings.ORG_UNIT_LEVELS):
+            ou = OrgUnit(name=('Level %d ' % level).ljust(96, 'x'), parent=parent, orgunit_type='HC II' if level == max(settings.ORG_UNIT_LEVELS) else 'ADMIN')
+            ou.save()
+            parent = ou
+        self.assertEqual(ou.level, max(settings.ORG_UNIT_LEVELS))
+        self.assertEqual(len(ou.path_key), OrgUnit._meta.get_field('path_key').max_length)
+        self.assertEqual(resolve_path([a.name for a in ou.get_ancestors(include_self=True)]), ou.pk)
+
+class OrgUnitPathCommitTest(TransactionTestCase):
+    # cached paths are dropped again on commit
+
+    def test_path_cached_during_rename_is_dropped(self):
+        load_facilities(8)
+        facility = OrgUnit.objects.get(name='Facility 3 HC II')
+        path = [ou.name for ou in facility.get_ancestors(include_self=True)]
+        with transaction.atomic():
+            district = facility.parent.parent
+            district.name = 'Renamed District'
+            district.save()
+            # another process, still seeing the old path, resolves it meanwhile
+            cache.set(paths.cache_key(paths.path_key(path)), facility.pk)
+        self.assertIsNone(resolve_path(path))
+
+class OrgUnitHierarchyTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+
+    def test_ancestor_columns_follow_renames_and_moves(self):
+        district = OrgUnit.objects.get(name='District 1')
+        district.name = 'Renamed District'
+        district.save()
+        subcounty = OrgUnit.objects.get(name='Subcounty 5')
+        subcounty.parent = OrgUnit.objects.get(name='District 2')
+        subcounty.save()
+
+        for ou in OrgUnit.objects.filter(level=5):
+            self.assertEqual(list(ou.hierarchy.values()), [a.name for a in ou.get_ancestors()])
+
+        response = self.client.get('/api/facilities/', {'district': 'renamed district'})
+        self.assertEqual([x['name'] for x in response.json()['results']], ['Facility 1 HC II'])
+
+class SubtreeAPITest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(16)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_district_subtree_in_one_query(self):
+        district = OrgUnit.objects.get(name='District 1')
+        with self.assertNumQueries(2): # the registry version and the subtree
+            response = self.client.get('/api/orgunits/%d/subtree/' % district.pk)
+        data = response.json()
+        self.assertEqual(data['name'], 'District 1')
+        self.assertEqual(sorted(x['name'] for x in data['children']), ['Subcounty 1', 'Subcounty 5'])
+        self.assertEqual(sum(len(x['children']) for x in data['children']), 4)
+
+        response = self.client.get('/api/orgunits/%d/subtree/' % district.pk, {'flat': 'true', 'depth': 1, 'fields': 'name'})
+        self.assertEqual([(x['name'], x['depth']) for x in response.json()], [('District 1', 0), ('Subcounty 1', 1), ('Subcounty 5', 1)])
+
+    def test_cached_subtree_invalidated_by_changes_below(self):
+        district = OrgUnit.objects.get(name='District 1')
+        self.client.get('/api/orgunits/%d/subtree/' % district.pk, {'flat': 'true'})
+        with self.assertNumQueries(1): # the registry version only
+            self.client.get('/api/orgunits/%d/subtree/' % district.pk, {'flat': 'true'})
+
+        facility = OrgUnit.objects.get(name='Facility 1 HC II')
+        facility.name = 'Renamed HC II'
+        facility.save()
+        response = self.client.get('/api/orgunits/%d/subtree/' % district.pk, {'flat': 'true'})
+        self.assertIn('Renamed HC II', [x['name'] for x in response.json()])
+
+class SubtreeCacheCommitTest(TransactionTestCase):
+    # cached subtrees are dropped again on commit
+
+    def test_subtree_cached_during_write_is_dropped(self):
+        load_facilities(8)
+        district = OrgUnit.objects.get(name='District 1')
+        for write in (lambda: OrgUnit.objects.get(name='Facility 1 HC II').save(), subtree.invalidate_all_subtrees):
+            with transaction.atomic():
+                write()
+                # another process, still seeing the old rows, renders the subtree meanwhile
+                subtree.cached_subtree(district.pk, 'test', lambda: 'old')
+            self.assertEqual(subtree.cached_subtree(district.pk, 'test', lambda: 'new'), 'new')
+            cache.clear()
+
+class NearestFacilityTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        subcounty = OrgUnit.objects.get(name='Subcounty 0')
+        OrgUnit(name='Faraway HC IV', parent=subcounty, orgunit_type='HC IV', geometry_str='{"type": "Point", "coordinates": [-50.0, -10.0]}').save()
+        OrgUnit(name='Unmapped HC II', parent=subcounty, orgunit_type='HC II').save()
+
+    def nearest(self, **kwargs):
+        return [(round(distance, 3), ou.name) for distance, ou in OrgUnit.nearest(1.0, 32.0, queryset=OrgUnit.objects.exclude(orgunit_type='ADMIN'), **kwargs)]
+
+    def test_k_nearest(self):
+        nearest = self.nearest(k=3)
+        self.assertEqual([name for _, name in nearest], ['Facility 0 HC II', 'Facility 1 HC II', 'Facility 2 HC II'])
+        self.assertEqual(nearest[1][0], round(haversine_km(1.0, 32.0, 1.001, 32.001), 3))
+        # as many as the coarsest cells around the point hold, never the facility without coordinates
+        self.assertEqual(len(self.nearest(k=100)), 8)
+
+    def test_radius(self):
+        self.assertEqual([name for _, name in self.nearest(k=None, radius_km=0.5)], ['Facility %d HC II' % i for i in range(4)])
+        self.assertEqual(len(self.nearest(k=2, radius_km=0.5)), 2)
+        self.assertEqual(self.nearest(radius_km=0.5, k=None)[-1][0], round(haversine_km(1.0, 32.0, 1.003, 32.003), 3))
+        # wider than the coarsest geohash cells reach
+        self.assertGreater(haversine_km(1.0, 32.0, -10.0, -50.0), geohash_covered_radius_km(1.0, 1))
+        self.assertEqual(self.nearest(k=None, radius_km=12000)[-1][1], 'Faraway HC IV')
+        self.assertEqual(len(self.nearest(k=None, radius_km=12000)), 9)
+
+    def test_cell_range_boundary(self):
+        self.assertEqual(geohash_prefix_range('s00'), ('s00', 's01'))
+        self.assertEqual(geohash_prefix_range('s0z'), ('s0z', 's1'))
+        self.assertEqual(geohash_prefix_range('zz'), ('zz', None))
+        # a neighbour in the north-east corner of a cell sorts last under its prefix
+        height, width = geohash_cell_size(5)
+        lat = (math.floor(91.0 / height) + 1) * height - 90.0 - 1e-7
+        lon = (math.floor(212.0 / width) + 1) * width - 180.0 - 1e-7
+        corner = OrgUnit(name='Corner HC III', parent=OrgUnit.objects.get(name='Subcounty 0'), orgunit_type='HC III', geometry_str=json.dumps({'type': 'Point', 'coordinates': [lon, lat]}))
+        corner.save()
+        self.assertEqual(corner.geocell, geohash_encode(1.0, 32.0, 5) + 'zz')
+        self.assertIn('Corner HC III', [name for _, name in self.nearest(k=None, radius_km=haversine_km(1.0, 32.0, lat, lon) + 0.01)])
+
+    def test_nearby_api(self):
+        response = self.client.get('/api/facilities/nearby/', {'lat': 1.0, 'lon': 32.0, 'k': 2})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([(f['name'], f['distance_km']) for f in data['facilities']], [('Facility 0 HC II', 0.0), ('Facility 1 HC II', 0.157)])
+        self.assertEqual([(level, [u['name'] for u in units]) for level, units in data['adminunits'].items()], [
+            ('country', ['Uganda']), ('region', ['Region 0', 'Region 1']), ('subregion', ['Subregion 0', 'Subregion 1']),
+            ('district', ['District 0', 'District 1']), ('subcounty', ['Subcounty 0', 'Subcounty 1']),
+        ])
+        self.assertEqual(len(self.client.get('/api/facilities/nearby/', {'lat': 1.0, 'lon': 32.0, 'radius': 12000, 'k': 100}).json()['facilities']), 9)
+        for params in ({'lat': 1.0}, {'lat': 91, 'lon': 32}, {'lat': 1, 'lon': 32, 'k': 'x'}):
+            self.assertEqual(self.client.get('/api/facilities/nearby/', params).status_code, 400)
+
+class SummaryUpkeepTest(TransactionTestCase):
+    # a moved subtree is summarized again on commit
+
+    def setUp(self):
+        load_facilities(16)
+
+    def summary_rows(self):
+        fields = ('level', 'orgunit_type', 'ownership', 'authority', 'region_id', 'district_id', 'count', 'with_coordinates')
+        return sorted(OrgUnitSummary.objects.filter(count__gt=0).values_list(*fields))
+
+    def test_incremental_upkeep_matches_rebuild(self):
+        with mock.patch.object(summary, 'rebuild_summary', wraps=summary.rebuild_summary) as rebuild:
+            with transaction.atomic():
+                # subtrees into another region, a facility into another district
+                for name, parent in (('Subcounty 1', 'District 0'), ('Subcounty 3', 'District 2'), ('Facility 4 HC II', 'Subcounty 5')):
+                    ou = OrgUnit.objects.get(name=name)
+                    ou.parent = OrgUnit.objects.get(name=parent)
+                    ou.save()
+                self.assertEqual(rebuild.call_count, 0)
+            self.assertEqual(rebuild.call_count, 1)
+
+        facility = OrgUnit.objects.get(name='Facility 6 HC II')
+        facility.orgunit_type = 'HC III'
+        facility.ownership = 'PNFP'
+        facility.save()
+        facility = OrgUnit.objects.get(name='Facility 7 HC II')
+        facility.geometry_str = ''
+        facility.save()
+        OrgUnit.objects.get(name='Facility 8 HC II').delete()
+        OrgUnit.objects.get(name='Subcounty 2').delete() # with its facilities
+
+        incremental = self.summary_rows()
+        summary.rebuild_summary()
+        self.assertEqual(incremental, self.summary_rows())
+        region_0 = OrgUnit.objects.get(name='Region 0').pk
+        self.assertEqual(sum(row[6] for row in incremental if row[0] == 5 and row[4] == region_0), 8 + 2 + 2 - 1 - 1 - 2) # moved in, moved out, deleted
+
+class OrgUnitLoadCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+
+    def setUp(self):
+        # four facilities as they are, one changed, two new (one in a new subcounty), 5 to 7 gone
+        rows = [facility_row(i) for i in range(4)] + [facility_row(4, OWNERSHIP_NAME='PNFP'), facility_row(8), facility_row(9, SUBCOUNTY='Subcounty 10')]
+        self.path = write_csv(rows + [facility_row(5, FACILITY_LEVEL='')]) # not a facility row
+        self.addCleanup(os.remove, self.path)
+
+    def load(self, *args):
+        out = StringIO()
+        call_command('orgunit_load', self.path, *args, stdout=out)
+        return out.getvalue().splitlines()
+
+    def counts(self, output):
+        return [line for line in output if line.split(':')[0] in ('inserted', 'updated', 'unchanged', 'missing', 'new adminunits')]
+
+    def test_dry_run_writes_nothing(self):
+        orgunits, version = OrgUnit.objects.count(), OrgUnitChange.data_version()
+        output = self.load('--dry-run')
+        self.assertEqual(output[0], '7 facility rows read, 1 rows skipped')
+        self.assertEqual(self.counts(output), ['inserted: 2', 'updated: 1', 'unchanged: 4', 'missing: 3', 'new adminunits: 1'])
+        self.assertEqual(sorted(line for line in output if line[:2] in ('+ ', '~ ', '- ')), [
+            '+ Uganda/Region 0/Subregion 0/District 0/Subcounty 0/Facility 8 HC II',
+            '+ Uganda/Region 1/Subregion 1/District 1/Subcounty 10/Facility 9 HC II',
+            '- Facility 5 HC II [id: %d]' % OrgUnit.objects.get(name='Facility 5 HC II').pk,
+            '- Facility 6 HC II [id: %d]' % OrgUnit.objects.get(name='Facility 6 HC II').pk,
+            '- Facility 7 HC II [id: %d]' % OrgUnit.objects.get(name='Facility 7 HC II').pk,
+            '~ Uganda/Region 0/Subregion 0/District 0/Subcounty 4/Facility 4 HC II',
+        ])
+        self.assertEqual((OrgUnit.objects.count(), OrgUnitChange.data_version()), (orgunits, version))
+        self.assertEqual(OrgUnit.objects.get(name='Facility 4 HC II').ownership, 'GOVT')
+
+    def test_second_run_unchanged(self):
+        self.assertEqual(self.counts(self.load()), ['inserted: 2', 'updated: 1', 'unchanged: 4', 'missing: 3', 'new adminunits: 1'])
+        self.assertEqual(OrgUnit.objects.get(name='Facility 4 HC II').ownership, 'PNFP')
+        self.assertEqual(OrgUnit.objects.get(name='Facility 9 HC II').parent.name, 'Subcounty 10')
+        version = OrgUnitChange.data_version()
+        for args in ((), ('--bulk',)):
+            self.assertEqual(self.counts(self.load(*args)), ['inserted: 0', 'updated: 0', 'unchanged: 7', 'missing: 3', 'new adminunits: 0'])
+        self.assertEqual(OrgUnitChange.data_version(), version)
+
+class BulkLoadEquivalenceTest(TestCase):
+    def setUp(self):
+        cache.clear() # paths cached by other tests, whose rolled back pks are reused
+
+    def load(self, rows, *args):
+        path = write_csv(rows)
+        self.addCleanup(os.remove, path)
+        call_command('orgunit_load', path, *args, stdout=StringIO())
+
+    def registry(self):
+        fields = ('name', 'level', 'lft', 'rght', 'tree_id', 'orgunit_type', 'ownership', 'authority', 'active', 'geometry_str',
+            'latitude', 'longitude', 'geocell', 'content_hash', 'path_key', 'search_name') + tuple(name_field for _, name_field in OrgUnit.ancestor_fields().values())
+        identifiers = {}
+        for path, agency, context, external_id in OrgUnit.identifiers.through.objects.values_list('orgunit__path_key', 'identifier__agency', 'identifier__context', 'identifier__external_id'):
+            identifiers.setdefault(path, []).append((agency, context, external_id))
+        return dict(
+            (row['path_key'], (row, sorted(identifiers.get(row['path_key'], []))))
+            for row in OrgUnit.objects.values(*fields)
+        )
+
+    def test_bulk_and_row_loads_agree(self):
+        # out of order, then changes and a new subcounty
+        first = [facility_row(i) for i in reversed(range(16))]
+        second = [facility_row(i) for i in range(12)] + [facility_row(3, OWNERSHIP_NAME='PNFP', COORDINATES='[32.5, 1.5]'), facility_row(16, SUBCOUNTY='Subcounty 0b', UID='')]
+        registries = []
+        for args in ((), ('--bulk',)):
+            OrgUnit.objects.all().delete()
+            Identifier.objects.all().delete()
+            for rows in (first, second):
+                self.load(rows, *args)
+            registries.append(self.registry())
+        row_mode, bulk = registries
+        self.assertEqual(len(row_mode), 1 + 2 + 2 + 4 + 9 + 17)
+        self.assertEqual(sorted(row_mode), sorted(bulk))
+        for key in row_mode:
+            self.assertEqual(row_mode[key], bulk[key])
+        self.assertEqual(row_mode['uganda/region 1/subregion 1/district 3/subcounty 3/facility 3 hc ii'][1], [('MOH', 'DHIS2', 'uid0003')])
+
+class FacilityBulkWriteTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        User.objects.create_user('partner', password='partner')
+
+    def setUp(self):
+        self.client.login(username='partner', password='partner')
+
+    def post(self, items):
+        return self.client.post('/api/facilities/bulk/', json.dumps(items), content_type='application/json')
+
+    def test_create_update_deactivate(self):
+        subcounty = OrgUnit.objects.get(name='Subcounty 1')
+        subcounty_path = [ou.name for ou in subcounty.get_ancestors(include_self=True)]
+        response = self.post([
+            {'action': 'create', 'path': subcounty_path + ['New HC III'], 'orgunit_type': 'HC III', 'identifiers': ['MOH::DHIS2::new0001']},
+            {'identifier': 'uid0005', 'ownership': 'PNFP'},
+            {'path': '/'.join(subcounty_path + ['Facility 1 HC II']), 'action': 'deactivate'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x['status'] for x in response.json()['results']], ['created', 'updated', 'deactivated'])
+
+        new_facility = OrgUnit.objects.get(name='New HC III')
+        self.assertEqual(new_facility.parent_id, subcounty.pk)
+        self.assertEqual(new_facility.identifiers_flat, ['MOH::DHIS2::new0001'])
+        self.assertEqual(list(new_facility.hierarchy.values()), subcounty_path)
+        self.assertEqual(OrgUnit.objects.get(name='Facility 5 HC II').ownership, 'PNFP')
+        self.assertFalse(OrgUnit.objects.get(name='Facility 1 HC II').active)
+
+    def test_invalid_item_rejects_the_batch(self):
+        facility = OrgUnit.objects.get(name='Facility 1 HC II')
+        response = self.post([
+            {'uuid': str(facility.uuid), 'ownership': 'PNFP'},
+            {'uuid': str(facility.uuid), 'name': 'Facility 5 HC II'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([x['status'] for x in response.json()['results']], ['valid', 'invalid'])
+        self.assertEqual(OrgUnit.objects.get(pk=facility.pk).ownership, 'GOVT')
+
+class RestructureAPITest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+
+    def setUp(self):
+        self.client.login(username='admin', password='admin')
+
+    def post(self, spec, **params):
+        url = '/api/adminunits/restructure/' + ('?dry_run=true' if params.get('dry_run') else '')
+        return self.client.post(url, json.dumps(spec), content_type='application/json')
+
+    def test_split_merge_and_move(self):
+        spec = {
+            'splits': [{'orgunit': 'Uganda/Region 1/Subregion 1/District 1', 'into': [{'name': 'District 9', 'children': ['Uganda/Region 1/Subregion 1/District 1/Subcounty 5']}]}],
+            'merges': [{'orgunits': ['Uganda/Region 1/Subregion 1/District 3'], 'into': 'Uganda/Region 1/Subregion 1/District 1'}],
+            'moves': [{'orgunit': str(OrgUnit.objects.get(name='Subcounty 0').uuid), 'parent': 'Uganda/Region 1/Subregion 1/District 9'}],
+        }
+        response = self.post(spec, dry_run=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(OrgUnit.objects.filter(name='District 3').exists())
+
+        response = self.post(spec)
+        self.assertEqual(response.status_code, 200)
+        summary = response.json()
+        self.assertEqual(summary['created'], ['Uganda/Region 1/Subregion 1/District 9'])
+        self.assertEqual(summary['deleted'], ['Uganda/Region 1/Subregion 1/District 3'])
+        self.assertEqual(summary['orgunits_moved'], 8) # four subcounties with their facility
+
+        self.assertFalse(OrgUnit.objects.filter(name='District 3').exists())
+        self.assertEqual(sorted(ou.name for ou in OrgUnit.objects.get(name='District 1').get_children()), ['Subcounty 1', 'Subcounty 3', 'Subcounty 7'])
+        for ou in OrgUnit.objects.filter(level=5):
+            self.assertEqual(list(ou.hierarchy.values()), [a.name for a in ou.get_ancestors()])
+            self.assertEqual(resolve_path(list(ou.hierarchy.values()) + [ou.name]), ou.pk)
+        self.assertEqual(OrgUnit.objects.get(name='Facility 0 HC II').hierarchy['district'], 'District 9')
+
+    def test_invalid_spec_changes_nothing(self):
+        for move in ({'orgunit': 'Uganda/Region 0', 'parent': 'Uganda/Region 0/Subregion 0'}, {'orgunit': 'Uganda/Region 0', 'parent': 'Uganda/Nowhere'}):
+            response = self.post({'moves': [move, {'orgunit': 'Uganda/Region 1/Subregion 1', 'parent': 'Uganda/Region 0'}]})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(len(response.json()['errors']), 1)
+        self.assertEqual(OrgUnit.objects.get(name='Subregion 1').parent.name, 'Region 1')
+        self.assertEqual(OrgUnit.objects.get(name='Region 0').parent.name, 'Uganda')
+
+    def test_unit_added_to_a_merged_unit_is_not_deleted(self):
+        district = OrgUnit.objects.get(name='District 3')
+        def add_subcounty(restructuring):
+            # another writer, between reading the tree and locking it
+            OrgUnit.objects.create(name='Subcounty 99', parent=district)
+        spec = {'merges': [{'orgunits': ['Uganda/Region 1/Subregion 1/District 3'], 'into': 'Uganda/Region 1/Subregion 1/District 1'}]}
+        with mock.patch.object(Restructure, 'lock', autospec=True, side_effect=add_subcounty):
+            with self.assertRaises(RestructureError) as raised:
+                Restructure(spec).apply()
+        self.assertEqual(raised.exception.errors, ['Uganda/Region 1/Subregion 1/District 3/Subcounty 99: added while restructuring, apply the spec again'])
+        self.assertEqual(OrgUnit.objects.get(pk=district.pk).get_descendant_count(), 4)
+        self.assertEqual(OrgUnit.objects.get(name='Subcounty 3').parent_id, district.pk)
+
+class CSVExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+
+    def setUp(self):
+        self.export_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.export_root)
+        self.settings = override_settings(EXPORT_ROOT=self.export_root)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def download(self):
+        response = self.client.get('/download/facilities.csv')
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode('utf-8')
+
+    def test_csv_content(self):
+        _, content = self.download()
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[0], [
+            'UUID', 'NAME', 'ACTIVE', 'CREATEDAT', 'UPDATEDAT', 'GEOMETRY_STR', 'ORGUNIT_TYPE', 'OWNERSHIP', 'AUTHORITY', 'IDENTIFIERS',
+            'COUNTRY', 'REGION', 'SUBREGION', 'DISTRICT', 'SUBCOUNTY',
+        ])
+        self.assertEqual(len(rows), 9)
+        facility = OrgUnit.objects.get(name='Facility 3 HC II')
+        row = dict(zip(rows[0], next(r for r in rows if r[1] == facility.name)))
+        self.assertEqual((row['UUID'], row['ORGUNIT_TYPE'], row['OWNERSHIP'], row['ACTIVE']), (str(facility.uuid), 'HC II', 'GOVT', 'True'))
+        self.assertEqual(json.loads(row['GEOMETRY_STR'])['coordinates'], [32.003, 1.003])
+        self.assertIn('uid0003', row['IDENTIFIERS'])
+        self.assertEqual([row[level] for level in ('COUNTRY', 'REGION', 'SUBREGION', 'DISTRICT', 'SUBCOUNTY')], ['Uganda', 'Region 1', 'Subregion 1', 'District 3', 'Subcounty 3'])
+
+    def test_snapshot_reused_until_a_write(self):
+        response, content = self.download()
+        self.assertNotIsInstance(response, FileResponse)
+        self.assertEqual(os.listdir(self.export_root), [os.path.basename(snapshot_path(OrgUnitChange.data_version()))])
+
+        response, cached = self.download()
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(cached, content)
+
+        facility = OrgUnit.objects.get(name='Facility 3 HC II')
+        facility.name = 'Facility 3 HC III'
+        facility.save()
+        response, content = self.download()
+        self.assertNotIsInstance(response, FileResponse)
+        self.assertIn('Facility 3 HC III', content)
+        self.assertEqual(os.listdir(self.export_root), [os.path.basename(snapshot_path(OrgUnitChange.data_version()))])
+
+@override_settings(REGISTRY_SNAPSHOT=True)
+class RegistrySnapshotTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+
+    def setUp(self):
+        # test databases roll back, a snapshot of another test could carry the same version
+        patcher = mock.patch.object(snapshot, '_snapshot', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookups_match_database(self):
+        registry = snapshot.RegistrySnapshot.load()
+        self.assertEqual(len(registry), OrgUnit.objects.count())
+        for ou in OrgUnit.objects.all():
+            entry = registry.get_by_uuid(str(ou.uuid))
+            self.assertEqual([a.pk for a in entry.ancestors()], [a.pk for a in ou.get_ancestors()])
+            self.assertEqual(registry.resolve_path([a.name for a in entry.ancestors(include_self=True)]).pk, ou.pk)
+            self.assertEqual(list(entry.identifiers), ou.identifiers_flat)
+        ids = ['uid0001', 'MOH::DHIS2::uid0002', 'OTHER::DHIS2::uid0003', 'missing']
+        self.assertEqual(registry.resolve_identifiers(ids, 'pk', 'uuid', 'name'), Identifier.resolve(ids, 'pk', 'uuid', 'name'))
+
+    def test_resolve_without_queries_and_reload_after_write(self):
+        self.client.get('/api/identifiers/resolve/', {'id': 'uid0001'}) # loads the snapshot
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/identifiers/resolve/', {'id': 'uid0001'})
+        self.assertEqual(response.json()['results']['uid0001'][0]['name'], 'Facility 1 HC II')
+
+        ou = OrgUnit.objects.get(name='Facility 1 HC II')
+        ou.name = 'Facility 1 HC III'
+        ou.save()
+        response = self.client.get('/api/identifiers/resolve/', {'id': 'uid0001'})
+        self.assertEqual(response.json()['results']['uid0001'][0]['name'], 'Facility 1 HC III')
+
+class IdentifierResolveTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        # the same external ID from another agency, on another facility
+        OrgUnit.objects.get(name='Facility 2 HC II').identifiers.add(Identifier.objects.create(agency='OTHER', context='DHIS2', external_id='uid0001'))
+
+    def resolve_names(self, response):
+        self.assertEqual(response.status_code, 200)
+        return dict((id_str, sorted(m['name'] for m in matches)) for id_str, matches in response.json()['results'].items())
+
+    def test_batch(self):
+        response = self.client.get('/api/identifiers/resolve/', {'id': ['uid0003', 'uid0004']})
+        self.assertEqual(self.resolve_names(response), {'uid0003': ['Facility 3 HC II'], 'uid0004': ['Facility 4 HC II']})
+        match = response.json()['results']['uid0003'][0]
+        ou = OrgUnit.objects.get(name='Facility 3 HC II')
+        self.assertEqual((match['uuid'], match['href']), (str(ou.uuid), 'http://testserver/api/orgunits/%d/' % ou.pk))
+        response = self.client.post('/api/identifiers/resolve/', json.dumps({'ids': ['uid0003', 'uid0004']}), content_type='application/json')
+        self.assertEqual(self.resolve_names(response), {'uid0003': ['Facility 3 HC II'], 'uid0004': ['Facility 4 HC II']})
+
+    def test_triplet_and_bare_id(self):
+        triplet = str(Identifier.objects.exclude(agency='OTHER').get(external_id='uid0001'))
+        response = self.client.get('/api/identifiers/resolve/', {'id': ['uid0001', triplet, 'OTHER::DHIS2::uid0001']})
+        self.assertEqual(self.resolve_names(response), {
+            'uid0001': ['Facility 1 HC II', 'Facility 2 HC II'], triplet: ['Facility 1 HC II'], 'OTHER::DHIS2::uid0001': ['Facility 2 HC II'],
+        })
+
+    def test_unmatched(self):
+        response = self.client.get('/api/identifiers/resolve/', {'id': ['uid0005', 'missing', 'OTHER::DHIS2::uid0005']})
+        self.assertEqual(self.resolve_names(response), {'uid0005': ['Facility 5 HC II'], 'missing': [], 'OTHER::DHIS2::uid0005': []})
+        self.assertEqual(sorted(response.json()['unmatched']), ['OTHER::DHIS2::uid0005', 'missing'])
+
+    def test_too_many_ids(self):
+        with mock.patch.object(IdentifierViewSet, 'RESOLVE_MAX_IDS', 2):
+            self.assertEqual(self.client.get('/api/identifiers/resolve/', {'id': ['uid0001', 'uid0002']}).status_code, 200)
+            self.assertEqual(self.client.get('/api/identifiers/resolve/', {'id': ['uid0001', 'uid0002', 'uid0003']}).status_code, 400)
+            response = self.client.post('/api/identifiers/resolve/', json.dumps({'ids': ['uid0001', 'uid0002', 'uid0003']}), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/api/identifiers/resolve/', '["uid0001"]', content_type='application/json').status_code, 400)
+
+class ConditionalRequestTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+
+    def test_not_modified_until_the_registry_changes(self):
+        for url in ('/api/facilities/', '/geojson/facilities.json', '/download/facilities.csv', '/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            with self.assertNumQueries(1): # the change log only
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        response = self.client.get('/api/facilities/')
+        identifier = Identifier.objects.get(external_id='uid0001')
+        identifier.external_id = 'uid9001'
+        identifier.save()
+        self.assertEqual(self.client.get('/api/facilities/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_etag_depends_on_format(self):
+        json_etag = self.client.get('/api/facilities/', HTTP_ACCEPT='application/json')['ETag']
+        html_etag = self.client.get('/api/facilities/', HTTP_ACCEPT='text/html')['ETag']
+        self.assertNotEqual(json_etag, html_etag)
+
+class FacilityGeoJSONTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        OrgUnit.objects.filter(name__in=['Facility 1 HC II', 'Facility 2 HC II', 'Facility 5 HC II']).update(orgunit_type='HC III')
+        OrgUnit.objects.filter(name='Facility 5 HC II').update(ownership='PNFP')
+
+    def names(self, **params):
+        response = self.client.get('/geojson/facilities.json', params)
+        self.assertEqual(response.status_code, 200)
+        collection = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        return sorted(feature['properties']['name'] for feature in collection['features'])
+
+    def test_feature_collection(self):
+        response = self.client.get('/geojson/facilities.json')
+        features = json.loads(b''.join(response.streaming_content).decode())['features']
+        self.assertEqual(len(features), 8)
+        facility = OrgUnit.objects.get(name='Facility 3 HC II')
+        feature = next(f for f in features if f['properties']['name'] == facility.name)
+        self.assertEqual(feature['type'], 'Feature')
+        self.assertEqual(feature['geometry'], {'type': 'Point', 'coordinates': [facility.longitude, facility.latitude]})
+        self.assertEqual(feature['properties']['uuid'], str(facility.uuid))
+        self.assertNotIn('geometry', feature['properties'])
+
+    def test_filters(self):
+        self.assertEqual(self.names(type='HC III'), ['Facility 1 HC II', 'Facility 2 HC II', 'Facility 5 HC II'])
+        self.assertEqual(self.names(type='HC III', ownership='PNFP'), ['Facility 5 HC II'])
+        district = OrgUnit.objects.get(name='District 1')
+        self.assertEqual(self.names(ancestor=str(district.uuid)), ['Facility 1 HC II', 'Facility 5 HC II'])
+        self.assertEqual(self.names(type='HC III', district_id=district.pk), ['Facility 1 HC II', 'Facility 5 HC II'])
+        self.assertEqual(self.names(ancestor=str(OrgUnit.objects.get(name='Facility 1 HC II').uuid)), [])
+
+    def test_bad_ancestor(self):
+        for url in ('/geojson/facilities.json', '/geojson/adminunits.json'):
+            self.assertEqual(self.client.get(url, {'ancestor': 'not-a-uuid'}).status_code, 400)
+            self.assertEqual(self.client.get(url, {'ancestor': '00000000-0000-0000-0000-000000000000'}).status_code, 404)
+        self.assertEqual(self.client.get('/geojson/facilities.json', {'district_id': 'x'}).status_code, 400)
+
+class ChangeFeedTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+
+    def feed(self, **params):
+        response = self.client.get('/api/changes/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages_cover_every_change_once(self):
+        total = OrgUnit.objects.count()
+        self.assertEqual(len(self.feed()['results']), total)
+
+        seen, since = [], 0
+        while True:
+            data = self.feed(since=since, limit=5)
+            seen += [change['uuid'] for change in data['results']]
+            if not data['has_more']:
+                break
+            self.assertGreater(int(data['sync_token']), since)
+            since = int(data['sync_token'])
+        self.assertEqual(len(seen), total)
+        self.assertEqual(set(seen), set(str(uuid) for uuid in OrgUnit.objects.values_list('uuid', flat=True)))
+
+    def test_limit_and_since_are_checked(self):
+        for limit in (0, -1):
+            data = self.feed(limit=limit)
+            self.assertEqual(len(data['results']), 1)
+            self.assertTrue(data['has_more'])
+            self.assertNotEqual(data['sync_token'], '0')
+        for since in (-1, 'x'):
+            self.assertEqual(self.client.get('/api/changes/', {'since': since}).status_code, 400)
+        self.assertEqual(self.client.get('/api/changes/', {'updated_since': 'yesterday'}).status_code, 400)
+
+    def test_updates_and_tombstones(self):
+        since = self.feed()['sync_token']
+        self.assertEqual(self.feed(since=since), {'sync_token': since, 'has_more': False, 'next': None, 'results': []})
+
+        facility = OrgUnit.objects.get(name='Facility 1 HC II')
+        facility.name = 'Facility 1 HC III'
+        facility.save()
+        deleted = OrgUnit.objects.get(name='Facility 2 HC II')
+        deleted_uuid = str(deleted.uuid)
+        deleted.delete()
+
+        results = self.feed(since=since)['results']
+        self.assertEqual([(change['action'], change['uuid']) for change in results], [
+            (OrgUnitChange.UPDATED, str(facility.uuid)),
+            (OrgUnitChange.DELETED, deleted_uuid),
+        ])
+        self.assertEqual(results[0]['orgunit']['name'], 'Facility 1 HC III')
+        self.assertIsNone(results[1]['orgunit'])
+
+        # only changes after the timestamp
+        changed_at = OrgUnitChange.objects.get(seq=int(since)).changed_at
+        self.assertEqual(len(self.feed(updated_since=changed_at.isoformat())['results']), 2)
+        self.assertEqual(self.feed(updated_since=timezone.now().isoformat())['results'], [])
+
+    def test_late_commit_is_not_skipped(self):
+        # a long import allocates its ids first but commits after a later
+        # writer; its changes are numbered when it commits
+        facility, other = OrgUnit.objects.filter(level=5)[:2]
+        pending = OrgUnitChange.objects.create(orgunit_id=facility.pk, uuid=facility.uuid, action=OrgUnitChange.UPDATED)
+        committed = OrgUnitChange.objects.create(orgunit_id=other.pk, uuid=other.uuid, action=OrgUnitChange.UPDATED)
+        committed.seq = OrgUnitChange.data_version() + 1
+        committed.save()
+
+        since = self.feed()['sync_token']
+        self.assertEqual(since, str(committed.seq))
+        self.assertEqual(OrgUnitChange.assign_sequence(), 1)
+        pending.refresh_from_db()
+        self.assertGreater(pending.seq, committed.seq)
+        self.assertEqual([change['uuid'] for change in self.feed(since=since)['results']], [str(facility.uuid)])
+
+class SyntheticRegistryTest(TestCase):
+    def test_reproducible_and_loadable(self):
+        rows = list(SyntheticRegistry(2000, seed=3).rows())
+        self.assertEqual(rows, list(SyntheticRegistry(2000, seed=3).rows()))
+        self.assertNotEqual(rows, list(SyntheticRegistry(2000, seed=4).rows()))
+
+        BulkOrgUnitLoader().load([parse_row(row) for row in rows])
+        self.assertEqual(OrgUnit.objects.count(), 2000)
+        self.assertEqual(OrgUnit.objects.filter(level=5).count(), len(rows))
+        self.assertEqual(OrgUnit.objects.filter(level=1).count(), 4)
+
+    def test_benchmark_results(self):
+        results = run_benchmarks(300, repeat=1)
+        self.assertEqual(results['meta']['orgunits'], 300)
+        by_name = dict((r['name'], r) for r in results['results'])
+        self.assertEqual(by_name['import_unchanged']['unchanged'], results['meta']['facilities'])
+        self.assertEqual(by_name['api_not_modified']['status'], 304)
+        self.assertGreater(by_name['csv_export']['peak_memory_bytes'], 0)
+
+class MetricsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+
+    def setUp(self):
+        patcher = mock.patch.object(metrics, 'registry', metrics.MetricsRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_measured_per_action(self):
+        self.client.get('/api/facilities/', {'page_size': 5})
+        self.client.get('/api/facilities/', {'page_size': 5})
+        self.client.get('/api/orgunits/missing/')
+        stats = metrics.registry.histograms['simplemfl_db_queries'][('facilities-list', 'list', 'GET')]
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.sum, 2 * 4)
+        self.assertGreater(metrics.registry.histograms['simplemfl_serializer_duration_seconds'][('facilities-list', 'list', 'GET')].sum, 0)
+        self.assertEqual(metrics.registry.requests[('orgunit-detail', 'retrieve', 'GET', '404')], 1)
+
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.login(username='admin', password='admin')
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('simplemfl_http_requests_total{endpoint="facilities-list",action="list",method="GET",status="200"} 2', text)
+        self.assertIn('simplemfl_db_queries_bucket{endpoint="facilities-list",action="list",method="GET",le="+Inf"} 2', text)
+
+    @override_settings(METRICS_SLOW_REQUEST_SECONDS=0)
+    def test_slow_request_trace_groups_queries(self):
+        response = self.client.get('/geojson/facilities.json')
+        b''.join(response.streaming_content)
+        trace = metrics.registry.slow_requests[-1]
+        self.assertEqual(trace['endpoint'], 'facilities-geojson')
+        self.assertEqual(trace['queries'], sum(s['count'] for s in trace['statements']))
+        self.assertEqual(trace['size'], len(self.client.get('/geojson/facilities.json').getvalue()))
+
+    def test_stream_recorded_on_close(self):
+        response = self.client.get('/geojson/facilities.json')
+        # never consumed: the next request starts from its own stats
+        self.assertIsNone(metrics._local.stats)
+        self.client.get('/api/facilities/', {'page_size': 5})
+        self.assertEqual(metrics.registry.histograms['simplemfl_db_queries'][('facilities-list', 'list', 'GET')].sum, 4)
+        self.assertNotIn(('facilities-geojson', '', 'GET', '200'), metrics.registry.requests)
+
+        response.close()
+        self.assertEqual(metrics.registry.requests[('facilities-geojson', '', 'GET', '200')], 1)
+        self.assertEqual(metrics.registry.histograms['simplemfl_http_response_size_bytes'][('facilities-geojson', '', 'GET')].sum, 0)
+
+class NameSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        OrgUnit(name='Kiruddu H/C III', parent=OrgUnit.objects.get(name='Subcounty 1'), orgunit_type='HC III').save()
+
+    def search(self, q, **params):
+        response = self.client.get('/api/facilities/search/', dict(params, q=q))
+        self.assertEqual(response.status_code, 200)
+        return [r['name'] for r in response.json()['results']]
+
+    def test_normalized_name(self):
+        self.assertEqual(normalize_name(' Kiruddu  Health Centre III '), 'kiruddu hc iii')
+        self.assertEqual(normalize_name('St. Mary\'s H/C IV'), 'st mary s hc iv')
+        self.assertEqual(OrgUnit.objects.get(name='Facility 3 HC II').search_name, 'facility 3 hc ii')
+        long_name = 'Kiruddu HCIII ' + '\ufb03' * 82 # the ligature decomposes into 'ffi'
+        self.assertEqual(len(long_name), 96)
+        self.assertEqual(normalize_name(long_name), 'kiruddu hc iii ' + 'ffi' * 27)
+
+    def test_typos_and_variants(self):
+        self.assertEqual(self.search('kirudu health center 3')[:1], ['Kiruddu H/C III'])
+        self.assertEqual(self.search('Kirrudu')[:1], ['Kiruddu H/C III'])
+        self.assertEqual(self.search('facilty 6')[0], 'Facility 6 HC II')
+
+    def test_scoped_to_ancestor(self):
+        district = OrgUnit.objects.get(name='District 1')
+        names = self.search('facility', within=str(district.uuid))
+        self.assertEqual(sorted(names), ['Facility 1 HC II', 'Facility 5 HC II'])
+        self.assertNotIn('Facility 5 HC II', self.search('facility 5', district_id=OrgUnit.objects.get(name='District 0').pk))
+        self.assertEqual(self.client.get('/api/facilities/search/', {'q': 'facility', 'within': '999999'}).status_code, 404)
+
+    def test_index_follows_writes(self):
+        ou = OrgUnit.objects.get(name='Facility 2 HC II')
+        ou.name = 'Nakasero Hospital'
+        ou.save()
+        self.assertEqual(set(OrgUnitNameGram.objects.filter(orgunit_id=ou.pk).values_list('gram', flat=True)), name_grams('nakasero hospital'))
+        self.assertEqual(self.search('nakaser')[:1], ['Nakasero Hospital'])
+        ou.delete()
+        self.assertFalse(OrgUnitNameGram.objects.filter(orgunit_id=ou.pk).exists())
+
+    def test_admin_search_within_filters(self):
+        load_facilities(120) # more matches than the admin search keeps
+        OrgUnit.objects.filter(name='Facility 119 HC II').update(ownership='PNFP')
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/admin/facilities/orgunit/', {'q': 'facility', 'ownership__exact': 'PNFP'})
+        self.assertEqual([ou.name for ou in response.context['cl'].result_list], ['Facility 119 HC II'])
+
+class DuplicateDetectionTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(16)
+        # Facility 3 again, spelt differently and 30m away
+        OrgUnit(name='Facility 3 Health Centre II', parent=OrgUnit.objects.get(name='Subcounty 3'), orgunit_type='HC II',
+            geometry_str='{"type": "Point", "coordinates": [32.0033, 1.0032]}').save()
+
+    def pairs(self):
+        return set(tuple(sorted((row['name_a'], row['name_b']))) for row in duplicate_report())
+
+    def test_full_scan(self):
+        detector = DuplicateDetector()
+        scan = detector.run()
+        self.assertTrue(scan.full)
+        self.assertEqual(self.pairs(), {('Facility 3 HC II', 'Facility 3 Health Centre II')})
+        row = next(duplicate_report())
+        self.assertEqual(row['path_a'], 'Uganda/Region 1/Subregion 1/District 3/Subcounty 3')
+        self.assertIn('same parent', row['reasons'])
+
+    def test_incremental_scan(self):
+        DuplicateDetector().run()
+        ou = OrgUnit.objects.get(name='Facility 12 HC II')
+        ou.name = 'Facility 4 H/C II' # Facility 4 is in the same subcounty
+        ou.geometry_str = '{"type": "Point", "coordinates": [32.0041, 1.0041]}'
+        ou.save()
+        scan = DuplicateDetector().run()
+        self.assertFalse(scan.full)
+        self.assertEqual(scan.orgunits_checked, 1)
+        self.assertLess(scan.pairs_compared, 17)
+        self.assertIn(('Facility 4 H/C II', 'Facility 4 HC II'), self.pairs())
+
+        # dismissed pairs stay dismissed, pairs with a deleted facility go
+        DuplicateCandidate.objects.filter(orgunit_b_id=ou.pk).update(status=DuplicateCandidate.DISMISSED)
+        OrgUnit.objects.get(name='Facility 3 Health Centre II').delete()
+        DuplicateDetector().run()
+        self.assertEqual(self.pairs(), set())
+        self.assertEqual(DuplicateCandidate.objects.filter(status=DuplicateCandidate.DISMISSED).count(), 1)
+
+    def test_api(self):
+        DuplicateDetector().run()
+        results = self.client.get('/api/duplicates/').json()['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(self.client.post('/api/duplicates/%d/review/' % results[0]['id'], {'status': 'dismissed'}).status_code, 403)
+
+        self.client.force_login(User.objects.create_user('reviewer'))
+        self.assertEqual(self.client.post('/api/duplicates/%d/review/' % results[0]['id'], {'status': 'merged'}).status_code, 400)
+        self.assertEqual(self.client.post('/api/duplicates/%d/review/' % results[0]['id'], '["dismissed"]', content_type='application/json').status_code, 400)
+        response = self.client.post('/api/duplicates/%d/review/' % results[0]['id'], {'status': 'dismissed'})
+        self.assertEqual(response.json()['status'], 'dismissed')
+        self.assertEqual(self.client.get('/api/duplicates/').json()['results'], [])
+        self.assertEqual(len(self.client.get('/api/duplicates/', {'status': 'dismissed'}).json()['results']), 1)
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.assertEqual(self.client.post('/api/duplicates/scan/', '[true]', content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post('/api/duplicates/scan/', '{"full": true}', content_type='application/json').status_code, 200)
+
+    def test_api_paging(self):
+        OrgUnit(name='Facility 5 Health Centre II', parent=OrgUnit.objects.get(name='Subcounty 5'), orgunit_type='HC II',
+            geometry_str='{"type": "Point", "coordinates": [32.0053, 1.0052]}').save()
+        DuplicateDetector().run()
+        self.assertEqual(len(self.client.get('/api/duplicates/').json()['results']), 2)
+        for params, count in (({'limit': 0}, 1), ({'limit': -1}, 1), ({'limit': 1, 'offset': 1}, 1), ({'offset': -1}, 2), ({'offset': 2}, 0)):
+            response = self.client.get('/api/duplicates/', params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['count'], count)
+
+class AuditTest(TransactionTestCase):
+    # CRUD events are queued on commit, which TestCase never does
+
+    def setUp(self):
+        load_facilities(8)
+
+    def test_bulk_write_is_one_change_set(self):
+        User.objects.create_user('partner', password='partner')
+        self.client.login(username='partner', password='partner')
+        events = CRUDEvent.objects.count()
+        response = self.client.post('/api/facilities/bulk/', json.dumps([
+            {'action': 'create', 'path': ['Uganda', 'Region 1', 'Subregion 1', 'District 1', 'Subcounty 1', 'New HC III'], 'orgunit_type': 'HC III', 'identifiers': ['MOH::DHIS2::new0001']},
+            {'identifier': 'uid0005', 'ownership': 'PNFP'},
+        ]), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CRUDEvent.objects.count(), events)
+
+        self.assertEqual(AuditChangeSet.objects.get(operation='orgunit import').get_counts(), {'facilities.orgunit': {'created': 25, 'm2m': 8}})
+        change_set = AuditChangeSet.objects.get(operation='facility batch')
+        self.assertEqual((change_set.user.username, change_set.object_count), ('partner', 3))
+        self.assertEqual(change_set.get_counts(), {'facilities.orgunit': {'created': 1, 'updated': 1, 'm2m': 1}})
+        facility = OrgUnit.objects.get(name='Facility 5 HC II')
+        self.assertEqual(change_set.get_changes()['facilities.orgunit']['updated'], [[facility.pk, {'ownership': ['GOVT', 'PNFP']}]])
+
+    def test_events_written_together_after_commit(self):
+        facilities = list(OrgUnit.objects.exclude(orgunit_type='ADMIN')[:3])
+        events = CRUDEvent.objects.count()
+        with mock.patch.object(CRUDEvent.objects, 'bulk_create', wraps=CRUDEvent.objects.bulk_create) as bulk_create:
+            with audit.buffered_audit():
+                with transaction.atomic():
+                    for ou in facilities:
+                        ou.ownership = 'PFP'
+                        ou.save()
+                try:
+                    with transaction.atomic():
+                        facilities[0].delete()
+                        raise ValueError
+                except ValueError:
+                    pass
+                self.assertEqual(CRUDEvent.objects.count(), events)
+        self.assertEqual(bulk_create.call_count, 1)
+        self.assertEqual(list(CRUDEvent.objects.filter(pk__gt=0).order_by('pk').values_list('event_type', flat=True)[events:]), [CRUDEvent.UPDATE] * 3)
+
+    @override_settings(AUDIT_ASYNC=True)
+    def test_background_writer(self):
+        ou = OrgUnit.objects.get(name='Facility 1 HC II')
+        with mock.patch.object(audit, 'insert_events') as insert_events:
+            ou.active = False
+            ou.save()
+            audit.wait_for_audit_writer()
+        [events], _ = insert_events.call_args
+        self.assertEqual([(e.event_type, e.object_id) for e in events], [(CRUDEvent.UPDATE, ou.pk)])
+
+    @override_settings(AUDIT_ASYNC=True, AUDIT_RETRY_DELAY=0)
+    def test_background_writer_retries(self):
+        ou = OrgUnit.objects.get(name='Facility 1 HC II')
+        events = CRUDEvent.objects.count()
+        bulk_create = CRUDEvent.objects.bulk_create
+        def insert_once_reconnected(*args, **kwargs):
+            # the first insert finds the connection gone, as after a database restart
+            if insert.call_count == 1:
+                raise OperationalError('server closed the connection unexpectedly')
+            return bulk_create(*args, **kwargs)
+        with mock.patch.object(CRUDEvent.objects, 'bulk_create', side_effect=insert_once_reconnected) as insert, \
+                self.assertLogs('facilities.audit', 'WARNING'):
+            ou.active = False
+            ou.save()
+            audit.wait_for_audit_writer()
+        self.assertEqual(insert.call_count, 2)
+        self.assertEqual(list(CRUDEvent.objects.order_by('pk').values_list('event_type', 'object_id')[events:]), [(CRUDEvent.UPDATE, ou.pk)])
+
+class FacilityTileTest(TransactionTestCase):
+    # cached tiles are dropped on commit
+
+    def setUp(self):
+        load_facilities(8)
+        OrgUnit(name='Faraway HC IV', parent=OrgUnit.objects.get(name='Subcounty 0'), orgunit_type='HC IV',
+            geometry_str='{"type": "Point", "coordinates": [34.5, 3.5]}').save()
+        self.tile_root = tempfile.mkdtemp()
+        self.settings = override_settings(TILE_ROOT=self.tile_root)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.tile_root)
+
+    def tile(self, z, lat, lon, **params):
+        x, y = tiles.tile_of(lat, lon, z)
+        response = self.client.get('/tiles/%d/%d/%d' % (z, x, y), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['features']
+
+    def cached_tiles(self):
+        return sorted(os.path.relpath(os.path.join(path, name), self.tile_root) for path, _, names in os.walk(self.tile_root) for name in names)
+
+    def test_points_and_clusters(self):
+        features = self.tile(16, 1.003, 32.003)
+        self.assertIn('Facility 3 HC II', [f['properties']['name'] for f in features])
+        self.assertEqual(features[0]['geometry']['type'], 'Point')
+        south, west, north, east = tiles.tile_bounds(16, *tiles.tile_of(1.003, 32.003, 16))
+        for f in features:
+            lon, lat = f['geometry']['coordinates']
+            self.assertTrue(south <= lat <= north and west <= lon <= east)
+
+        # all 8 close together in one cluster at low zoom, the faraway one on its own
+        features = self.tile(4, 1.003, 32.003)
+        self.assertEqual([(f['properties'].get('cluster'), f['properties'].get('count')) for f in features], [(True, 8), (None, None)])
+        self.assertEqual(features[0]['properties']['types'], {'HC II': 8})
+        self.assertEqual(self.tile(4, 1.003, 32.003, type='HC IV')[0]['properties']['name'], 'Faraway HC IV')
+        self.assertEqual(self.client.get('/tiles/17/0/0').status_code, 404)
+        self.assertEqual(self.client.get('/tiles/2/4/0').status_code, 404)
+
+    def test_gzip(self):
+        x, y = tiles.tile_of(3.5, 34.5, 12)
+        response = self.client.get('/tiles/12/%d/%d' % (x, y), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content).decode())['features'][0]['properties']['name'], 'Faraway HC IV')
+
+    def test_only_touched_tiles_dropped(self):
+        for z in (4, 12, 16):
+            self.tile(z, 1.003, 32.003)
+            self.tile(z, 3.5, 34.5)
+        self.assertEqual(len(self.cached_tiles()), 5) # one z4 tile holds both
+
+        ou = OrgUnit.objects.get(name='Faraway HC IV')
+        ou.geometry_str = '{"type": "Point", "coordinates": [34.6, 3.6]}'
+        ou.save()
+        # the shared z4 tile and the ones the faraway facility was in go, the others stay
+        self.assertEqual(self.cached_tiles(), sorted(
+            os.path.join('v1', 'all', str(z), str(x), '%d.json.gz' % y) for z in (12, 16) for x, y in [tiles.tile_of(1.003, 32.003, z)]
+        ))
+        self.assertEqual(self.tile(16, 3.5, 34.5), [])
+        self.assertEqual(len(self.cached_tiles()), 2) # empty tiles aren't kept
+
+    def test_unknown_filter_values(self):
+        for params in ({'type': 'HC V'}, {'ownership': 'GOVT,x'}, {'authority': '../../etc'}):
+            self.assertEqual(self.client.get('/tiles/4/9/7', params).status_code, 400)
+        self.assertEqual(self.cached_tiles(), [])
+
+def ragged_polygon(lon, lat, radius, vertices=2000):
+    # a circle with a jagged edge, like a surveyed boundary
+    ring = [[round(lon + radius * (1 + 0.01 * (i % 3)) * math.cos(2 * math.pi * i / vertices), 6),
+             round(lat + radius * (1 + 0.01 * (i % 3)) * math.sin(2 * math.pi * i / vertices), 6)] for i in range(vertices)]
+    return json.dumps({'type': 'Polygon', 'coordinates': [ring + ring[:1]]})
+
+class BoundaryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(8)
+        for i in range(4):
+            district = OrgUnit.objects.get(name='District %d' % i)
+            district.geometry_str = ragged_polygon(32 + i, 1, 0.3)
+            district.save()
+
+    def test_levels_stored_on_save(self):
+        district = OrgUnit.objects.get(name='District 2')
+        ring = json.loads(district.geometry_str)['coordinates'][0]
+        self.assertEqual((district.bbox_west, district.bbox_north), (min(p[0] for p in ring), max(p[1] for p in ring)))
+        self.assertIsNone(district.latitude)
+        facility = OrgUnit.objects.get(name='Facility 2 HC II')
+        self.assertEqual((facility.bbox_west, facility.bbox_north), (facility.longitude, facility.latitude))
+
+        levels = dict(OrgUnitGeometry.objects.filter(orgunit_id=district.pk).values_list('resolution', 'geometry_str'))
+        sizes = [len(json.loads(levels[r])['coordinates'][0]) for r in (OrgUnitGeometry.LOW, OrgUnitGeometry.MEDIUM, OrgUnitGeometry.HIGH)]
+        self.assertEqual(sizes, sorted(sizes))
+        self.assertLess(sizes[0], 200)
+        self.assertLess(len(levels[OrgUnitGeometry.LOW]) * 20, len(district.geometry_str))
+
+        # unchanged geometries aren't simplified again, a point has no levels
+        self.assertEqual(store_geometries([(district.pk, district.geometry_str)]), 0)
+        district.geometry_str = '{"type": "Point", "coordinates": [34, 1]}'
+        district.save()
+        self.assertFalse(OrgUnitGeometry.objects.filter(orgunit_id=district.pk).exists())
+
+    def test_adminunits_geojson(self):
+        response = self.client.get('/geojson/adminunits.json', {'level': 'district'})
+        self.assertEqual(response.status_code, 200)
+        features = json.loads(b''.join(response.streaming_content).decode())['features']
+        self.assertEqual(sorted(f['properties']['name'] for f in features), ['District 0', 'District 1', 'District 2', 'District 3'])
+        district = OrgUnit.objects.get(name=features[0]['properties']['name'])
+        self.assertEqual(features[0]['properties']['bbox'], [district.bbox_west, district.bbox_south, district.bbox_east, district.bbox_north])
+        self.assertLess(len(features[0]['geometry']['coordinates'][0]), 200)
+
+        response = self.client.get('/geojson/adminunits.json', {'level': 3, 'zoom': 15})
+        features = json.loads(b''.join(response.streaming_content).decode())['features']
+        district = OrgUnit.objects.get(name=features[1]['properties']['name'])
+        self.assertTrue(features[1]['geometry'] == json.loads(district.geometry_str))
+        self.assertEqual(self.client.get('/geojson/adminunits.json', {'resolution': 'tiny'}).status_code, 400)
+
+    def test_api_resolution(self):
+        district = OrgUnit.objects.get(name='District 1')
+        with self.assertNumQueries(5): # registry version, path, count, page (levels in a subquery), identifiers
+            response = self.client.get('/api/adminunits/', {'path': 'Uganda/Region 1/Subregion 1/District 1', 'resolution': 'medium'})
+        geometry = response.json()['results'][0]['geometry']
+        self.assertEqual(geometry, json.loads(OrgUnitGeometry.objects.get(orgunit_id=district.pk, resolution=OrgUnitGeometry.MEDIUM).geometry_str))
+        # lists are in full unless asked otherwise, the same as each orgunit's detail
+        response = self.client.get('/api/adminunits/', {'page_size': 100})
+        self.assertEqual(response.content, self.client.get('/api/adminunits/', {'page_size': 100, 'resolution': 'full'}).content)
+        results = response.json()['results']
+        self.assertEqual(results, [self.client.get(row['href']).json() for row in results])
+        self.assertTrue(dict((row['name'], row['geometry']) for row in results)['District 1'] == json.loads(district.geometry_str))
+
+        response = self.client.get('/api/facilities/', {'zoom': 5})
+        self.assertEqual(response.json()['results'][0]['geometry']['type'], 'Point')
+        self.assertEqual(self.client.get('/api/orgunits/', {'zoom': 'x'}).status_code, 400)
+
+class PlacementTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        load_facilities(40) # the facilities of every district are within 0.04 degrees of each other
+
+    def test_extents(self):
+        stats = check_placement()
+        self.assertEqual((stats['facilities_checked'], stats['boundary_polygons'], stats['facilities_misplaced']), (40, 0, 0))
+        self.assertEqual(OrgUnitExtent.objects.count(), stats['derived_extents'])
+        self.assertEqual(check_placement()['derived_extents'], stats['derived_extents']) # derived again, not reused
+
+        # checked on save, against the stored extents
+        ou = OrgUnit.objects.get(name='Facility 4 HC II')
+        ou.geometry_str = '{"type": "Point", "coordinates": [33.5, 2.5]}'
+        ou.save()
+        misplaced = MisplacedFacility.objects.get()
+        self.assertEqual((misplaced.orgunit_id, misplaced.level, misplaced.method, misplaced.found_id), (ou.pk, 0, MisplacedFacility.EXTENT, None))
+        ou.geometry_str = '{"type": "Point", "coordinates": [32.004, 1.004]}'
+        ou.save()
+        self.assertFalse(MisplacedFacility.objects.exists())
+
+    def test_load_checks_once(self):
+        path = write_csv([facility_row(i) for i in range(41)])
+        self.addCleanup(os.remove, path)
+        with mock.patch('facilities.placement.check_placement', wraps=check_placement) as on_save, \
+                mock.patch('facilities.management.commands.orgunit_load.check_placement', wraps=check_placement) as full:
+            out = StringIO()
+            call_command('orgunit_load', path, stdout=out)
+            self.assertEqual((on_save.call_count, full.call_count), (0, 1))
+            self.assertIn('facilities checked: 41', out.getvalue())
+            call_command('orgunit_load', path, stdout=StringIO()) # nothing to write, nothing to check
+            self.assertEqual(full.call_count, 1)
+
+    def test_polygons(self):
+        check_placement()
+        # District 1 is drawn away from its facilities, which are in District 0
+        for i, lon in ((0, 32.02), (1, 33.02)):
+            district = OrgUnit.objects.get(name='District %d' % i)
+            district.geometry_str = ragged_polygon(lon, 1.02, 0.1)
+            district.save()
+        rows = list(placement_report())
+        self.assertEqual(sorted(row['name'] for row in rows), ['Facility %d HC II' % i for i in (1, 13, 17, 21, 25, 29, 33, 37, 5, 9)])
+        self.assertEqual(set((row['level'], row['method'], row['expected'], row['found']) for row in rows), {
+            ('District', MisplacedFacility.POLYGON, 'Uganda/Region 1/Subregion 1/District 1', 'Uganda/Region 0/Subregion 0/District 0'),
+        })
+        self.assertEqual(check_placement()['facilities_misplaced'], 10)
+        for params, count in (({'limit': 0}, 1), ({'limit': -1}, 1), ({'limit': 4, 'offset': 8}, 2), ({'offset': -1}, 10)):
+            response = self.client.get('/api/misplaced/', params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['count'], count)
+
+        # a corrected boundary clears them
+        district = OrgUnit.objects.get(name='District 1')
+        district.geometry_str = ragged_polygon(32.02, 1.02, 0.1)
+        district.save()
+        self.assertFalse(MisplacedFacility.objects.exists())
+
+    def test_api(self):
+        self.assertEqual(self.client.post('/api/misplaced/check/').status_code, 403)
+        check_placement()
+        ou = OrgUnit.objects.get(name='Facility 4 HC II')
+        ou.geometry_str = '{"type": "Point", "coordinates": [33.5, 2.5]}'
+        ou.save()
+        results = self.client.get('/api/misplaced/', {'level': 'country'}).json()['results']
+        self.assertEqual([(row['name'], row['expected'], row['found']) for row in results], [('Facility 4 HC II', 'Uganda', None)])
+        self.assertEqual(self.client.get('/api/misplaced/', {'level': 'district'}).json()['results'], [])
+        self.assertEqual(self.client.get('/api/misplaced/', {'level': 'ward'}).status_code, 400)
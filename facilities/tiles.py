@@ -0,0 +1,216 @@
+from django.conf import settings
+from django.db import transaction
+
+from collections import OrderedDict
+from functools import partial
+import gzip
+import hashlib
+import json
+import math
+import os
+import tempfile
+
+from facilities.bulk import bulk_fetch
+from facilities.models import OrgUnit, OrgUnitChange
+
+# Facility points as slippy map tiles (z/x/y, web mercator), so map clients
+# only download what is on screen. A tile is a GeoJSON FeatureCollection of
+# the facilities whose coordinates fall in it, optionally filtered by type,
+# ownership and authority. Below TILE_CLUSTER_ZOOM nearby points are merged
+# into clusters (one per 1/CLUSTER_GRID of the tile width) carrying a count
+# per facility type.
+#
+# Rendered tiles are kept gzipped on disk under settings.TILE_ROOT, one
+# directory per filter combination, and handed out as they are to clients
+# accepting gzip. Empty tiles (most of the world at high zoom) are cheap to
+# render and not kept, and filters only take the codes the registry uses, so
+# requests for arbitrary tiles or filters can't fill the disk. Writes don't clear the cache: the tiles containing the old
+# and new position of every written facility are deleted, at every zoom and
+# for every filter, once the transaction commits. A tile rendered while the
+# registry changed isn't stored.
+
+TILE_LAYOUT = 1 # bump when the tile contents change, so old cached tiles aren't served
+CLUSTER_GRID = 16 # clusters per tile side, i.e. 16 x 16 pixel cells of a 256 pixel tile
+FILTER_PARAMS = (('type', 'orgunit_type'), ('ownership', 'ownership'), ('authority', 'authority'))
+WALK_THRESHOLD = 5000 # above this many touched tiles, scan the cached ones instead of probing each
+
+def max_zoom():
+    return getattr(settings, 'TILE_MAX_ZOOM', 16)
+
+def cluster_zoom():
+    return getattr(settings, 'TILE_CLUSTER_ZOOM', 11)
+
+def tile_of(lat, lon, z):
+    """
+    (x, y) of the tile containing (lat, lon) at zoom `z`
+    """
+    n = 2 ** z
+    lat = max(-85.0511, min(85.0511, lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_bounds(z, x, y):
+    """
+    (south, west, north, east) of a tile in degrees
+    """
+    n = 2 ** z
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0
+
+def touched_tiles(points):
+    """
+    (z, x, y) of the tiles containing any of the (lat, lon) `points`, at
+    every zoom served
+    """
+    tiles = set()
+    for lat, lon in points:
+        if lat is None or lon is None:
+            continue
+        for z in range(max_zoom() + 1):
+            tiles.add((z,) + tile_of(lat, lon, z))
+    return tiles
+
+def tile_filters(params):
+    """
+    Canonical {field: sorted values} of the filter parameters of a request,
+    raises ValueError for a value that isn't one of the field's codes
+    """
+    filters = OrderedDict()
+    for param, field in FILTER_PARAMS:
+        values = sorted(set(v for value in params.getlist(param) for v in value.split(',') if v))
+        codes = dict(OrgUnit._meta.get_field(field).choices)
+        unknown = [v for v in values if v not in codes]
+        if unknown:
+            raise ValueError('{0}: unknown code {1}, expected one of {2}'.format(param, ', '.join(unknown), ', '.join(codes)))
+        if values:
+            filters[field] = values
+    return filters
+
+def filter_key(filters):
+    if not filters:
+        return 'all'
+    return hashlib.sha1(json.dumps(filters).encode('utf-8')).hexdigest()[:16]
+
+def tile_root():
+    root = getattr(settings, 'TILE_ROOT', None)
+    return os.path.join(root, 'v{0}'.format(TILE_LAYOUT)) if root else None
+
+def tile_path(filters, z, x, y):
+    """
+    Location of a cached tile, None when tiles aren't cached (settings.TILE_ROOT
+    is unset)
+    """
+    root = tile_root()
+    if root is None:
+        return None
+    return os.path.join(root, filter_key(filters), str(z), str(x), '{0}.json.gz'.format(y))
+
+def feature(lon, lat, properties):
+    return OrderedDict([
+        ('type', 'Feature'),
+        ('geometry', OrderedDict([('type', 'Point'), ('coordinates', [round(lon, 6), round(lat, 6)])])),
+        ('properties', properties),
+    ])
+
+def render_tile(filters, z, x, y):
+    """
+    GeoJSON FeatureCollection (as a dict) of the facilities in a tile
+    """
+    south, west, north, east = tile_bounds(z, x, y)
+    # the bounds select the rows through the latitude index, tile_of() decides which ones belong to the tile
+    facilities = OrgUnit.objects.exclude(orgunit_type='ADMIN').filter(
+        latitude__gte=south, latitude__lte=north, longitude__gte=west, longitude__lte=east, **dict((field + '__in', values) for field, values in filters.items())
+    )
+    # positions on the grid of CLUSTER_GRID x CLUSTER_GRID cells per tile (the tile's children that many zoom levels down)
+    shift = int(math.log2(CLUSTER_GRID)) if z < cluster_zoom() else 0
+    groups = OrderedDict()
+    for row in facilities.order_by('pk').values_list('pk', 'latitude', 'longitude', 'orgunit_type').iterator():
+        cell = tile_of(row[1], row[2], z + shift)
+        if (cell[0] >> shift, cell[1] >> shift) == (x, y):
+            groups.setdefault(cell if shift else row[0], []).append(row)
+    groups = list(groups.values())
+
+    # the other columns only for the points shown on their own, a low zoom tile may hold the whole country
+    fields = ('pk', 'uuid', 'name', 'ownership', 'authority')
+    details = dict((values[0], values[1:]) for values in bulk_fetch(OrgUnit.objects, 'pk', [group[0][0] for group in groups if len(group) == 1], *fields))
+    features = []
+    for group in groups:
+        if len(group) == 1:
+            pk, lat, lon, orgunit_type = group[0]
+            ou_uuid, name, ownership, authority = details[pk]
+            features.append(feature(lon, lat, OrderedDict([
+                ('uuid', str(ou_uuid)), ('name', name), ('orgunit_type', orgunit_type), ('ownership', ownership), ('authority', authority),
+            ])))
+        else:
+            types = OrderedDict()
+            for row in group:
+                types[row[3]] = types.get(row[3], 0) + 1
+            features.append(feature(
+                sum(row[2] for row in group) / len(group),
+                sum(row[1] for row in group) / len(group),
+                OrderedDict([('cluster', True), ('count', len(group)), ('types', types)]),
+            ))
+    return OrderedDict([('type', 'FeatureCollection'), ('features', features)])
+
+def get_tile(filters, z, x, y):
+    """
+    Gzipped GeoJSON of a tile, from the disk cache when there
+    """
+    path = tile_path(filters, z, x, y)
+    if path is not None:
+        try:
+            with open(path, 'rb') as tile_file:
+                return tile_file.read()
+        except OSError:
+            pass
+
+    version = OrgUnitChange.data_version()
+    tile = render_tile(filters, z, x, y)
+    data = gzip.compress(json.dumps(tile, separators=(',', ':')).encode('utf-8'))
+    if path is not None and tile['features']:
+        store_tile(path, data, version)
+    return data
+
+def store_tile(path, data, version):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    except OSError:
+        return
+    with os.fdopen(fd, 'wb') as tile_file:
+        tile_file.write(data)
+    if OrgUnitChange.data_version() == version:
+        os.replace(tmp_path, path)
+    else:
+        os.remove(tmp_path) # the registry changed meanwhile, the tile may be out of date already
+
+def delete_tiles(tiles):
+    root = tile_root()
+    if root is None or not tiles or not os.path.isdir(root):
+        return
+    for key in os.listdir(root):
+        if len(tiles) <= WALK_THRESHOLD:
+            for z, x, y in tiles:
+                try:
+                    os.remove(os.path.join(root, key, str(z), str(x), '{0}.json.gz'.format(y)))
+                except OSError:
+                    pass
+            continue
+        for dir_path, _, file_names in os.walk(os.path.join(root, key)):
+            z_x = os.path.relpath(dir_path, os.path.join(root, key)).split(os.sep)
+            if len(z_x) != 2:
+                continue
+            for file_name in file_names:
+                if file_name.endswith('.json.gz') and (int(z_x[0]), int(z_x[1]), int(file_name.split('.')[0])) in tiles:
+                    os.remove(os.path.join(dir_path, file_name))
+
+def invalidate_tiles(points):
+    """
+    Drop the cached tiles containing any of the (lat, lon) `points` (old and
+    new positions of the facilities written), once the transaction commits
+    """
+    tiles = touched_tiles(points)
+    if tiles and tile_root() is not None:
+        transaction.on_commit(partial(delete_tiles, tiles))
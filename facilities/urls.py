@@ -6,6 +6,11 @@ urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^regions_by_type/', views.region_type_summary, name='region-by-type'),
     url(r'^geojson/(?P<ou_id>[0-9]+).json', views.get_facility_geojson, name='facility-geojson'),
+    url(r'^geojson/facilities.json', views.get_facilities_geojson, name='facilities-geojson'),
+    url(r'^geojson/adminunits.json', views.get_adminunits_geojson, name='adminunits-geojson'),
+    url(r'^tiles/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)(\.json)?$', views.facility_tile, name='facility-tile'),
     url(r'^download/facilities.csv', views.download_csv, name='facilities-csv'),
+    url(r'^metrics$', views.metrics, name='metrics'),
+    url(r'^metrics/slow$', views.slow_requests, name='metrics-slow'),
     url(r'^listing/(?P<ou_uuid>[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})', views.orgunit_and_children, name='listing'),
 ]
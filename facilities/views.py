@@ -1,37 +1,126 @@
-from django.shortcuts import render
-from django.db.models import Q, Max, Count
-from django.http import HttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.db.models import Q, Max, Sum, prefetch_related_objects
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
+from django.views.decorators.http import condition
 from django.conf import settings
+from django.middleware.gzip import re_accepts_gzip
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_datetime
 
+from collections import OrderedDict
 import datetime
-import csv
-import io
+import gzip
 import json
-import requests
+import os
 
 import rest_framework as drf
 from rest_framework import serializers, viewsets
 from rest_framework import permissions
-
-from facilities.models import OrgUnit, Identifier
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from facilities.models import DuplicateCandidate, OrgUnit, OrgUnitChange, OrgUnitSummary, Identifier
+from facilities.batch import FacilityBatch
+from facilities.boundaries import FULL, geometry_at, geometry_bbox_list, requested_resolution
+from facilities.bulk import keyset_chunks
+from facilities.duplicates import duplicate_report, find_duplicates
+from facilities.conditional import RegistryConditionalMixin, registry_condition, registry_etag, registry_last_modified, registry_state
+from facilities.export import facility_csv_lines, snapshot_path, write_snapshot
+from facilities.metrics import TimedSerializerMixin, prometheus_text, slow_request_traces, timed_serialization
+from facilities.pagination import OrgUnitPagination
+from facilities.placement import check_placement, placement_report
+from facilities.paths import PATH_SEPARATOR, resolve_path
+from facilities.restructure import UUID_RE, Restructure, RestructureError
+from facilities.search import MAX_RESULTS as SEARCH_MAX_RESULTS, search_orgunits
+from facilities.snapshot import get_snapshot
+from facilities.subtree import (
+    DEFAULT_SUBTREE_FIELDS, SUBTREE_FIELDS, cached_subtree, flat_subtree, nested_subtree, subtree_queryset, subtree_rows
+)
+from facilities.tiles import get_tile, max_zoom as tile_max_zoom, tile_filters
 
 ORGUNIT_TYPE_MAP = dict(OrgUnit.ORGUNIT_TYPE_CHOICES)
 OWNERSHIP_MAP = dict(OrgUnit.OWNERSHIP_CHOICES)
 AUTHORITY_MAP = dict(OrgUnit.AUTHORITY_CHOICES)
 
 # Serializers define the API representation.
-class IdentifierSerializer(serializers.ModelSerializer):
+class IdentifierSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Identifier
         fields = ('agency', 'context', 'external_id')
 
-class OrgUnitSerializer(serializers.HyperlinkedModelSerializer):
+class OrgUnitSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     identifiers = IdentifierSerializer(required=False, many=True)
 
     class Meta:
         model = OrgUnit
-        fields = ('href', 'name', 'uuid', 'level', 'orgunit_type', 'ownership', 'authority', 'active', 'parent', 'createdAt', 'updatedAt', 'identifiers', 'geometry')
+        fields = ('href', 'name', 'uuid', 'level', 'orgunit_type', 'ownership', 'authority', 'active', 'parent', 'hierarchy', 'createdAt', 'updatedAt', 'identifiers', 'geometry')
+
+def orgunit_href_template(request):
+    '''
+    Detail URL of an orgunit with a {0} placeholder for the pk, reversed once
+    instead of for every row
+    '''
+    return drf.reverse.reverse('orgunit-detail', args=[0], request=request)[:-len('0/')] + '{0}/'
+
+class OrgUnitValuesSerializer:
+    '''
+    Read-only equivalent of OrgUnitSerializer for QuerySet.values() rows. No
+    model instances are built, the identifiers of the whole batch come from a
+    single query and hyperlinks are formatted from one reversed URL.
+    '''
+    VALUES_FIELDS = ('id', 'name', 'uuid', 'level', 'orgunit_type', 'ownership', 'authority', 'active', 'parent_id', 'createdAt', 'updatedAt') + tuple(
+        name_field for _, name_field in OrgUnit.ancestor_fields().values()
+    )
+    datetime_field = serializers.DateTimeField()
+
+    @classmethod
+    def values(cls, queryset, resolution=FULL):
+        '''
+        The rows to serialize, with the geometry strings at `resolution` (see
+        facilities.boundaries)
+        '''
+        return queryset.values(*cls.VALUES_FIELDS, geometry=geometry_at(resolution))
+
+    def __init__(self, rows, request):
+        self.rows = list(rows)
+        self.request = request
+
+    @property
+    def data(self):
+        with timed_serialization():
+            identifiers = {}
+            links = OrgUnit.identifiers.through.objects.filter(orgunit_id__in=[row['id'] for row in self.rows]).order_by('identifier_id')
+            for orgunit_id, agency, context, external_id in links.values_list('orgunit_id', 'identifier__agency', 'identifier__context', 'identifier__external_id'):
+                identifiers.setdefault(orgunit_id, []).append(OrderedDict([('agency', agency), ('context', context), ('external_id', external_id)]))
+
+            href = orgunit_href_template(self.request)
+            to_datetime = self.datetime_field.to_representation
+            hierarchy_fields = [(OrgUnit.get_level_field(level), name_field) for level, (_, name_field) in OrgUnit.ancestor_fields().items()]
+            return [
+                OrderedDict([
+                    ('href', href.format(row['id'])),
+                    ('name', row['name']),
+                    ('uuid', str(row['uuid'])),
+                    ('level', row['level']),
+                    ('orgunit_type', row['orgunit_type']),
+                    ('ownership', row['ownership']),
+                    ('authority', row['authority']),
+                    ('active', row['active']),
+                    ('parent', None if row['parent_id'] is None else href.format(row['parent_id'])),
+                    ('hierarchy', OrderedDict((level_field, row[name_field]) for level_field, name_field in hierarchy_fields if row[name_field])),
+                    ('createdAt', to_datetime(row['createdAt'])),
+                    ('updatedAt', to_datetime(row['updatedAt'])),
+                    ('identifiers', identifiers.get(row['id'], [])),
+                    ('geometry', json.loads(row['geometry']) if row['geometry'] else None),
+                ])
+                for row in self.rows
+            ]
 
 def ou_to_geojson_obj(ou):
     geo_dict = dict(list([('type', 'Feature'), ('geometry', ou.get('geometry'))]))
@@ -46,89 +135,573 @@ def ou_to_geojson_obj(ou):
                 geo_dict['properties'][k] = AUTHORITY_MAP[v]
     return geo_dict
 
+class PathField(serializers.Field):
+    '''
+    Orgunit path from the root, as a list of names or a '/' separated string
+    '''
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = data.split(PATH_SEPARATOR)
+        if not isinstance(data, list) or not data or not all(isinstance(x, str) and x.strip() for x in data):
+            raise ValidationError('Expected a list of names or a "/" separated path')
+        return [x.strip() for x in data]
+
+class FacilityBatchItemSerializer(serializers.Serializer):
+    '''
+    One item of a bulk write. Existing facilities are addressed by 'uuid',
+    'identifier' ("agency::context::external_id" or a bare external ID) or
+    'path'. New ones need a 'path' ending in their name, or a 'parent' UUID
+    and a 'name'.
+    '''
+    action = serializers.ChoiceField(choices=FacilityBatch.ACTIONS, default=FacilityBatch.UPDATE)
+    uuid = serializers.UUIDField(required=False)
+    identifier = serializers.CharField(required=False, max_length=200)
+    path = PathField(required=False)
+    parent = serializers.UUIDField(required=False)
+    name = serializers.CharField(required=False, max_length=96)
+    orgunit_type = serializers.ChoiceField(choices=[c for c in OrgUnit.ORGUNIT_TYPE_CHOICES if c[0] != 'ADMIN'], required=False)
+    ownership = serializers.ChoiceField(choices=OrgUnit.OWNERSHIP_CHOICES, required=False)
+    authority = serializers.ChoiceField(choices=OrgUnit.AUTHORITY_CHOICES, required=False)
+    active = serializers.BooleanField(required=False)
+    geometry = serializers.JSONField(required=False, allow_null=True)
+    identifiers = serializers.ListField(child=serializers.CharField(max_length=200), required=False)
+
+    def validate_geometry(self, value):
+        if value is not None and not (isinstance(value, dict) and 'type' in value and 'coordinates' in value):
+            raise ValidationError('Expected a GeoJSON geometry object')
+        return value
+
+    def validate_identifiers(self, value):
+        for id_str in value:
+            if None in Identifier.split_identifier_str(id_str):
+                raise ValidationError('Expected "agency::context::external_id", got {0}'.format(id_str))
+        return value
+
+    def validate(self, data):
+        addresses = [f for f in ('uuid', 'identifier', 'path') if f in data]
+        if data['action'] == FacilityBatch.CREATE:
+            if 'uuid' in data or 'identifier' in data:
+                raise ValidationError('New facilities are addressed by path, or parent and name')
+            if 'path' not in data and not ('parent' in data and 'name' in data):
+                raise ValidationError('New facilities need a path, or a parent and a name')
+            if 'orgunit_type' not in data:
+                raise ValidationError({'orgunit_type': 'This field is required.'})
+        elif len(addresses) != 1:
+            raise ValidationError('Exactly one of uuid, identifier or path is required')
+        return data
+
+def filter_by_hierarchy(orgunits, params):
+    '''
+    Filter on the denormalized ancestor columns: ?district_id=<pk> or
+    ?district=<name> for any level above the lowest, e.g. all HC IIIs in a
+    district with ?district=Gulu&orgunit_type=HC III
+    '''
+    for level, (id_field, name_field) in OrgUnit.ancestor_fields().items():
+        if params.get(id_field):
+            try:
+                orgunits = orgunits.filter(**{id_field: int(params[id_field])})
+            except ValueError:
+                raise ValidationError({id_field: 'Expected an orgunit id'})
+        level_field = OrgUnit.get_level_field(level)
+        if params.get(level_field):
+            orgunits = orgunits.filter(**{name_field+'__iexact': params[level_field]})
+    return orgunits
+
 class GeoJSONOrgUnitSerializer(OrgUnitSerializer):
     def to_representation(self, instance):
         ret = super().to_representation(instance)
         return ou_to_geojson_obj(ret)
 
 # ViewSets define the view behavior.
-# class IdentifierViewSet(viewsets.ModelViewSet):
-#     queryset = Identifier.objects.all()
-#     serializer_class = IdentifierSerializer
-
-class OrgUnitViewSet(viewsets.ModelViewSet):
+class IdentifierViewSet(RegistryConditionalMixin, viewsets.ReadOnlyModelViewSet):
+    '''
+    External identifiers. 'resolve' translates a batch of IDs, either bare
+    external IDs or "agency::context::external_id" triplets, to orgunits:
+    GET ?id=...&id=... or POST {"ids": [...]}
+    '''
+    queryset = Identifier.objects.order_by('pk')
+    serializer_class = IdentifierSerializer
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    RESOLVE_MAX_IDS = 20000
+    conditional_actions = ('resolve',) # identifiers that aren't linked to an orgunit are not in the change log
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        for field in ('agency', 'context', 'external_id'):
+            if field in self.request.query_params:
+                queryset = queryset.filter(**{field: self.request.query_params[field]})
+        return queryset
+
+    # resolving is a read, POST is only there to carry long ID lists
+    @action(detail=False, methods=['get', 'post'], permission_classes=(permissions.AllowAny,))
+    def resolve(self, request):
+        if request.method == 'POST':
+            ids = request.data.get('ids') if hasattr(request.data, 'get') else None
+        else:
+            ids = request.query_params.getlist('id')
+        if not isinstance(ids, list) or not all(isinstance(x, str) for x in ids):
+            raise ValidationError({'ids': 'Expected a list of identifier strings'})
+        if len(ids) > self.RESOLVE_MAX_IDS:
+            raise ValidationError({'ids': 'At most {0} identifiers per request'.format(self.RESOLVE_MAX_IDS)})
+
+        snapshot = get_snapshot()
+        resolve = snapshot.resolve_identifiers if snapshot is not None else Identifier.resolve
+        resolved = resolve(ids, 'pk', 'uuid', 'name', 'orgunit_type', 'level', 'active')
+        results = {}
+        for id_str, matches in resolved.items():
+            for match in matches:
+                match['href'] = drf.reverse.reverse('orgunit-detail', args=[match.pop('pk')], request=request)
+            results[id_str] = matches
+        unmatched = [id_str for id_str, matches in results.items() if not matches]
+
+        return Response({'results': results, 'unmatched': unmatched})
+
+class OrgUnitViewSet(RegistryConditionalMixin, viewsets.ModelViewSet):
+    '''
+    Orgunits, filtered by ?path=, ?orgunit_type= and the hierarchy levels.
+    Listings serve geometries in full like the detail view; ?resolution=
+    (low, medium, high or full) or a map ?zoom= opts in to simplified
+    boundaries, much less JSON for a page of districts.
+    '''
     queryset = OrgUnit.objects.all()
     serializer_class = OrgUnitSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
-
-# TODO: inherit from OrgUnitViewSet?
-class AdminUnitViewSet(viewsets.ModelViewSet):
+    pagination_class = OrgUnitPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset().prefetch_related('identifiers')
+        if 'path' in self.request.query_params:
+            # ?path=Uganda/Region/.../Facility, names matched as orgunit_load matches them
+            path_parts = self.request.query_params['path'].split(PATH_SEPARATOR)
+            snapshot = get_snapshot()
+            if snapshot is not None:
+                ou = snapshot.resolve_path(path_parts)
+                queryset = queryset.filter(pk=ou.pk if ou is not None else None)
+            else:
+                queryset = queryset.filter(pk=resolve_path(path_parts))
+        if self.request.query_params.getlist('orgunit_type'):
+            queryset = queryset.filter(orgunit_type__in=self.request.query_params.getlist('orgunit_type'))
+        return filter_by_hierarchy(queryset, self.request.query_params)
+
+    def get_values_queryset(self, default_resolution=FULL):
+        # ?resolution= or ?zoom= serve simplified boundaries
+        try:
+            resolution = requested_resolution(self.request.query_params, default_resolution)
+        except ValueError as e:
+            raise ValidationError({'resolution': str(e)})
+        return OrgUnitValuesSerializer.values(self.filter_queryset(self.get_queryset()).prefetch_related(None), resolution)
+
+    def list(self, request, *args, **kwargs):
+        # a constant number of queries per page, whatever the page size
+        queryset = self.get_values_queryset()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(OrgUnitValuesSerializer(page, request).data)
+        return Response(OrgUnitValuesSerializer(queryset, request).data)
+
+    @action(detail=False)
+    def dump(self, request):
+        '''
+        Every orgunit in the listing as newline-delimited JSON, streamed in
+        primary key order: a full mirror in a single request
+        '''
+        queryset = self.get_values_queryset()
+
+        def ndjson_lines():
+            for chunk in keyset_chunks(queryset, ('id',)):
+                yield ''.join(json.dumps(data) + '\n' for data in OrgUnitValuesSerializer(chunk, request).data)
+
+        return StreamingHttpResponse(ndjson_lines(), content_type='application/x-ndjson')
+
+    @action(detail=False)
+    def search(self, request):
+        '''
+        Typeahead: the orgunits whose names best match ?q=, tolerating typos
+        and spelling variants ('H/C III', 'Health Centre III'), best first.
+        ?within=<uuid or id> limits the search to the orgunits below another,
+        the listing filters (orgunit_type, district_id, ...) apply as well.
+        ?limit= defaults to 10.
+        '''
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'A search term is required'})
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 10)), SEARCH_MAX_RESULTS))
+        except ValueError:
+            raise ValidationError({'limit': 'Expected an integer'})
+
+        queryset = self.filter_queryset(self.get_queryset())
+        within = request.query_params.get('within', '').strip()
+        if within:
+            ancestor = None
+            if within.isdigit():
+                ancestor = OrgUnit.objects.filter(pk=within).values('pk', 'level').first()
+            elif UUID_RE.match(within):
+                ancestor = OrgUnit.objects.filter(uuid=within).values('pk', 'level').first()
+            if ancestor is None:
+                raise NotFound('No orgunit {0}'.format(within))
+            ancestor_fields = OrgUnit.ancestor_fields()
+            if ancestor['level'] not in ancestor_fields:
+                return Response(OrderedDict([('query', query), ('results', [])])) # lowest level, nothing below
+            queryset = queryset.filter(**{ancestor_fields[ancestor['level']][0]: ancestor['pk']})
+
+        hierarchy_fields = [(OrgUnit.get_level_field(level), name_field) for level, (_, name_field) in OrgUnit.ancestor_fields().items()]
+        fields = ('pk', 'uuid', 'name', 'level', 'orgunit_type', 'active') + tuple(name_field for _, name_field in hierarchy_fields)
+        href = orgunit_href_template(request)
+        results = [
+            OrderedDict([
+                ('href', href.format(row['pk'])),
+                ('name', row['name']),
+                ('uuid', str(row['uuid'])),
+                ('level', row['level']),
+                ('orgunit_type', row['orgunit_type']),
+                ('active', row['active']),
+                ('hierarchy', OrderedDict((level_field, row[name_field]) for level_field, name_field in hierarchy_fields if row[name_field])),
+                ('score', score),
+            ])
+            for score, row in search_orgunits(query, queryset, limit, fields)
+        ]
+        return Response(OrderedDict([('query', query), ('results', results)]))
+
+    @action(detail=True)
+    def subtree(self, request, pk=None):
+        '''
+        The orgunit and everything below it in one response: nested (each node
+        with its 'children') or with ?flat=true a list in tree order with each
+        node's depth. ?depth= limits how many levels below the orgunit are
+        included, ?fields= selects the node fields (comma separated).
+        '''
+        flat = request.query_params.get('flat', '').lower() in ('1', 'true', 'yes')
+        if not pk.isdigit():
+            raise NotFound()
+        try:
+            max_depth = int(request.query_params['depth']) if request.query_params.get('depth') else None
+        except ValueError:
+            raise ValidationError('depth must be an integer')
+        if max_depth is not None and max_depth < 0:
+            raise ValidationError('depth must not be negative')
+        fields = tuple(f.strip() for f in request.query_params.get('fields', '').split(',') if f.strip()) or DEFAULT_SUBTREE_FIELDS
+        unknown = [f for f in fields if f not in SUBTREE_FIELDS]
+        if unknown:
+            raise ValidationError({'fields': 'Unknown field(s) {0}, choose from {1}'.format(', '.join(unknown), ', '.join(SUBTREE_FIELDS))})
+
+        # hrefs are absolute, the host is part of the rendering
+        href = orgunit_href_template(request)
+        shape = flat_subtree if flat else nested_subtree
+        data = cached_subtree(int(pk), ('api', href, flat, max_depth, fields), lambda: shape(subtree_rows(int(pk), fields, max_depth), fields, href))
+        if not data:
+            raise NotFound()
+        return Response(data)
+
+class AdminUnitViewSet(OrgUnitViewSet):
     queryset = OrgUnit.objects.filter(Q(orgunit_type='ADMIN'))
-    serializer_class = OrgUnitSerializer
-    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
-class FacilityViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'], permission_classes=(permissions.IsAdminUser,))
+    def restructure(self, request):
+        '''
+        Apply administrative boundary changes (new units, moves, splits and
+        merges, see facilities.restructure) in one transaction. With
+        ?dry_run=true nothing is written. The response summarizes what moved.
+        '''
+        if not isinstance(request.data, dict):
+            raise ValidationError('Expected a restructuring spec')
+        restructuring = Restructure(request.data)
+        try:
+            if request.query_params.get('dry_run', '').lower() in ('1', 'true', 'yes'):
+                summary = restructuring.plan()
+            else:
+                summary = restructuring.apply()
+        except RestructureError as e:
+            raise ValidationError({'errors': e.errors})
+        return Response(summary)
+
+class FacilityViewSet(OrgUnitViewSet):
     queryset = OrgUnit.objects.filter(~Q(orgunit_type='ADMIN'))
-    serializer_class = OrgUnitSerializer
+    NEARBY_MAX_RESULTS = 100
+    BULK_MAX_ITEMS = 5000
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        '''
+        Create, update and deactivate many facilities in one request: POST a
+        list of items (see FacilityBatchItemSerializer), or {"items": [...]}.
+        Nothing is written unless every item is valid. The response has one
+        result per item, in order.
+        '''
+        items = request.data.get('items') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list):
+            raise ValidationError({'items': 'Expected a list of facilities'})
+        if len(items) > self.BULK_MAX_ITEMS:
+            raise ValidationError({'items': 'At most {0} facilities per request'.format(self.BULK_MAX_ITEMS)})
+
+        item_serializers = [FacilityBatchItemSerializer(data=item) for item in items]
+        errors = dict((i, serializer.errors) for i, serializer in enumerate(item_serializers) if not serializer.is_valid())
+        if not errors:
+            batch = FacilityBatch([serializer.validated_data for serializer in item_serializers])
+            if batch.validate():
+                results = batch.apply()
+                return Response({'results': [
+                    OrderedDict([
+                        ('status', result['status']),
+                        ('href', drf.reverse.reverse('orgunit-detail', args=[result['pk']], request=request)),
+                        ('uuid', str(result['uuid'])),
+                    ])
+                    for result in results
+                ]})
+            errors = batch.errors
+
+        return Response({'results': [
+            OrderedDict([('status', 'invalid'), ('errors', errors[i])]) if i in errors else OrderedDict([('status', 'valid')])
+            for i in range(len(items))
+        ]}, status=400)
+
+    @action(detail=False)
+    def nearby(self, request):
+        '''
+        Facilities nearest to ?lat=&lon=, limited by k (default 10) and/or
+        radius (km), plus the admin units that enclose them at every level
+        '''
+        try:
+            lat = float(request.query_params['lat'])
+            lon = float(request.query_params['lon'])
+            k = int(request.query_params.get('k', 10))
+            radius_km = float(request.query_params['radius']) if 'radius' in request.query_params else None
+        except (KeyError, ValueError):
+            raise ValidationError('lat and lon are required, k must be an integer and radius a number (km)')
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValidationError('lat/lon out of range')
+        k = max(1, min(k, self.NEARBY_MAX_RESULTS))
+
+        nearest, adminunits = OrgUnit.find_proximity(lat, lon, k=k, radius_km=radius_km, queryset=self.get_queryset())
+        prefetch_related_objects([ou for _, ou in nearest], 'identifiers')
+
+        facilities = []
+        for distance, ou in nearest:
+            data = self.get_serializer(ou).data
+            data['distance_km'] = round(distance, 3)
+            facilities.append(data)
+        levels = OrderedDict()
+        for level, units in adminunits.items():
+            levels[level] = [
+                OrderedDict([
+                    ('href', drf.reverse.reverse('orgunit-detail', args=[ou.pk], request=request)),
+                    ('name', ou.name), ('uuid', str(ou.uuid)), ('distance_km', round(distance, 3))
+                ])
+                for distance, ou in units
+            ]
+
+        return Response(OrderedDict([('facilities', facilities), ('adminunits', levels)]))
+
+class ChangeFeedViewSet(RegistryConditionalMixin, viewsets.ViewSet):
+    '''
+    Orgunits created, updated or deleted since ?since=<sync token> (from the
+    previous response) or ?updated_since=<ISO 8601 timestamp>, in change
+    sequence order. Each entry carries the current orgunit, or null for a
+    deletion (tombstone). Without either parameter the feed starts from the
+    beginning, i.e. the whole registry.
+    '''
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
-
-class HospitalViewSet(viewsets.ModelViewSet):
-    queryset = OrgUnit.objects.filter(Q(orgunit_type='HOSPITAL') | Q(orgunit_type='RRH') | Q(orgunit_type='NRH'))
+    DEFAULT_LIMIT = 500
+    MAX_LIMIT = 5000
+
+    def list(self, request):
+        # only numbered (committed) changes, see OrgUnitChange.seq
+        changes = OrgUnitChange.objects.filter(seq__isnull=False).order_by('seq')
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT))
+            since = int(request.query_params.get('since', 0))
+        except ValueError:
+            raise ValidationError('since must be a sync token and limit an integer')
+        if since < 0:
+            raise ValidationError({'since': 'must be a sync token from a previous response'})
+        if 'updated_since' in request.query_params:
+            updated_since = parse_datetime(request.query_params['updated_since'])
+            if updated_since is None:
+                raise ValidationError('updated_since must be an ISO 8601 timestamp')
+            changes = changes.filter(changed_at__gt=updated_since)
+
+        page = list(changes.filter(seq__gt=since).values('seq', 'orgunit_id', 'uuid', 'action', 'changed_at')[:limit])
+        # only the latest change of an orgunit within the page matters
+        latest = OrderedDict()
+        for change in page:
+            latest.pop(change['uuid'], None)
+            latest[change['uuid']] = change
+
+        current = dict(
+            (data['uuid'], data) for data in
+            OrgUnitValuesSerializer(OrgUnitValuesSerializer.values(OrgUnit.objects.filter(pk__in=[c['orgunit_id'] for c in latest.values() if c['action'] != OrgUnitChange.DELETED])), request).data
+        )
+        to_datetime = serializers.DateTimeField().to_representation
+        results = []
+        for change_uuid, change in latest.items():
+            orgunit = current.get(str(change_uuid))
+            if change['action'] != OrgUnitChange.DELETED and orgunit is None:
+                continue # deleted later on, its tombstone follows
+            results.append(OrderedDict([
+                ('seq', change['seq']),
+                ('action', change['action']),
+                ('uuid', str(change_uuid)),
+                ('changed_at', to_datetime(change['changed_at'])),
+                ('orgunit', orgunit),
+            ]))
+
+        sync_token = str(page[-1]['seq'] if page else since)
+        has_more = len(page) == limit
+        next_url = replace_query_param(request.build_absolute_uri(), 'since', sync_token) if has_more else None
+        if next_url is not None:
+            next_url = remove_query_param(next_url, 'updated_since')
+
+        return Response(OrderedDict([('sync_token', sync_token), ('has_more', has_more), ('next', next_url), ('results', results)]))
+
+class DuplicateCandidateViewSet(viewsets.ViewSet):
+    '''
+    Possible duplicate facilities, best candidates first. ?status (open by
+    default, confirmed or dismissed), ?min_score, ?limit and ?offset. Reviews
+    are POSTed to /duplicates/<id>/review/ as {"status": "confirmed"} or
+    {"status": "dismissed"}; an admin can POST /duplicates/scan/ to check the
+    facilities changed since the last run.
+    '''
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    def list(self, request):
+        status = request.query_params.get('status', DuplicateCandidate.OPEN)
+        if status not in dict(DuplicateCandidate.STATUS_CHOICES):
+            raise ValidationError('status must be one of %s' % ', '.join(dict(DuplicateCandidate.STATUS_CHOICES)))
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT))
+            offset = max(0, int(request.query_params.get('offset', 0)))
+            min_score = float(request.query_params['min_score']) if 'min_score' in request.query_params else None
+        except ValueError:
+            raise ValidationError('limit and offset must be integers, min_score a number')
+        results = list(duplicate_report(limit=limit, offset=offset, status=status, min_score=min_score))
+        return Response(OrderedDict([('count', len(results)), ('results', results)]))
+
+    @action(detail=True, methods=['post'], permission_classes=(permissions.IsAuthenticated,))
+    def review(self, request, pk=None):
+        candidate = get_object_or_404(DuplicateCandidate, pk=pk)
+        if not isinstance(request.data, dict):
+            raise ValidationError('Expected a review status')
+        status = request.data.get('status')
+        if status not in (DuplicateCandidate.CONFIRMED, DuplicateCandidate.DISMISSED, DuplicateCandidate.OPEN):
+            raise ValidationError({'status': 'must be confirmed, dismissed or open'})
+        candidate.status = status
+        candidate.reviewed_at = timezone.now()
+        candidate.reviewed_by = request.user
+        candidate.save()
+        return Response(OrderedDict([('id', candidate.pk), ('status', candidate.status)]))
+
+    @action(detail=False, methods=['post'], permission_classes=(permissions.IsAdminUser,))
+    def scan(self, request):
+        if not isinstance(request.data, dict):
+            raise ValidationError('Expected scan options')
+        return Response(find_duplicates(full=bool(request.data.get('full'))))
+
+class MisplacedFacilityViewSet(viewsets.ViewSet):
+    '''
+    Facilities whose coordinates are outside one of their admin units, with
+    the unit of that level containing them instead. ?level (number or name,
+    e.g. 'district'), ?limit and ?offset. An admin can POST
+    /misplaced/check/ to check every facility again.
+    '''
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    def list(self, request):
+        level = request.query_params.get('level') or None
+        if level is not None:
+            levels = dict((name.lower(), level) for level, name in settings.ORG_UNIT_LEVELS.items())
+            if not level.isdigit() and level.lower() not in levels:
+                raise ValidationError({'level': 'Expected a level number or one of %s' % ', '.join(levels)})
+            level = int(level) if level.isdigit() else levels[level.lower()]
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT))
+            offset = max(0, int(request.query_params.get('offset', 0)))
+        except ValueError:
+            raise ValidationError('limit and offset must be integers')
+        results = list(placement_report(limit=limit, offset=offset, level=level))
+        return Response(OrderedDict([('count', len(results)), ('results', results)]))
+
+    @action(detail=False, methods=['post'], permission_classes=(permissions.IsAdminUser,))
+    def check(self, request):
+        return Response(check_placement())
+
+class HospitalViewSet(RegistryConditionalMixin, viewsets.ModelViewSet):
+    queryset = OrgUnit.objects.filter(Q(orgunit_type='HOSPITAL') | Q(orgunit_type='RRH') | Q(orgunit_type='NRH')).prefetch_related('identifiers')
     serializer_class = GeoJSONOrgUnitSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     paginator = None
 
+@registry_condition
 def index(request):
-    from django.db import connection
-    cursor = connection.cursor()
-
-    cursor.execute("select level, count(level) from facilities_orgunit group by level order by level asc")
-    rows = cursor.fetchall()
-    level_summary = [(settings.ORG_UNIT_LEVELS[level], count) for level,count in rows]
-    total_facilities = 0 if len(level_summary) == 0 else level_summary[-1][1]
-
-    cursor.execute("select ownership, count(ownership) from facilities_orgunit group by ownership order by ownership asc")
-    rows = cursor.fetchall()
-    ownership_summary = [(OWNERSHIP_MAP[ownership], count, (count/total_facilities)*100) for ownership,count in rows]
-
-    context = {
-        'level_summary': level_summary,
-        'total_facilities': total_facilities,
-        'ownership_summary': ownership_summary,
-    }
+    # the summary only changes with the data, cache the page context per data version
+    cache_key = 'index:{0}'.format(OrgUnitChange.data_version())
+    context = cache.get(cache_key)
+
+    if context is None:
+        level_counts = OrgUnitSummary.objects.values('level').annotate(total=Sum('count')).filter(total__gt=0).order_by('level')
+        level_summary = [(settings.ORG_UNIT_LEVELS[row['level']], row['total']) for row in level_counts]
+        total_facilities = 0 if len(level_summary) == 0 else level_summary[-1][1]
+
+        facility_summary = OrgUnitSummary.objects.exclude(orgunit_type='ADMIN')
+        ownership_counts = facility_summary.values('ownership').annotate(total=Sum('count')).filter(total__gt=0).order_by('ownership')
+        ownership_summary = [(OWNERSHIP_MAP[row['ownership']], row['total'], (row['total']/total_facilities)*100) for row in ownership_counts]
+
+        coverage_counts = facility_summary.values('region_id').annotate(total=Sum('count'), with_coordinates=Sum('with_coordinates')).filter(total__gt=0)
+        region_names = dict(OrgUnit.objects.filter(pk__in=[row['region_id'] for row in coverage_counts]).values_list('pk', 'name'))
+        coverage_summary = sorted(
+            (region_names.get(row['region_id'], 'Unknown'), row['with_coordinates'], (row['with_coordinates']/row['total'])*100)
+            for row in coverage_counts
+        )
+        with_coordinates = sum(row[1] for row in coverage_summary)
+
+        context = {
+            'level_summary': level_summary,
+            'total_facilities': total_facilities,
+            'ownership_summary': ownership_summary,
+            'coverage_summary': coverage_summary,
+            'coverage_total': with_coordinates,
+            'coverage_pct': (with_coordinates/total_facilities)*100 if total_facilities else 0,
+        }
+        cache.set(cache_key, context, None)
 
     return render(request, 'facilities/index.html', context)
 
+@registry_condition
 def orgunit_and_children(request, ou_uuid):
     # TODO: when orgunit uuid not supplied default to top-level orgunit
-    # TODO: display error for non-existent or invalid UUID
-    ou = OrgUnit.objects.get(uuid=ou_uuid)
+    ou = get_object_or_404(OrgUnit, uuid=ou_uuid)
+
+    # subdivisions above subcounty level, the whole tree of facilities below, rendered once per change
+    max_depth = 1 if ou.level < 4 else None
+    def render_subtree():
+        descendants = list(subtree_queryset(ou.pk, max_depth))[1:]
+        return render_to_string('facilities/orgunit_subtree.html', {'orgunit': ou, 'descendants': descendants})
+
     context = {
         'orgunit': ou,
+        'subtree_html': cached_subtree(ou.pk, ('listing', max_depth), render_subtree),
     }
 
     return render(request, 'facilities/orgunit_detail.html', context)
 
 
+@registry_condition
 def region_type_summary(request):
-    from django.db import connection
-    cursor = connection.cursor()
-
-    sql_str = """
-    WITH regions AS (
-    SELECT name, lft, rght FROM facilities_orgunit
-    WHERE level=1)
-    SELECT regions.name, orgunit_type, count(orgunit_type)
-    FROM facilities_orgunit ou, regions
-    WHERE ou.lft >= regions.lft AND ou.rght <= regions.rght
-    AND ou.orgunit_type<>'ADMIN'
-    GROUP BY regions.name, orgunit_type
-    ORDER BY regions.name, orgunit_type;
-    """
-
-    cursor.execute(sql_str)
-    rows = cursor.fetchall()
-    region_type_summary = [(name, ORGUNIT_TYPE_MAP[orgunit_type], count) for name, orgunit_type, count in rows]
+    cache_key = 'region_type_summary:{0}'.format(OrgUnitChange.data_version())
+    region_type_summary = cache.get(cache_key)
+
+    if region_type_summary is None:
+        rows = OrgUnitSummary.objects.exclude(orgunit_type='ADMIN').values('region_id', 'orgunit_type').annotate(total=Sum('count')).filter(total__gt=0)
+        region_names = dict(OrgUnit.objects.filter(pk__in=[row['region_id'] for row in rows]).values_list('pk', 'name'))
+        region_type_summary = sorted(
+            (region_names.get(row['region_id'], 'Unknown'), row['orgunit_type'], row['total'])
+            for row in rows
+        )
+        region_type_summary = [(name, ORGUNIT_TYPE_MAP[orgunit_type], count) for name, orgunit_type, count in region_type_summary]
+        cache.set(cache_key, region_type_summary, None)
 
     context = {
         'page_title': 'Regions broken down by Facility Type',
@@ -137,61 +710,171 @@ def region_type_summary(request):
 
     return render(request, 'facilities/grouped_summary.html', context)
 
+@registry_condition
 def get_facility_geojson(request, ou_id):
     '''Returns an orgunit as a GeoJSON feature. All attributes (except geometry) are moved to the 'properties' collection.'''
 
-    url = drf.reverse.reverse('orgunit-detail', args=[ou_id], request=request)
-    r = requests.get(url)
-    data = r.json()
+    # serialize in-process, calling back into our own API over HTTP ties up a second worker per request
+    ou = get_object_or_404(OrgUnit.objects.prefetch_related('identifiers'), pk=ou_id)
+    data = OrgUnitSerializer(ou, context={'request': request}).data
     geo_data = ou_to_geojson_obj(data)
 
-    return HttpResponse(json.dumps(geo_data, indent=4))
+    return HttpResponse(json.dumps(geo_data, indent=4), content_type='application/json')
 
-def facility_to_list(facility_obj, field_list, default=None):
-    out_list = [getattr(facility_obj, field) for field in field_list]
-    out_list = list(map(lambda x: str(x) if x is not None else default, out_list)) # replace empty/null/None with supplied default
-    return out_list
+def geojson_feature_collection(orgunits, request, chunk_size=500):
+    """
+    Generate a GeoJSON FeatureCollection as a stream of strings, serializing
+    the orgunits one keyset chunk at a time
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for chunk in keyset_chunks(orgunits.prefetch_related('identifiers'), ('tree_id', 'lft'), chunk_size):
+        for data in OrgUnitSerializer(chunk, many=True, context={'request': request}).data:
+            yield separator + json.dumps(ou_to_geojson_obj(data))
+            separator = ','
+    yield ']}'
+
+def filter_by_ancestor(orgunits, ancestor_uuid):
+    '''The orgunits below the one with `ancestor_uuid` (404 if there is none)'''
+    if not UUID_RE.match(ancestor_uuid):
+        raise ValidationError({'ancestor': 'Expected an orgunit UUID'})
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        ancestor = snapshot.get_by_uuid(ancestor_uuid)
+        if ancestor is None:
+            raise Http404('No orgunit with this uuid')
+    else:
+        ancestor = get_object_or_404(OrgUnit, uuid=ancestor_uuid)
+    ancestor_fields = OrgUnit.ancestor_fields()
+    if ancestor.level in ancestor_fields:
+        return orgunits.filter(**{ancestor_fields[ancestor.level][0]: ancestor.pk})
+    return orgunits.none() # lowest level, nothing below it
+
+@registry_condition
+def get_facilities_geojson(request):
+    '''Returns facilities as a GeoJSON FeatureCollection. Optionally filtered by one or more 'type', 'ownership' and
+    'authority' codes, by an 'ancestor' orgunit UUID (e.g. all HC IIIs in a district) and by ancestor id/name
+    (see filter_by_hierarchy).'''
+
+    facilities = OrgUnit.objects.filter(~Q(orgunit_type='ADMIN'))
+    for param, field in (('type', 'orgunit_type'), ('ownership', 'ownership'), ('authority', 'authority')):
+        values = request.GET.getlist(param)
+        if values:
+            facilities = facilities.filter(**{field+'__in': values})
+    try:
+        facilities = filter_by_hierarchy(facilities, request.GET)
+        if request.GET.get('ancestor'):
+            facilities = filter_by_ancestor(facilities, request.GET['ancestor'])
+    except ValidationError as e:
+        return HttpResponseBadRequest(json.dumps(e.detail), content_type='application/json')
+
+    return StreamingHttpResponse(geojson_feature_collection(facilities, request), content_type='application/json')
+
+def boundary_features(rows):
+    '''
+    Generate a GeoJSON FeatureCollection of values() rows with a 'geometry'
+    string, which goes in as it is
+    '''
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for row in rows:
+        bbox = geometry_bbox_list(row) # only set for geometries that parsed
+        properties = OrderedDict([('uuid', str(row['uuid'])), ('name', row['name']), ('level', row['level']), ('bbox', bbox)])
+        yield '{0}{{"type": "Feature", "geometry": {1}, "properties": {2}}}'.format(separator, row['geometry'] if bbox and row['geometry'] else 'null', json.dumps(properties))
+        separator = ','
+    yield ']}'
+
+@registry_condition
+def get_adminunits_geojson(request):
+    '''Returns admin units as a GeoJSON FeatureCollection of their boundaries, e.g. all districts for a choropleth
+    map. Optionally filtered by 'level' (number or name, e.g. 'district') and by an 'ancestor' orgunit UUID. The
+    boundaries are simplified for a 'resolution' (low, medium, high or full) or a map 'zoom', low by default; each
+    feature has the unit's bounding box.'''
+
+    try:
+        resolution = requested_resolution(request.GET, default='low')
+    except ValueError as e:
+        return HttpResponseBadRequest(json.dumps({'resolution': str(e)}), content_type='application/json')
+    units = OrgUnit.objects.filter(orgunit_type='ADMIN')
+    if request.GET.get('level'):
+        levels = dict((name.lower(), level) for level, name in settings.ORG_UNIT_LEVELS.items())
+        level = request.GET['level']
+        if not level.isdigit() and level.lower() not in levels:
+            return HttpResponseBadRequest(json.dumps({'level': 'Expected a level number or one of %s' % ', '.join(levels)}), content_type='application/json')
+        units = units.filter(level=int(level) if level.isdigit() else levels[level.lower()])
+    if request.GET.get('ancestor'):
+        try:
+            units = filter_by_ancestor(units, request.GET['ancestor'])
+        except ValidationError as e:
+            return HttpResponseBadRequest(json.dumps(e.detail), content_type='application/json')
+
+    rows = units.order_by('tree_id', 'lft').values('uuid', 'name', 'level', 'bbox_west', 'bbox_south', 'bbox_east', 'bbox_north', geometry=geometry_at(resolution))
+    return StreamingHttpResponse(boundary_features(rows.iterator()), content_type='application/json')
+
+def accepts_gzip(request):
+    return bool(re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+def tile_etag(request, *args, **kwargs):
+    # the gzipped and plain responses are different representations
+    return registry_etag(request) + ('-gz' if accepts_gzip(request) else '')
+
+@condition(etag_func=tile_etag, last_modified_func=registry_last_modified)
+def facility_tile(request, z, x, y):
+    '''Facility points in map tile z/x/y as a GeoJSON FeatureCollection, nearby points merged into clusters at low
+    zoom levels (see facilities.tiles). Optionally filtered by one or more 'type', 'ownership' and 'authority' codes.
+    Sent gzipped to clients accepting it.'''
+
+    z, x, y = int(z), int(x), int(y)
+    if z > tile_max_zoom() or x >= 2**z or y >= 2**z:
+        raise Http404('No such tile')
+    try:
+        filters = tile_filters(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(json.dumps({'filters': str(e)}), content_type='application/json')
+    data = get_tile(filters, z, x, y)
+    if accepts_gzip(request):
+        response = HttpResponse(data, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(data), content_type='application/json')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
 
+@registry_condition
 def download_csv(request):
-    facilities = OrgUnit.objects.filter(~Q(orgunit_type='ADMIN')).prefetch_related('identifiers')
+    facilities = OrgUnit.objects.filter(~Q(orgunit_type='ADMIN'))
+    version, last_modified = registry_state(request)
 
-    summary = {k: str(v) for k,v in facilities.aggregate(facilities_count=Count('uuid')).items()}
-    last_modified_timestamp = OrgUnit.objects.latest('updatedAt').updatedAt
-    summary['last_update'] =  str(last_modified_timestamp)
-
-    # Create the HttpResponse object with the appropriate HTTP headers
-    response = HttpResponse(content_type='text/csv')
-    response['Last-Modified'] = last_modified_timestamp.strftime('%a, %d %b %Y %H:%M:%S GMT')
-    
-    # HEAD request checks when data last changed
+    # HEAD request checks when data last changed, registry_condition adds the Last-Modified and ETag headers
     if request.method == 'HEAD':
-        return response # reply with just the last modified header
-    
-    response['Content-Disposition'] = 'attachment; filename="facilities_{0}.csv"'.format(summary['last_update'][:19])
-    
-    from django.core.cache import cache
-
-    #TODO: switch to using a key:value combination of 'download_csv':(<last_update>,<csv_str>) which makes it easier to clear the cache
-    cache_key = 'download_csv {0}'.format(summary['last_update'])
-    cache.delete(cache_key)
-    csv_str = cache.get(cache_key)
-
-    if csv_str is None:
-        str_output = io.StringIO()
-
-        field_list = (
-            'uuid', 'name', 'active', 'createdAt', 'updatedAt', 'geometry_str', 'orgunit_type', 'ownership', 'authority', 'identifiers'
-        )
-        
-        writer = csv.writer(str_output, quoting=csv.QUOTE_NONNUMERIC)
-        header_list = [h.upper() for h in field_list]
-        writer.writerow(header_list) # CSV header row
-        facilities_gen = (facility_to_list(f, field_list[:-1], default='')+[str(f.identifiers_flat)] for f in facilities)
-        writer.writerows(facilities_gen)
-
-        csv_str = str_output.getvalue()
-        cache.set(cache_key, csv_str, None)
-    
-    response.write(csv_str)
+        return HttpResponse(content_type='text/csv')
+
+    csv_path = snapshot_path(version)
+
+    if csv_path is not None and os.path.exists(csv_path):
+        response = FileResponse(open(csv_path, 'rb'), content_type='text/csv')
+    else:
+        csv_lines = facility_csv_lines(facilities)
+        if csv_path is not None:
+            csv_lines = write_snapshot(csv_path, csv_lines) # build the snapshot while streaming this download
+        response = StreamingHttpResponse(csv_lines, content_type='text/csv')
+
+    response['Content-Disposition'] = 'attachment; filename="facilities_{0}.csv"'.format(str(last_modified or version)[:19])
 
     return response
+
+def metrics_allowed(request):
+    # the scraper's address goes in INTERNAL_IPS, staff can look too
+    return request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS or request.user.is_staff
+
+def metrics(request):
+    '''Request metrics of this worker process (see facilities.metrics) in the Prometheus text format'''
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def slow_requests(request):
+    '''The kept slow request traces of this worker process, latest first'''
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return JsonResponse(slow_request_traces(), safe=False)
@@ -3,3 +3,8 @@ from easyaudit.apps import EasyAuditConfig
 # Change "Easy Audit Application" to "Audit Log"
 class AuditLogConfig(EasyAuditConfig):
     verbose_name = 'Audit Log'
+
+    def ready(self):
+        super().ready()
+        from facilities import audit
+        audit.install() # buffered CRUD events and bulk change sets instead of a row per save
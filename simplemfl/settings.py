@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'facilities.metrics.MetricsMiddleware', # first, so that it measures the whole request
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,6 +59,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
     'easyaudit.middleware.easyaudit.EasyAuditMiddleware',
+    'facilities.audit.AuditBufferMiddleware', # after EasyAuditMiddleware, which sets the user
 ]
 
 ROOT_URLCONF = 'simplemfl.urls'
@@ -130,6 +132,33 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Orgunit path resolutions and dashboard summaries are cached with Django's cache framework. The
+# default is per-process memory, point CACHES at memcached/redis to share them between workers, e.g.
+# CACHES = {'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache', 'LOCATION': '127.0.0.1:11211'}}
+
+# Keep a read-only copy of the whole orgunit tree and its identifiers in every worker process, for
+# lookups without the database (see facilities.snapshot). It is checked against the data version at
+# most every REGISTRY_SNAPSHOT_MAX_AGE seconds, so other processes' writes show up with that delay.
+REGISTRY_SNAPSHOT = False
+REGISTRY_SNAPSHOT_MAX_AGE = 5
+
+# Request metrics (see facilities.metrics), served at /metrics to INTERNAL_IPS and staff users. Slow
+# requests are kept with their queries at /metrics/slow, set METRICS_LOG_FILE to also log every request.
+METRICS_SLOW_REQUEST_SECONDS = 1.0
+METRICS_SLOW_TRACE_SAMPLE = 1.0 # share of the slow requests that are kept
+METRICS_SLOW_TRACES = 50
+METRICS_LOG_FILE = None
+
+# Pre-built CSV downloads are kept here and regenerated when the registry changes (set to None to disable)
+EXPORT_ROOT = os.path.join(BASE_DIR, 'exports')
+
+# Rendered facility map tiles (/tiles/z/x/y) are cached here, and dropped tile by tile when facilities
+# change (set to None to disable). Tiles are served up to TILE_MAX_ZOOM, points are clustered below
+# TILE_CLUSTER_ZOOM.
+TILE_ROOT = os.path.join(BASE_DIR, 'tiles')
+TILE_MAX_ZOOM = 16
+TILE_CLUSTER_ZOOM = 11
+
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions, or allow read-only access for unauthenticated users.
     'DEFAULT_PERMISSION_CLASSES': [
@@ -154,3 +183,24 @@ ORG_UNIT_ROOT_NAME = 'Uganda'
 
 # audit logging settings
 DJANGO_EASY_AUDIT_WATCH_REQUEST_EVENTS = False # don't log HTTP requests
+DJANGO_EASY_AUDIT_UNREGISTERED_CLASSES_EXTRA = [
+    'facilities.OrgUnitChange', # the change feed log is an audit trail of its own
+    'facilities.OrgUnitSummary', # derived from the orgunits, rebuilt wholesale after bulk writes
+    'facilities.OrgUnitNameGram', # name search index, derived from the orgunit names
+    'facilities.OrgUnitGeometry', # simplified boundaries, derived from the orgunit geometries
+    'facilities.AuditChangeSet', # audit record of a bulk operation
+    'facilities.DuplicateScan', # bookkeeping of the duplicate detection runs
+    'facilities.OrgUnitExtent', # derived from the facility coordinates by the placement check
+    'facilities.MisplacedFacility', # placement check results, derived from the coordinates and boundaries
+]
+# CRUD events are queued and written in bulk (see facilities.audit): per request, or every
+# AUDIT_FLUSH_SIZE events. With AUDIT_ASYNC they are written by a background thread instead,
+# which tries a failed insert again AUDIT_WRITE_RETRIES times, waiting AUDIT_RETRY_DELAY seconds
+# (doubled every time) in between.
+AUDIT_FLUSH_SIZE = 500
+AUDIT_ASYNC = False
+AUDIT_WRITE_RETRIES = 3
+AUDIT_RETRY_DELAY = 1.0
+
+# duplicate facility detection (see facilities.duplicates): pairs scoring below this are not kept
+DUPLICATE_MIN_SCORE = 0.7
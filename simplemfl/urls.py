@@ -18,7 +18,7 @@ from django.contrib import admin
 
 from rest_framework import routers
 
-from facilities.views import OrgUnitViewSet, FacilityViewSet, AdminUnitViewSet, HospitalViewSet
+from facilities.views import OrgUnitViewSet, FacilityViewSet, AdminUnitViewSet, HospitalViewSet, IdentifierViewSet, ChangeFeedViewSet, DuplicateCandidateViewSet, MisplacedFacilityViewSet
 import facilities.urls
 
 # Routers provide an easy way of automatically determining the URL conf.
@@ -27,6 +27,10 @@ router.register(r'facilities', FacilityViewSet, base_name='facilities')
 router.register(r'adminunits', AdminUnitViewSet, base_name='adminunits')
 router.register(r'orgunits', OrgUnitViewSet)
 router.register(r'hospitals', HospitalViewSet, base_name='hospitals')
+router.register(r'identifiers', IdentifierViewSet)
+router.register(r'changes', ChangeFeedViewSet, base_name='changes')
+router.register(r'duplicates', DuplicateCandidateViewSet, base_name='duplicates')
+router.register(r'misplaced', MisplacedFacilityViewSet, base_name='misplaced')
 # router.register(r'geojson', GeoJSONOrgUnitViewSet, base_name='geojson')
 
 urlpatterns = [